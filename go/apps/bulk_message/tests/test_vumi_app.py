@@ -13,6 +13,7 @@ from vumi.tests.utils import LogCatcher
 
 from go.vumitools.tests.utils import AppWorkerTestCase
 from go.vumitools.api import VumiApiCommand
+from go.vumitools.middleware import DebitAccountMiddleware
 from go.apps.bulk_message.vumi_app import BulkMessageApplication
 
 
@@ -88,6 +89,21 @@ class TestBulkMessageApplication(AppWorkerTestCase):
         self.assertEqual(msg1['to_addr'], contact1.msisdn)
         self.assertEqual(msg2['to_addr'], contact2.msisdn)
 
+    @inlineCallbacks
+    def test_start_with_recipient_snapshot(self):
+        conversation = yield self.setup_conversation()
+        yield self.start_conversation(
+            conversation, snapshot_recipients=True)
+        info = yield conversation.recipient_snapshot().get_info()
+        self.assertEqual(info['count'], 2)
+
+        yield self._amqp.kick_delivery()
+        self.clock.advance(self.app.monitor_interval + 1)
+        msgs = yield self.wait_for_dispatched_messages(2)
+        [contact1, contact2] = yield self.get_opted_in_contacts(conversation)
+        self.assertEqual(sorted(msg['to_addr'] for msg in msgs),
+                         [contact1.msisdn, contact2.msisdn])
+
     @inlineCallbacks
     def test_start_with_deduplication(self):
         # Create two contacts with the same to_addr, they should be deduped
@@ -115,6 +131,77 @@ class TestBulkMessageApplication(AppWorkerTestCase):
         self.assertEqual(msg['to_addr'], contact1.msisdn)
         self.assertEqual(msg['to_addr'], contact2.msisdn)
 
+    @inlineCallbacks
+    def test_start_records_progress(self):
+        conversation = yield self.setup_conversation(contact_count=3)
+        yield self.start_conversation(conversation)
+        [batch_id] = conversation.get_batch_keys()
+        window_id = self.app.get_window_id(conversation.key, batch_id)
+
+        progress = yield self.app.get_send_progress(window_id)
+        self.assertEqual(progress['contacts'], 3)
+        self.assertEqual(progress['queued'], 3)
+        self.assertEqual(progress['duplicates'], 0)
+        self.assertTrue(progress['finished_at'] >= progress['started_at'])
+        self.assertEqual(
+            (yield self.app.window_manager.count_waiting(window_id)), 3)
+
+    @inlineCallbacks
+    def test_start_with_deduplication_records_progress(self):
+        conversation = yield self.setup_conversation(from_addr=u'27831234567',
+            contact_count=3)
+        yield self.start_conversation(conversation, dedupe=True)
+        [batch_id] = conversation.get_batch_keys()
+        window_id = self.app.get_window_id(conversation.key, batch_id)
+
+        progress = yield self.app.get_send_progress(window_id)
+        self.assertEqual(progress['contacts'], 3)
+        self.assertEqual(progress['queued'], 1)
+        self.assertEqual(progress['duplicates'], 2)
+        # The dedupe set is only needed while we're sending.
+        self.assertEqual((yield self.app.fan_out_redis.smembers(
+            self.app.get_dedupe_key(window_id))), set())
+
+    @inlineCallbacks
+    def test_dedupe_addresses_expire(self):
+        unique = yield self.app.dedupe_addresses(
+            'window-1', ['+1', '+2', '+1'])
+        self.assertEqual(unique, ['+1', '+2'])
+        self.assertEqual(
+            (yield self.app.dedupe_addresses('window-1', ['+2', '+3'])),
+            ['+3'])
+        dedupe_key = self.app.get_dedupe_key('window-1')
+        ttl = yield self.app.fan_out_redis.ttl(dedupe_key)
+        self.assertTrue(0 < ttl <= self.app.dedupe_lifetime)
+
+    @inlineCallbacks
+    def test_start_with_credit_reservation(self):
+        self.app.reserve_credits = True
+        yield self.vumi_api.tpm.set_metadata(u"pool", {
+            "transport_type": self.transport_type,
+            "msg_options": {
+                "transport_name": self.transport_name,
+                },
+            "credits_per_message": 2,
+            })
+        yield self.vumi_api.cm.credit(self.user_account.key, 5)
+        conversation = yield self.setup_conversation(contact_count=3)
+        yield self.start_conversation(conversation)
+        [batch_id] = conversation.get_batch_keys()
+        window_id = self.app.get_window_id(conversation.key, batch_id)
+
+        progress = yield self.app.get_send_progress(window_id)
+        self.assertEqual(progress['queued'], 2)
+        self.assertEqual(progress['unpaid'], 1)
+        self.assertEqual(
+            (yield self.vumi_api.cm.get_credit(self.user_account.key)), 1)
+
+        yield self._amqp.kick_delivery()
+        self.clock.advance(self.app.monitor_interval + 1)
+        msgs = yield self.wait_for_dispatched_messages(2)
+        for msg in msgs:
+            self.assertTrue(DebitAccountMiddleware.is_prepaid_message(msg))
+
     @inlineCallbacks
     def test_consume_events(self):
         conversation = yield self.setup_conversation()
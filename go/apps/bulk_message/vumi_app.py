@@ -2,12 +2,16 @@
 # -*- coding: utf-8 -*-
 
 """Vumi application worker for the vumitools API."""
-from twisted.internet.defer import inlineCallbacks, returnValue
+import time
+from copy import deepcopy
+
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
 
 from vumi.components.window_manager import WindowManager
 from vumi import log
 
 from go.vumitools.app_worker import GoApplicationWorker
+from go.vumitools.middleware import DebitAccountMiddleware
 
 
 class BulkMessageApplication(GoApplicationWorker):
@@ -20,10 +24,27 @@ class BulkMessageApplication(GoApplicationWorker):
     max_ack_wait = 10
     monitor_interval = 1
     monitor_window_cleanup = True
+    # How many contact bunches to have loading from Riak while the
+    # current one is being written to the window.
+    max_bunches_in_flight = 4
+    # How often (in queued messages) to log send progress.
+    progress_log_interval = 10000
+    # How long (in seconds) a dedupe set outlives the last bunch added to
+    # it, in case the send dies before it can delete it.
+    dedupe_lifetime = 24 * 60 * 60
+
+    def validate_config(self):
+        super(BulkMessageApplication, self).validate_config()
+        # If set, credit for each contact bunch is reserved up front and
+        # the messages are marked as paid for so that the
+        # DebitAccountMiddleware doesn't debit them one at a time.
+        self.reserve_credits = self.config.get('reserve_credits', False)
 
     @inlineCallbacks
     def setup_application(self):
         yield super(BulkMessageApplication, self).setup_application()
+        self.fan_out_redis = self.redis.sub_manager('%s:fan_out' % (
+            self.worker_name,))
         wm_redis = self.redis.sub_manager('%s:window_manager' % (
             self.worker_name,))
         self.window_manager = WindowManager(wm_redis,
@@ -88,17 +109,157 @@ class BulkMessageApplication(GoApplicationWorker):
                 'and conversation_key: %s' % (batch_id, conversation_key))
             return
 
-        to_addresses = []
-        for contacts_batch in (yield conv.get_opted_in_contact_bunches()):
-            for contact in (yield contacts_batch):
-                to_addresses.append(contact.addr_for(conv.delivery_class))
-        if extra_params.get('dedupe'):
-            to_addresses = set(to_addresses)
-
         window_id = self.get_window_id(conversation_key, batch_id)
-        for to_addr in to_addresses:
-            yield self.send_message_via_window(window_id, batch_id, to_addr,
-                                    conv.message, msg_options)
+        yield self.send_to_contacts(window_id, batch_id, conv, msg_options,
+                                    dedupe=extra_params.get('dedupe'))
+
+    def get_progress_key(self, window_id):
+        return ':'.join(['progress', window_id])
+
+    def get_dedupe_key(self, window_id):
+        return ':'.join(['dedupe', window_id])
+
+    @inlineCallbacks
+    def get_send_progress(self, window_id):
+        """
+        Return a dictionary describing how far along the fan-out for a
+        window is.
+
+        :rtype: dict
+            *contacts* The number of opted-in contacts seen so far.
+            *queued* The number of messages added to the window.
+            *duplicates* The number of addresses dropped by deduplication.
+            *unpaid* The number of messages dropped because the account ran
+            out of credit (only if `reserve_credits` is set).
+            *started_at* When the fan-out started (seconds since the epoch).
+            *finished_at* When the fan-out finished, absent while running.
+        """
+        progress = yield self.fan_out_redis.hgetall(
+            self.get_progress_key(window_id))
+        returnValue(dict((k, float(v) if k.endswith('_at') else int(v))
+                         for k, v in progress.items()))
+
+    @inlineCallbacks
+    def send_to_contacts(self, window_id, batch_id, conv, msg_options,
+                            dedupe=False):
+        """
+        Stream the conversation's opted-in contacts into the send window.
+
+        Up to `max_bunches_in_flight` contact bunches are loading from Riak
+        while earlier ones are being written. Each bunch is written to the
+        window with concurrent Redis calls rather than one message at a time
+        and duplicate addresses are filtered through a Redis set so that we
+        never hold the full address list in memory.
+        """
+        progress_key = self.get_progress_key(window_id)
+        yield self.fan_out_redis.delete(progress_key)
+        yield self.fan_out_redis.hmset(progress_key, {
+            'contacts': 0,
+            'queued': 0,
+            'duplicates': 0,
+            'unpaid': 0,
+            'started_at': repr(time.time()),
+            })
+
+        credits_per_message = None
+        if self.reserve_credits:
+            pool = conv.delivery_tag_pool
+            tagpool_metadata = yield self.vumi_api.tpm.get_metadata(pool)
+            credits_per_message = (
+                DebitAccountMiddleware.parse_credits_per_message(
+                    pool, tagpool_metadata))
+            msg_options = deepcopy(msg_options)
+            DebitAccountMiddleware.add_prepaid_to_payload(msg_options)
+
+        in_flight = []
+        queued = 0
+        for contacts_bunch in (yield conv.get_opted_in_address_bunches()):
+            in_flight.append(contacts_bunch)
+            if len(in_flight) < self.max_bunches_in_flight:
+                continue
+            contacts = yield in_flight.pop(0)
+            queued += yield self.send_to_contacts_bunch(window_id, batch_id,
+                conv, msg_options, contacts, dedupe, credits_per_message)
+            self._log_send_progress(window_id, queued, len(contacts))
+
+        while in_flight:
+            contacts = yield in_flight.pop(0)
+            queued += yield self.send_to_contacts_bunch(window_id, batch_id,
+                conv, msg_options, contacts, dedupe, credits_per_message)
+            self._log_send_progress(window_id, queued, len(contacts))
+
+        if dedupe:
+            yield self.fan_out_redis.delete(self.get_dedupe_key(window_id))
+        yield self.fan_out_redis.hset(progress_key, 'finished_at',
+                                      repr(time.time()))
+        log.info('Queued %s messages for window %s.' % (queued, window_id))
+
+    def _log_send_progress(self, window_id, queued, bunch_size):
+        interval = self.progress_log_interval
+        if (queued - bunch_size) // interval != queued // interval:
+            log.info('Queued %s messages for window %s so far.' % (
+                queued, window_id))
+
+    @inlineCallbacks
+    def send_to_contacts_bunch(self, window_id, batch_id, conv, msg_options,
+                                contacts, dedupe=False,
+                                credits_per_message=None):
+        progress_key = self.get_progress_key(window_id)
+        to_addresses = [contact.addr_for(conv.delivery_class)
+                        for contact in contacts]
+        duplicates = 0
+        if dedupe:
+            unique_addresses = yield self.dedupe_addresses(window_id,
+                                                           to_addresses)
+            duplicates = len(to_addresses) - len(unique_addresses)
+            to_addresses = unique_addresses
+
+        unpaid = 0
+        if to_addresses and credits_per_message is not None:
+            paid = yield self.vumi_api.cm.debit_many(
+                conv.user_account.key, credits_per_message,
+                len(to_addresses))
+            unpaid = len(to_addresses) - paid
+            to_addresses = to_addresses[:paid]
+            if unpaid:
+                log.warning('Insufficient credit for %s messages in window'
+                            ' %s.' % (unpaid, window_id))
+
+        if to_addresses:
+            # The window might have been cleaned up by the monitor if it
+            # drained while we were waiting on Riak, so make sure it exists.
+            yield self.window_manager.create_window(window_id, strict=False)
+            yield gatherResults([self.window_manager.add(window_id, {
+                    'batch_id': batch_id,
+                    'to_addr': to_addr,
+                    'content': conv.message,
+                    'msg_options': msg_options,
+                    }) for to_addr in to_addresses])
+
+        yield self.fan_out_redis.hincrby(progress_key, 'contacts',
+                                         len(contacts))
+        yield self.fan_out_redis.hincrby(progress_key, 'queued',
+                                         len(to_addresses))
+        yield self.fan_out_redis.hincrby(progress_key, 'duplicates',
+                                         duplicates)
+        yield self.fan_out_redis.hincrby(progress_key, 'unpaid', unpaid)
+        returnValue(len(to_addresses))
+
+    @inlineCallbacks
+    def dedupe_addresses(self, window_id, to_addresses):
+        """
+        Return the addresses in `to_addresses` that haven't been seen for
+        this window yet. The set of seen addresses holds one entry per
+        unique address in the send and expires `dedupe_lifetime` seconds
+        after the last bunch if the send doesn't finish.
+        """
+        dedupe_key = self.get_dedupe_key(window_id)
+        added = yield gatherResults([
+            self.fan_out_redis.sadd(dedupe_key, to_addr)
+            for to_addr in to_addresses])
+        yield self.fan_out_redis.expire(dedupe_key, self.dedupe_lifetime)
+        returnValue([to_addr for to_addr, is_new in zip(to_addresses, added)
+                     if is_new])
 
     def consume_ack(self, event):
         return self.handle_event(event)
@@ -239,7 +239,8 @@ def people(request, conversation_key):
     if request.method == 'POST':
         if conversation.is_client_initiated():
             try:
-                conversation.start()
+                conversation.start(
+                    index_messages=settings.CONVERSATION_MESSAGE_SEARCH_INDEX)
             except ConversationSendError as error:
                 if str(error) == 'No spare messaging tags.':
                     error = 'You have maxed out your available ' \
@@ -291,7 +292,8 @@ def start(request, conversation_key):
     conversation = conversation_or_404(request.user_api, conversation_key)
     if request.method == 'POST':
         try:
-            conversation.start()
+            conversation.start(
+                index_messages=settings.CONVERSATION_MESSAGE_SEARCH_INDEX)
         except ConversationSendError as error:
             messages.add_message(request, messages.ERROR, str(error))
             return redirect(reverse('multi_survey:start', kwargs={
@@ -99,7 +99,7 @@ class MultiSurveyApplication(MamaPollApplication, GoApplicationMixin):
 
         if account_key is not None:
             # check if user is opted out
-            opt_out_store = OptOutStore(self.manager, account_key)
+            opt_out_store = OptOutStore(self.manager, account_key, self.redis)
             from_addr = message.get("from_addr")
             opt_out = yield opt_out_store.get_opt_out("msisdn", from_addr)
             if opt_out:
@@ -141,7 +141,7 @@ class MultiSurveyApplication(MamaPollApplication, GoApplicationMixin):
 
         conv = yield self.get_conversation(batch_id, conversation_key)
 
-        for contacts in (yield conv.get_opted_in_contact_bunches()):
+        for contacts in (yield conv.get_opted_in_address_bunches()):
             for contact in (yield contacts):
                 to_addr = contact.addr_for(conv.delivery_class)
                 yield self.start_survey(to_addr, conv, **msg_options)
@@ -26,7 +26,7 @@ class OptOutApplication(GoApplicationWorker):
                 "to a specific service, please try again later.")
             return
 
-        opt_out_store = OptOutStore(self.manager, account_key)
+        opt_out_store = OptOutStore(self.manager, account_key, self.redis)
         from_addr = message.get("from_addr")
         # Note: for now we are hardcoding addr_type as 'msisdn'
         # as only msisdn's are opting out currently
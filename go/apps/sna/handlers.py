@@ -14,7 +14,8 @@ class SNAEventHandler(EventHandler):
 
     def find_contact(self, account_key, msisdn):
         contact_store = ContactStore(self.dispatcher.vumi_api.manager,
-                                        account_key)
+                                        account_key,
+                                        self.dispatcher.vumi_api.redis)
         return contact_store.contact_for_addr('ussd', msisdn)
 
 
@@ -48,7 +49,8 @@ class USSDOptOutHandler(SNAEventHandler):
 
         """
         account_key = event.payload['account_key']
-        oo_store = OptOutStore(self.vumi_api.manager, account_key)
+        oo_store = OptOutStore(
+            self.vumi_api.manager, account_key, self.vumi_api.redis)
 
         event_data = event.payload['content']
 
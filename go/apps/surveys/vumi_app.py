@@ -153,7 +153,7 @@ class SurveyApplication(PollApplication, GoApplicationMixin):
         if not conv:
             return
 
-        for contacts in (yield conv.get_opted_in_contact_bunches()):
+        for contacts in (yield conv.get_opted_in_address_bunches()):
             for contact in (yield contacts):
                 to_addr = contact.addr_for(conv.delivery_class)
                 yield self.start_survey(to_addr, conv, **msg_options)
@@ -0,0 +1,49 @@
+"""Helpers for the Vumi Go management commands."""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+
+from go.base.utils import vumi_api_for_user
+
+
+class AccountRebuildCommand(BaseCommand):
+    """
+    Base class for commands that rebuild something for one or all Vumi Go
+    accounts. Subclasses implement :meth:`rebuild`, which is called with
+    the user api of each account and returns a summary of what it did.
+    The options the command was called with are in `self.options`.
+    """
+
+    LOCAL_OPTIONS = [
+        make_option('--email-address',
+            dest='email_address',
+            help='Email address for the Vumi Go user'),
+        make_option('--all',
+            dest='all',
+            action='store_true',
+            default=False,
+            help='Rebuild for all accounts'),
+    ]
+    option_list = BaseCommand.option_list + tuple(LOCAL_OPTIONS)
+
+    def handle(self, *args, **options):
+        self.options = options
+        email_address = options.get('email_address')
+        if options.get('all'):
+            users = User.objects.all().order_by('date_joined')
+        elif email_address:
+            try:
+                users = [User.objects.get(email=email_address)]
+            except User.DoesNotExist, e:
+                raise CommandError(e)
+        else:
+            raise CommandError('Please specify --email-address or --all')
+
+        for user in users:
+            summary = self.rebuild(vumi_api_for_user(user))
+            self.stdout.write('%s for %s\n' % (summary, user.email))
+
+    def rebuild(self, user_api):
+        raise NotImplementedError('Subclasses should implement this.')
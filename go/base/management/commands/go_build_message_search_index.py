@@ -0,0 +1,37 @@
+from optparse import make_option
+
+from go.base.command_utils import AccountRebuildCommand
+
+
+class Command(AccountRebuildCommand):
+    help = """
+    Add the messages of the conversations of one or all Vumi Go accounts to
+    the message search index, and keep indexing new messages in their
+    batches from now on. Conversations started with
+    CONVERSATION_MESSAGE_SEARCH_INDEX set are indexed from the start and
+    don't need this.
+    """
+
+    LOCAL_OPTIONS = [
+        make_option('--conversation-key',
+            dest='conversation_key',
+            help='Only index this conversation'),
+    ]
+    option_list = AccountRebuildCommand.option_list + tuple(LOCAL_OPTIONS)
+
+    def rebuild(self, user_api):
+        message_store = user_api.api.mdb
+        conversation_key = self.options.get('conversation_key')
+        if conversation_key is not None:
+            conv_keys = [conversation_key]
+        else:
+            conv_keys = user_api.conversation_store.list_conversations()
+        batches = messages = 0
+        for conv_key in conv_keys:
+            conversation = user_api.get_wrapped_conversation(conv_key)
+            if conversation is None:
+                continue
+            for batch_key in conversation.batches.keys():
+                messages += message_store.build_search_index(batch_key)
+                batches += 1
+        return 'Indexed %s message(s) in %s batch(es)' % (messages, batches)
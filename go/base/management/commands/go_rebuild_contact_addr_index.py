@@ -0,0 +1,13 @@
+from go.base.command_utils import AccountRebuildCommand
+
+
+class Command(AccountRebuildCommand):
+    help = """
+    Rebuild the Redis index of contacts by address for one or all Vumi Go
+    accounts from the contacts stored in Riak. Contacts that aren't in the
+    index are looked up with a Riak search.
+    """
+
+    def rebuild(self, user_api):
+        count = user_api.contact_store.rebuild_addr_index()
+        return 'Indexed %s contact(s)' % (count,)
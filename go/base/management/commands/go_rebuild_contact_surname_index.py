@@ -0,0 +1,13 @@
+from go.base.command_utils import AccountRebuildCommand
+
+
+class Command(AccountRebuildCommand):
+    help = """
+    Re-save the contacts for one or all Vumi Go accounts so that they have
+    surname letter indexes, and start using those indexes to browse contacts
+    by surname.
+    """
+
+    def rebuild(self, user_api):
+        count = user_api.contact_store.rebuild_surname_index()
+        return 'Indexed %s contact(s)' % (count,)
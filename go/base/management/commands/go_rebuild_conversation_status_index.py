@@ -0,0 +1,14 @@
+from go.base.command_utils import AccountRebuildCommand
+
+
+class Command(AccountRebuildCommand):
+    help = """
+    Rebuild the Redis conversation status index for one or all Vumi Go
+    accounts from the conversations stored in Riak. Until an account's index
+    has been built, its draft and running conversations are listed from
+    Riak.
+    """
+
+    def rebuild(self, user_api):
+        count = user_api.conversation_store.rebuild_status_index()
+        return 'Indexed %s active conversation(s)' % (count,)
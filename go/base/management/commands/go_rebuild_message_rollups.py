@@ -0,0 +1,20 @@
+from go.base.command_utils import AccountRebuildCommand
+
+
+class Command(AccountRebuildCommand):
+    help = """
+    Rebuild the per-batch message count rollups for the conversations of one
+    or all Vumi Go accounts from the message store cache. Until a batch's
+    rollups have been rebuilt (or if it was started before they existed),
+    conversation aggregates for it are counted from its cached message keys.
+    """
+
+    def rebuild(self, user_api):
+        cache = user_api.api.mdb.cache
+        batches = messages = 0
+        for conv_key in user_api.conversation_store.list_conversations():
+            conversation = user_api.get_wrapped_conversation(conv_key)
+            for batch_key in conversation.batches.keys():
+                messages += cache.rebuild_rollups(batch_key)
+                batches += 1
+        return 'Rolled up %s message(s) in %s batch(es)' % (messages, batches)
@@ -0,0 +1,17 @@
+from go.base.command_utils import AccountRebuildCommand
+from go.vumitools.opt_out import OptOutStore
+
+
+class Command(AccountRebuildCommand):
+    help = """
+    Rebuild the Redis opt-out index for one or all Vumi Go accounts from the
+    opt-outs stored in Riak. Until an account's index has been built, opt-out
+    checks for that account are done with Riak MapReduce.
+    """
+
+    def rebuild(self, user_api):
+        opt_out_store = OptOutStore(user_api.api.manager,
+                                    user_api.user_account_key,
+                                    user_api.api.redis)
+        count = opt_out_store.rebuild_opt_out_index()
+        return 'Indexed %s opt-out(s)' % (count,)
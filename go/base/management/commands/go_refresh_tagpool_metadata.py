@@ -0,0 +1,14 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from go.vumitools.api import VumiApi
+
+
+class Command(BaseCommand):
+    help = ("Make all Vumi Go workers reload tagpool metadata. Run this "
+            "after changing tagpools with the vumi_tagpools script.")
+
+    def handle(self, *args, **options):
+        api = VumiApi.from_config_sync(settings.VUMI_API_CONFIG)
+        api.tpm.refresh_metadata()
+        self.stdout.write('Tagpool metadata refreshed\n')
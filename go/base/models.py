@@ -18,6 +18,8 @@ def create_user_profile(sender, instance, created, **kwargs):
         account = get_account_store().new_user(unicode(instance.username))
         UserProfile.objects.create(user=instance, user_account=account.key)
     user_api = vumi_api_for_user(instance)
+    if created:
+        user_api.mark_indexes_built()
     # Enable search for the contact & group stores
     user_api.contact_store.contacts.enable_search()
     user_api.contact_store.groups.enable_search()
@@ -0,0 +1,32 @@
+import os
+from datetime import datetime, timedelta
+
+from celery.task import task
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from go.base.utils import EXPORTS_DIR
+
+
+@task(ignore_result=True)
+def delete_expired_exports():
+    """
+    Delete stored exports that are older than `EXPORT_RETENTION_DAYS` days.
+    Returns the number of exports deleted.
+    """
+    if not default_storage.exists(EXPORTS_DIR):
+        return 0
+    expires_before = datetime.now() - timedelta(
+        days=settings.EXPORT_RETENTION_DAYS)
+    deleted = 0
+    account_dirs, _files = default_storage.listdir(EXPORTS_DIR)
+    for account_dir in account_dirs:
+        account_path = os.path.join(EXPORTS_DIR, account_dir)
+        _dirs, export_names = default_storage.listdir(account_path)
+        for export_name in export_names:
+            export_path = os.path.join(account_path, export_name)
+            if default_storage.modified_time(export_path) < expires_before:
+                default_storage.delete(export_path)
+                deleted += 1
+    return deleted
@@ -9,6 +9,7 @@ from django.core.paginator import Paginator
 from go.base.tests.utils import VumiGoDjangoTestCase
 from go.base.templatetags import go_tags
 from go.base import utils
+from go.vumitools.opt_out import OptOutStore
 
 
 class AuthenticationTestCase(VumiGoDjangoTestCase):
@@ -24,6 +25,16 @@ class AuthenticationTestCase(VumiGoDjangoTestCase):
         self.assertEqual('username',
                          self.user.userprofile.get_user_account().username)
 
+    def test_user_account_indexes_built(self):
+        user_api = utils.vumi_api_for_user(self.user)
+        self.assertTrue(
+            user_api.conversation_store.status_index_built())
+        self.assertTrue(user_api.contact_store.surname_index_built())
+        opt_out_store = OptOutStore(user_api.api.manager,
+                                    user_api.user_account_key,
+                                    user_api.api.redis)
+        self.assertTrue(opt_out_store.opt_out_index_built())
+
     def test_redirect_to_login(self):
         """test the authentication mechanism"""
         response = self.client.get(reverse('conversations:index'))
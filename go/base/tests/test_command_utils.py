@@ -0,0 +1,65 @@
+from StringIO import StringIO
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import CommandError
+
+from go.base.tests.utils import VumiGoDjangoTestCase
+from go.base.command_utils import AccountRebuildCommand
+
+
+class RecordingRebuildCommand(AccountRebuildCommand):
+
+    def __init__(self):
+        super(RecordingRebuildCommand, self).__init__()
+        self.account_keys = []
+
+    def rebuild(self, user_api):
+        self.account_keys.append(user_api.user_account_key)
+        return 'Rebuilt %s' % (len(self.account_keys),)
+
+
+class AccountRebuildCommandTestCase(VumiGoDjangoTestCase):
+
+    USE_RIAK = True
+
+    def setUp(self):
+        super(AccountRebuildCommandTestCase, self).setUp()
+        self.setup_api()
+        self.user = self.mk_django_user()
+        self.command = RecordingRebuildCommand()
+        self.command.stdout = StringIO()
+        self.command.stderr = StringIO()
+
+    def get_account_key(self, user):
+        return user.get_profile().user_account
+
+    def test_sanity_checks(self):
+        self.assertRaisesRegexp(CommandError,
+            'Please specify --email-address or --all', self.command.handle)
+        self.assertRaisesRegexp(CommandError,
+            'User matching query does not exist', self.command.handle,
+            email_address='foo@bar')
+
+    def test_rebuild_one(self):
+        User.objects.create_user('other', 'other@example.com', 'password')
+        self.command.handle(email_address=self.user.email)
+        self.assertEqual(self.command.account_keys,
+                         [self.get_account_key(self.user)])
+        self.assertEqual(self.command.stdout.getvalue(),
+            'Rebuilt 1 for %s\n' % (self.user.email,))
+
+    def test_rebuild_all(self):
+        other_user = User.objects.create_user(
+            'other', 'other@example.com', 'password')
+        # Accounts are rebuilt in the order they joined.
+        other_user.date_joined = self.user.date_joined + timedelta(days=1)
+        other_user.save()
+        self.command.handle(all=True)
+        self.assertEqual(self.command.account_keys, [
+            self.get_account_key(self.user),
+            self.get_account_key(other_user),
+            ])
+        self.assertEqual(self.command.stdout.getvalue(),
+            'Rebuilt 1 for %s\nRebuilt 2 for %s\n' % (
+                self.user.email, other_user.email))
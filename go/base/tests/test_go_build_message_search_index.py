@@ -0,0 +1,33 @@
+from StringIO import StringIO
+
+from go.apps.tests.base import DjangoGoApplicationTestCase
+from go.base.management.commands import go_build_message_search_index
+
+
+class GoBuildMessageSearchIndexCommandTestCase(DjangoGoApplicationTestCase):
+
+    USE_RIAK = True
+
+    def setUp(self):
+        super(GoBuildMessageSearchIndexCommandTestCase, self).setUp()
+        self.setup_riak_fixtures()
+        self.command = go_build_message_search_index.Command()
+        self.command.stdout = StringIO()
+        self.command.stderr = StringIO()
+
+    def test_build_index(self):
+        self.put_sample_messages_in_conversation(self.user_api,
+                                                 self.conv_key, 2)
+        conversation = self.user_api.get_wrapped_conversation(self.conv_key)
+        self.assertEqual(
+            conversation.search_message_keys('inbound', 'hello'), None)
+
+        self.command.handle(email_address=self.user.email,
+                            conversation_key=self.conv_key)
+        self.assertEqual(self.command.stdout.getvalue(),
+            'Indexed 4 message(s) in 1 batch(es) for %s\n' % (
+                self.user.email,))
+        self.assertEqual(
+            len(conversation.search_message_keys('inbound', 'hello')), 2)
+        self.assertEqual(
+            len(conversation.search_message_keys('outbound', 'thank*')), 2)
@@ -0,0 +1,30 @@
+from StringIO import StringIO
+
+from go.apps.tests.base import DjangoGoApplicationTestCase
+from go.base.management.commands import go_rebuild_contact_addr_index
+from go.vumitools.contact import ContactStore
+
+
+class GoRebuildContactAddrIndexCommandTestCase(DjangoGoApplicationTestCase):
+
+    USE_RIAK = True
+
+    def setUp(self):
+        super(GoRebuildContactAddrIndexCommandTestCase, self).setUp()
+        self.setup_riak_fixtures()
+        self.command = go_rebuild_contact_addr_index.Command()
+        self.command.stdout = StringIO()
+        self.command.stderr = StringIO()
+
+    def test_rebuild_index(self):
+        redis = self.contact_store.redis
+        redis.delete(self.contact_store.addr_index_key('msisdn'))
+        ContactStore.addr_cache.clear()
+
+        self.command.handle(email_address=self.user.email)
+        self.assertEqual(self.command.stdout.getvalue(),
+            'Indexed 1 contact(s) for %s\n' % (self.user.email,))
+        self.assertEqual(
+            redis.hget(self.contact_store.addr_index_key('msisdn'),
+                       u'+27761234567'),
+            self.contact_key)
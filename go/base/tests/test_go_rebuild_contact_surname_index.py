@@ -0,0 +1,31 @@
+from StringIO import StringIO
+
+from go.apps.tests.base import DjangoGoApplicationTestCase
+from go.base.management.commands import go_rebuild_contact_surname_index
+
+
+class GoRebuildContactSurnameIndexCommandTestCase(
+        DjangoGoApplicationTestCase):
+
+    USE_RIAK = True
+
+    def setUp(self):
+        super(GoRebuildContactSurnameIndexCommandTestCase, self).setUp()
+        self.setup_riak_fixtures()
+        self.command = go_rebuild_contact_surname_index.Command()
+        self.command.stdout = StringIO()
+        self.command.stderr = StringIO()
+
+    def test_rebuild_index(self):
+        # Accounts created before the index existed don't have it.
+        self.contact_store.redis.delete(
+            self.contact_store.SURNAME_INDEXED_KEY)
+        self.assertFalse(self.contact_store.surname_index_built())
+        self.command.handle(email_address=self.user.email)
+        self.assertEqual(self.command.stdout.getvalue(),
+            'Indexed 1 contact(s) for %s\n' % (self.user.email,))
+        self.assertTrue(self.contact_store.surname_index_built())
+        self.assertEqual(
+            self.contact_store.list_contact_keys_for_surname(
+                self.contact.surname[0]),
+            [self.contact_key])
@@ -0,0 +1,30 @@
+from StringIO import StringIO
+
+from go.apps.tests.base import DjangoGoApplicationTestCase
+from go.base.management.commands import go_rebuild_conversation_status_index
+
+
+class GoRebuildConversationStatusIndexCommandTestCase(
+        DjangoGoApplicationTestCase):
+
+    USE_RIAK = True
+
+    def setUp(self):
+        super(GoRebuildConversationStatusIndexCommandTestCase, self).setUp()
+        self.setup_riak_fixtures()
+        self.command = go_rebuild_conversation_status_index.Command()
+        self.command.stdout = StringIO()
+        self.command.stderr = StringIO()
+
+    def test_rebuild_index(self):
+        # Accounts created before the index existed don't have it.
+        self.conv_store.redis.delete(self.conv_store.INDEXED_KEY)
+        self.assertFalse(self.conv_store.status_index_built())
+
+        self.command.handle(email_address=self.user.email)
+        self.assertEqual(self.command.stdout.getvalue(),
+            'Indexed 1 active conversation(s) for %s\n' % (self.user.email,))
+        self.assertTrue(self.conv_store.status_index_built())
+        [summary] = self.user_api.active_conversation_summaries()
+        self.assertEqual(summary.key, self.conv_key)
+        self.assertEqual(summary.status, u'draft')
@@ -0,0 +1,32 @@
+from StringIO import StringIO
+
+from go.apps.tests.base import DjangoGoApplicationTestCase
+from go.base.management.commands import go_rebuild_message_rollups
+
+
+class GoRebuildMessageRollupsCommandTestCase(DjangoGoApplicationTestCase):
+
+    USE_RIAK = True
+
+    def setUp(self):
+        super(GoRebuildMessageRollupsCommandTestCase, self).setUp()
+        self.setup_riak_fixtures()
+        self.command = go_rebuild_message_rollups.Command()
+        self.command.stdout = StringIO()
+        self.command.stderr = StringIO()
+
+    def test_rebuild_rollups(self):
+        self.put_sample_messages_in_conversation(self.user_api,
+                                                 self.conv_key, 2)
+        conversation = self.user_api.get_wrapped_conversation(self.conv_key)
+        batch_key = conversation.get_latest_batch_key()
+        cache = self.api.mdb.cache
+        cache.clear_rollups(batch_key)
+        self.assertEqual(cache.get_rollup_counts(batch_key, 'inbound'), None)
+
+        self.command.handle(email_address=self.user.email)
+        self.assertEqual(self.command.stdout.getvalue(),
+            'Rolled up 4 message(s) in 1 batch(es) for %s\n' % (
+                self.user.email,))
+        counts = cache.get_rollup_counts(batch_key, 'inbound')
+        self.assertEqual(sum(count for _, count in counts), 2)
@@ -0,0 +1,41 @@
+from StringIO import StringIO
+
+from go.apps.tests.base import DjangoGoApplicationTestCase
+from go.base.management.commands import go_rebuild_opt_out_index
+from go.base.utils import vumi_api_for_user
+from go.vumitools.opt_out import OptOutStore
+
+
+class GoRebuildOptOutIndexCommandTestCase(DjangoGoApplicationTestCase):
+
+    USE_RIAK = True
+
+    def setUp(self):
+        super(GoRebuildOptOutIndexCommandTestCase, self).setUp()
+        self.setup_riak_fixtures()
+        self.user_api = vumi_api_for_user(self.user)
+        self.command = go_rebuild_opt_out_index.Command()
+        self.command.stdout = StringIO()
+        self.command.stderr = StringIO()
+
+    def get_opt_out_store(self, redis=None):
+        return OptOutStore(self.user_api.api.manager,
+                           self.user_api.user_account_key, redis)
+
+    def test_rebuild_index(self):
+        # Opt-outs stored without Redis aren't in the index.
+        riak_store = self.get_opt_out_store()
+        riak_store.new_opt_out(u'msisdn', u'+27761234567', {
+            'message_id': u'message-id'})
+
+        store = self.get_opt_out_store(self.user_api.api.redis)
+        # Accounts created before the index existed don't have it.
+        store.redis.delete(store.INDEXED_KEY)
+        self.assertFalse(store.opt_out_index_built())
+
+        self.command.handle(email_address=self.user.email)
+        self.assertEqual(self.command.stdout.getvalue(),
+            'Indexed 1 opt-out(s) for %s\n' % (self.user.email,))
+        self.assertTrue(store.opt_out_index_built())
+        self.assertEqual(store.opt_outs_for_addresses(u'msisdn', [
+            u'+27761234567', u'+27761234568']), [u'msisdn:+27761234567'])
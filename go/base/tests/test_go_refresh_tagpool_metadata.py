@@ -0,0 +1,32 @@
+from StringIO import StringIO
+
+from go.base.tests.utils import VumiGoDjangoTestCase
+from go.base.management.commands import go_refresh_tagpool_metadata
+
+
+class GoRefreshTagpoolMetadataTestCase(VumiGoDjangoTestCase):
+
+    USE_RIAK = False
+
+    def setUp(self):
+        super(GoRefreshTagpoolMetadataTestCase, self).setUp()
+        self.setup_api()
+        self.tpm = self.api.tpm
+        self.tpm.declare_tags([(u'pool', u'tag1')])
+        self.tpm.set_metadata(u'pool', {'credits_per_message': 1})
+
+        self.command = go_refresh_tagpool_metadata.Command()
+        self.command.stdout = StringIO()
+        self.command.stderr = StringIO()
+
+    def test_refresh(self):
+        self.assertEqual(self.tpm.get_metadata(u'pool'),
+                         {'credits_per_message': 1})
+        # Changed by the vumi_tagpools script.
+        self.tpm.redis.hset('tagpools:pool:metadata', 'credits_per_message',
+                            '2')
+        self.command.handle()
+        self.assertEqual(self.tpm.get_metadata(u'pool'),
+                         {'credits_per_message': 2})
+        self.assertEqual(self.command.stdout.getvalue(),
+                         'Tagpool metadata refreshed\n')
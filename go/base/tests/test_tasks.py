@@ -0,0 +1,30 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.test import TestCase
+
+from go.base import tasks
+
+
+class DeleteExpiredExportsTestCase(TestCase):
+
+    def store_export(self, name, age_in_days):
+        path = default_storage.save(
+            'exports/account-1/%s' % (name,), ContentFile('data'))
+        self.addCleanup(default_storage.delete, path)
+        modified = time.time() - age_in_days * 24 * 60 * 60
+        os.utime(default_storage.path(path), (modified, modified))
+        return path
+
+    def test_delete_expired_exports(self):
+        retention = settings.EXPORT_RETENTION_DAYS
+        old_path = self.store_export(
+            'contacts-export-old.csv.gz', retention + 1)
+        new_path = self.store_export(
+            'messages-export-new.csv.gz', retention - 1)
+        self.assertEqual(tasks.delete_expired_exports(), 1)
+        self.assertFalse(default_storage.exists(old_path))
+        self.assertTrue(default_storage.exists(new_path))
@@ -1,16 +1,34 @@
 """Utilities for the Django parts of Vumi Go."""
 
+import os
 import csv
+import heapq
 import codecs
+import tempfile
+from itertools import islice
 from StringIO import StringIO
+from uuid import uuid4
 
 from django import forms
 from django.http import Http404
 from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.urlresolvers import reverse
 
 from go.vumitools.api import VumiUserApi
 
 
+# Contact and message exports that are too big to attach to an email are
+# stored under here, in a directory per account.
+EXPORTS_DIR = 'exports'
+
+# Exports that are bigger than this once compressed are stored for download
+# instead of being attached to the email.
+EXPORT_ATTACHMENT_MAX_SIZE = 2 * 1024 * 1024
+
+
 def conversation_or_404(user_api, key):
     conversation = user_api.conversation_store.get_conversation_by_key(key)
     if conversation is None:
@@ -24,6 +42,51 @@ def vumi_api_for_user(user):
                                         settings.VUMI_API_CONFIG)
 
 
+def chunked(iterable, size):
+    """
+    Yield lists of up to `size` items from `iterable` without reading more
+    of it than is needed for the current list.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def sorted_lines(lines, run_size=10000):
+    """
+    Sort an iterable of newline terminated lines without holding more than
+    `run_size` of them in memory. Sorted runs are written to temporary
+    files and merged.
+    """
+    runs = []
+    for chunk in chunked(lines, run_size):
+        chunk.sort()
+        run = tempfile.TemporaryFile()
+        run.writelines(chunk)
+        run.seek(0)
+        runs.append(run)
+    return heapq.merge(*runs)
+
+
+def store_export(account_key, export_type, export_file):
+    """
+    Store a gzipped CSV export in the account's exports directory and return
+    the URL it can be downloaded from. `export_type` is either `contacts` or
+    `messages`.
+    """
+    export_file.seek(0)
+    export_path = default_storage.save(
+        '%s/%s/%s-export-%s.csv.gz' % (
+            EXPORTS_DIR, account_key, export_type, uuid4().get_hex()),
+        File(export_file))
+    site = Site.objects.get_current()
+    return 'http://%s%s' % (site.domain, reverse('export', kwargs={
+        'export_name': os.path.basename(export_path)}))
+
+
 def padded_queryset(queryset, size=6, padding=None):
     nr_of_results = queryset.count()
     if nr_of_results >= size:
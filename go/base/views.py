@@ -2,16 +2,19 @@ import urllib
 import urlparse
 
 from django.conf import settings
+from django.http import HttpResponse
 from django.shortcuts import render, Http404, redirect
 from django.contrib.auth.views import logout
 from django.contrib import messages
 from django.core.urlresolvers import reverse
+from django.core.files.storage import default_storage
 from django.contrib.auth.decorators import login_required
 
 from vumi.persist.redis_manager import RedisManager
 from vumi.utils import load_class_by_string
 
 from go.vumitools.token_manager import TokenManager
+from go.base.utils import EXPORTS_DIR
 
 
 def todo(request):  # pragma: no cover
@@ -73,3 +76,22 @@ def token_task(request):
     callback(*callback_args, **callback_kwargs)
     messages.add_message(request, message_level, message)
     return redirect(return_to)
+
+
+@login_required
+def export(request, export_name):
+    """
+    Download a stored contact or message export. Exports are stored per
+    account, so only the account that made an export can download it.
+    """
+    export_path = '%s/%s/%s' % (EXPORTS_DIR,
+                                request.user_api.user_account_key,
+                                export_name)
+    if not default_storage.exists(export_path):
+        raise Http404
+    export_file = default_storage.open(export_path, 'rb')
+    response = HttpResponse(export_file.chunks(),
+                            content_type='application/x-gzip')
+    response['Content-Disposition'] = 'attachment; filename=%s' % (
+        export_name,)
+    return response
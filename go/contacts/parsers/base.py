@@ -214,11 +214,19 @@ class ContactFileParser(object):
         # order is important and needs to stay intact while being encoded
         # and decoded as JSON
         field_names = [field[0] for field in fields]
+        data_dictionaries = self.read_data_from_file(file_path, field_names,
+            has_header)
+        return self.parse_rows(data_dictionaries, fields)
+
+    def parse_rows(self, data_dictionaries, fields):
+        """
+        Normalize rows of data as returned by `read_data_from_file()` (or
+        saved from it, so that a large file can be imported in chunks) into
+        dictionaries ready to be fed to the ContactStore.new_contact method.
+        """
         field_map = dict(fields)
         # We're expecting a generator so loop over it and save as contacts
         # in the contact_store, normalizing anything we need to
-        data_dictionaries = self.read_data_from_file(file_path, field_names,
-            has_header)
         for data_dictionary in data_dictionaries:
 
             # Populate this with whatever we'll be sending to the
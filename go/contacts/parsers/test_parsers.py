@@ -63,6 +63,21 @@ class CSVParserTestCase(ParserTestCase):
                 'name': 'Name 3'},
             ])
 
+    def test_parse_rows(self):
+        contacts = list(self.parser.parse_rows([
+            {'name': u'Name 1', 'msisdn': u'0761234561', 'age': u'2.0'},
+            {'name': u'', 'msisdn': u'0761234562', 'age': u''},
+            ], [('name', 'string'), ('msisdn', 'msisdn_za'),
+                ('age', 'integer')]))
+        self.assertEqual(contacts, [
+            {
+                'msisdn': '+27761234561',
+                'name': 'Name 1',
+                'extra': {'age': '2'}},
+            {
+                'msisdn': '+27761234562'},
+            ])
+
     def test_contacts_with_none_entries(self):
         csv_file = self.fixture('sample-contacts-with-headers-and-none.csv')
         fp = default_storage.open(csv_file, 'rU')
@@ -1,180 +1,486 @@
 import sys
+import gzip
+import json
+import itertools
+import tempfile
 import traceback
-from StringIO import StringIO
+from datetime import timedelta
 
 from celery.task import task
 
 from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files import File
+from django.core.files.storage import default_storage
 from django.core.mail import send_mail, EmailMessage
 from django.template.loader import render_to_string
 from django.utils.safestring import mark_safe
 
-from go.vumitools.api import VumiUserApi
+from go.vumitools.api import VumiApi, VumiUserApi
 from go.base.models import UserProfile
-from go.base.utils import UnicodeCSVWriter
+from go.base.utils import (
+    UnicodeCSVWriter, EXPORT_ATTACHMENT_MAX_SIZE, chunked, sorted_lines,
+    store_export)
 from go.contacts.parsers import ContactFileParser
 
 
-@task(ignore_result=True)
+def _process_group_contacts(contact_store, group, find_contact_key_pages,
+                            process_contact):
+    """
+    Call `process_contact` for each of the group's contacts, a page at a
+    time. Contacts that have been processed drop out of the group, so if
+    this is interrupted and run again it picks up where it left off. We
+    keep going over the group until no contacts are left to process so that
+    any contacts added to the group while we're busy are dealt with too.
+
+    `process_contact` returns `False` for a contact that has already been
+    dealt with (and that a stale index still lists), so we don't need to
+    remember which contacts we've seen and only one page of them is held at
+    a time.
+    """
+    while True:
+        processed = 0
+        for contacts in contact_store.load_contact_pages(
+                find_contact_key_pages(group)):
+            count = len([contact for contact in contacts
+                         if process_contact(contact)])
+            if count:
+                contact_store.record_group_deletion_progress(group.key, count)
+                processed += count
+        if not processed:
+            break
+
+
+# These tasks are safe to run again if they're interrupted, so they're only
+# acknowledged once they're done. A task lost with its worker is then
+# redelivered and resumes the deletion.
+@task(ignore_result=True, acks_late=True)
 def delete_group(account_key, group_key):
-    # NOTE: There is a small chance that this can break when running in
-    #       production if the load is high and the queues have backed up.
-    #       What could happen is that while contacts are being removed from
-    #       the group, new contacts could have been added before the group
-    #       has been deleted. If this happens those contacts will have
-    #       secondary indexes in Riak pointing to a non-existent Group.
     api = VumiUserApi.from_config_sync(account_key, settings.VUMI_API_CONFIG)
     contact_store = api.contact_store
     group = contact_store.get_group(group_key)
-    # We do this one at a time because we're already saving them one at a time
-    # and the boilerplate for fetching batches without having them all sit in
-    # memory is ugly.
-    for contact_key in group.backlinks.contacts():
-        contact = contact_store.get_contact_by_key(contact_key)
+    if group is None:
+        # We were interrupted after deleting the group last time.
+        contact_store.finish_group_deletion(group_key)
+        return
+
+    # Marking the group as being deleted stops it from being offered for
+    # new contacts while we remove the existing ones.
+    contact_store.start_group_deletion(group)
+
+    def remove_from_group(contact):
+        if group.key not in contact.groups.keys():
+            return False
         contact.groups.remove(group)
         contact.save()
+        return True
+
+    _process_group_contacts(
+        contact_store, group,
+        contact_store.get_static_contact_key_pages_for_group,
+        remove_from_group)
     group.delete()
+    contact_store.unmaterialize_smart_group(group_key)
+    contact_store.finish_group_deletion(group_key)
 
 
-@task(ignore_result=True)
+@task(ignore_result=True, acks_late=True)
 def delete_group_contacts(account_key, group_key):
     api = VumiUserApi.from_config_sync(account_key, settings.VUMI_API_CONFIG)
     contact_store = api.contact_store
     group = contact_store.get_group(group_key)
-    contacts = contact_store.get_contacts_for_group(group)
-    # We do this one at a time because we're already saving them one at a time
-    # and the boilerplate for fetching batches without having them all sit in
-    # memory is ugly.
-    for contact_key in contacts:
-        contact_store.get_contact_by_key(contact_key).delete()
+    contact_store.start_group_deletion(group, contacts_only=True)
+
+    def delete_contact(contact):
+        # Contacts that have been deleted don't load, so there's nothing to
+        # check here.
+        contact_store.delete_contact(contact)
+        return True
+
+    def find_contact_key_pages(group):
+        # A contact in both the static and the dynamic part of a smart group
+        # is deleted with the first page it turns up in and doesn't load for
+        # the second, so we don't need to dedupe the keys.
+        pages = contact_store.get_static_contact_key_pages_for_group(group)
+        if group.is_smart_group():
+            pages = itertools.chain(
+                pages,
+                contact_store.get_dynamic_contact_key_pages_for_group(group))
+        return pages
+
+    _process_group_contacts(contact_store, group, find_contact_key_pages,
+                            delete_contact)
+    contact_store.note_contacts_changed()
+    contact_store.finish_group_deletion(group_key)
+
+
+# Materialized smart groups are refreshed when contacts have changed through
+# the contact store, and at least this often to pick up contacts that have
+# been changed some other way (by application workers, for example).
+SMART_GROUP_MAX_AGE = timedelta(hours=1)
+
+
+@task(ignore_result=True)
+def refresh_smart_group(account_key, group_key):
+    api = VumiUserApi.from_config_sync(account_key, settings.VUMI_API_CONFIG)
+    contact_store = api.contact_store
+    group = contact_store.get_group(group_key)
+    if group is None or not group.is_smart_group():
+        contact_store.unmaterialize_smart_group(group_key)
+        return
+    contact_store.refresh_smart_group(group)
+
+
+@task(ignore_result=True)
+def refresh_smart_groups():
+    """
+    Queue a refresh of every materialized smart group that needs one.
+    """
+    # One set of Riak and Redis clients is shared by all the accounts.
+    api = VumiApi.from_config_sync(settings.VUMI_API_CONFIG)
+    for user in User.objects.all():
+        account_key = user.get_profile().user_account
+        user_api = VumiUserApi(api, account_key)
+        for group_key in user_api.contact_store.list_smart_groups_to_refresh(
+                SMART_GROUP_MAX_AGE):
+            refresh_smart_group.delay(account_key, group_key)
+
+
+# The contact fields included in an export, in order.
+EXPORT_FIELDS = ['name', 'surname', 'email_address', 'msisdn', 'dob',
+                 'twitter_handle', 'facebook_id', 'bbm_pin', 'gtalk_id',
+                 'created_at']
+
+
+def _spool_contacts(contact_store, key_pages, include_extra, spool):
+    """
+    Write each contact to `spool` as a line of JSON prefixed with its
+    creation time, so the lines sort by creation time, and return the number
+    of contacts and the extra field names seen.
+    """
+    count = 0
+    extra_fields = set()
+    for contacts in contact_store.load_contact_pages(key_pages):
+        count += len(contacts)
+        for contact in contacts:
+            row = [unicode(getattr(contact, field, None) or '')
+                   for field in EXPORT_FIELDS]
+            extra = {}
+            if include_extra:
+                extra = dict(contact.extra)
+                extra_fields.update(extra.keys())
+            created_at = (contact.created_at.isoformat()
+                          if contact.created_at else '')
+            spool.write('%s\t%s\n' % (created_at, json.dumps([row, extra])))
+    return count, extra_fields
+
+
+def _write_export(spooled_lines, extra_fields, export_file):
+    writer = UnicodeCSVWriter(export_file)
+    writer.writerow(EXPORT_FIELDS + ['extras-%s' % (key,)
+                                     for key in extra_fields])
+    for line in spooled_lines:
+        _created_at, _tab, data = line.partition('\t')
+        row, extra = json.loads(data)
+        row.extend([unicode(extra.get(extra_field) or '')
+                    for extra_field in extra_fields])
+        writer.writerow(row)
 
 
 @task(ignore_result=True)
-def export_group_contacts(account_key, group_key, include_extra):
+def export_group_contacts(account_key, group_key, include_extra,
+                          ordered=True):
     """
     Export the a groups' contacts as a CSV file and email to the account
     holders' email address.
 
+    Contacts are streamed to a temporary file as they are loaded rather than
+    held in memory. Small exports are attached to the email, larger ones are
+    gzipped and stored and the email has a link to download them.
+
     :param str account_key:
         The account holder's account key
     :param str group_key:
         The group to export contacts for (can be either static or smart groups)
     :param bool include_extra:
         Whether or not to include the extra data stored in the dynamic field.
+    :param bool ordered:
+        Whether or not to sort the contacts by when they were created. The
+        sort is done on disk, but it can be skipped for very large groups.
     """
 
     api = VumiUserApi.from_config_sync(account_key, settings.VUMI_API_CONFIG)
     contact_store = api.contact_store
     group = contact_store.get_group(group_key)
-    contact_keys = contact_store.get_contacts_for_group(group)
+    key_pages = contact_store.get_contact_key_pages_for_group(group)
 
     # Get the profile for this user so we can email them when the import
     # has been completed.
     user_profile = UserProfile.objects.get(user_account=account_key)
 
-    io = StringIO()
-    writer = UnicodeCSVWriter(io)
+    # The extra field names (and so the CSV header) are only known once
+    # we've seen every contact, so the rows are spooled to disk first.
+    spool = tempfile.TemporaryFile()
+    count, extra_fields = _spool_contacts(
+        contact_store, key_pages, include_extra, spool)
+    extra_fields = sorted(extra_fields)
+    spool.seek(0)
+    spooled_lines = sorted_lines(spool) if ordered else spool
+
+    export_file = tempfile.TemporaryFile()
+    gzip_file = gzip.GzipFile(fileobj=export_file, mode='wb')
+    _write_export(spooled_lines, extra_fields, gzip_file)
+    gzip_file.close()
+    spool.close()
+
+    subject = '%s contacts export' % (group.name,)
+    if export_file.tell() > EXPORT_ATTACHMENT_MAX_SIZE:
+        export_url = store_export(account_key, 'contacts', export_file)
+        email = EmailMessage(subject,
+            'The CSV data for %s contact(s) from group "%s" can be '
+            'downloaded from:\n\n%s\n\nThe download will be available '
+            'for %s days.\n\n' % (
+                count, group.name, export_url,
+                settings.EXPORT_RETENTION_DAYS),
+            settings.DEFAULT_FROM_EMAIL, [user_profile.user.email])
+    else:
+        export_file.seek(0)
+        email = EmailMessage(subject,
+            'Please find the CSV data for %s contact(s) from '
+            'group "%s" attached.\n\n' % (count, group.name),
+            settings.DEFAULT_FROM_EMAIL, [user_profile.user.email])
+        email.attach('contacts-export.csv',
+                     gzip.GzipFile(fileobj=export_file).read(), 'text/csv')
+    export_file.close()
+    email.send()
 
-    contacts = []
-    for bunch in contact_store.contacts.load_all_bunches(contact_keys):
-        contacts.extend(bunch)
 
-    contacts = sorted(contacts, key=lambda c: c.created_at)
+# How many contacts are written between progress updates.
+IMPORT_BATCH_SIZE = 100
 
-    # collect all names that we can export
-    fields = ['name', 'surname', 'email_address', 'msisdn', 'dob',
-                    'twitter_handle', 'facebook_id', 'bbm_pin', 'gtalk_id',
-                    'created_at']
+# How many rows of a file each import sub-task handles. Each sub-task can
+# run on a different Celery worker.
+IMPORT_CHUNK_SIZE = 10000
 
-    # Collect the possible field names for this set of contacts, depending
-    # the number of contacts found this could be potentially expensive.
-    extra_fields = set()
-    if include_extra:
-        for contact in contacts:
-            extra_fields.update(contact.extra.keys())
 
-    # write the CSV header
-    extra_fields = sorted(extra_fields)
-    writer.writerow(fields + ['extras-%s' % (key,)
-                                    for key in extra_fields])
+def _import_chunk_path(import_id, chunk_id):
+    return 'contact_imports/%s/chunk-%s.json' % (import_id, chunk_id)
 
-    # loop over the contacts and create the row populated with
-    # the values of the selected fields.
-    for contact in contacts:
-        row = [unicode(getattr(contact, field, None) or '')
-                for field in fields]
 
-        if include_extra:
-            row.extend([unicode(contact.extra[extra_field] or '')
-                        for extra_field in extra_fields])
+def _store_import_chunk(import_id, chunk_id, rows):
+    chunk_file = tempfile.TemporaryFile()
+    for row in rows:
+        # Values that aren't strings are stored the way the parser would
+        # turn them into strings, since JSON can't hold all of them.
+        chunk_file.write('%s\n' % (json.dumps(dict(
+            (key, value if value is None or isinstance(value, basestring)
+             else unicode(str(value)))
+            for key, value in row.iteritems())),))
+    chunk_file.seek(0)
+    chunk_path = default_storage.save(
+        _import_chunk_path(import_id, chunk_id), File(chunk_file))
+    chunk_file.close()
+    return chunk_path
 
-        writer.writerow(row)
 
-    email = EmailMessage('%s contacts export' % (group.name,),
-            'Please find the CSV data for %s contact(s) from '
-            'group "%s" attached.\n\n' % (
-            len(contact_keys), group.name),
-        settings.DEFAULT_FROM_EMAIL, [user_profile.user.email])
-    email.attach('contacts-export.csv', io.getvalue(), 'text/csv')
-    email.send()
+def _store_import_chunks(parser, import_id, file_path, fields, has_header):
+    """
+    Split the rows of data in the file into files of up to
+    `IMPORT_CHUNK_SIZE` rows, one JSON object per line, and return their
+    paths. Each import sub-task then only reads its own chunk instead of
+    parsing the whole file again.
+    """
+    field_names = [field[0] for field in fields]
+    rows = parser.read_data_from_file(file_path, field_names, has_header)
+    chunk_paths = [
+        _store_import_chunk(import_id, chunk_id, chunk)
+        for chunk_id, chunk in enumerate(chunked(rows, IMPORT_CHUNK_SIZE))]
+    if not chunk_paths:
+        # An empty file still gets one (empty) chunk so that the import is
+        # completed in the usual way.
+        chunk_paths.append(_store_import_chunk(import_id, 0, []))
+    return chunk_paths
+
+
+def _read_import_chunk(chunk_path):
+    chunk_file = default_storage.open(chunk_path)
+    try:
+        for line in chunk_file:
+            yield json.loads(line)
+    finally:
+        chunk_file.close()
+
+
+def _import_contacts_batch(contact_store, contact_imports, import_id,
+                           chunk_id, group_key, contact_dictionaries):
+    contact_keys = []
+    try:
+        for contact_dictionary in contact_dictionaries:
+            # Make sure we set this group they're being uploaded in to
+            contact_dictionary['groups'] = [group_key]
+            contact = contact_store.new_contact(**contact_dictionary)
+            contact_keys.append(contact.key)
+    finally:
+        # Even a partly written batch needs recording so we can roll it back.
+        contact_imports.record_written(import_id, contact_keys, chunk_id)
+
+
+def _rollback_chunk(contact_store, contact_imports, import_id, chunk_id):
+    start = 0
+    while True:
+        contact_keys = contact_imports.get_written_keys(
+            import_id, start, IMPORT_BATCH_SIZE, chunk_id)
+        if not contact_keys:
+            break
+        for bunch in contact_store.contacts.load_all_bunches(contact_keys):
+            for contact in bunch:
+                if contact is not None:
+                    contact_store.delete_contact(contact)
+        start += len(contact_keys)
+    contact_imports.discard_written(import_id, chunk_id)
+
+
+def _format_exception(exc_info):
+    exc_type, exc_value, exc_traceback = exc_info
+    return u''.join(traceback.format_exception(
+        exc_type, exc_value, exc_traceback))
+
+
+def _send_import_failed_mail(user_profile, account_key, group_key,
+                             file_name, file_path, fields, has_header,
+                             exception_type, exception_value,
+                             exception_traceback):
+    send_mail('Something went wrong while importing the contacts.',
+        render_to_string('contacts/import_failed_mail.txt', {
+            'user': user_profile.user,
+            'group_key': group_key,
+            'account_key': account_key,
+            'file_name': file_name,
+            'file_path': file_path,
+            'fields': fields,
+            'has_header': has_header,
+            'exception_type': exception_type,
+            'exception_value': mark_safe(exception_value),
+            'exception_traceback': mark_safe(exception_traceback),
+        }), settings.DEFAULT_FROM_EMAIL, [
+            user_profile.user.email,
+            'support+contact-import@vumi.org',
+        ], fail_silently=False)
 
 
 @task(ignore_result=True)
 def import_contacts_file(account_key, group_key, file_name, file_path,
-                            fields, has_header):
-    api = VumiUserApi.from_config_sync(account_key, settings.VUMI_API_CONFIG)
-    contact_store = api.contact_store
-    group = contact_store.get_group(group_key)
+                            fields, has_header, import_id=None):
+    """
+    Split the file into chunks of rows and import each chunk in its own
+    sub-task. The last chunk to finish completes the import.
 
-    # Get the profile for this user so we can email them when the import
-    # has been completed.
-    user_profile = UserProfile.objects.get(user_account=account_key)
+    The file is only read once, to store each chunk of rows separately.
+    """
+    api = VumiUserApi.from_config_sync(account_key, settings.VUMI_API_CONFIG)
+    contact_imports = api.api.contact_imports
 
-    written_contacts = []
+    if import_id is None:
+        import_id = contact_imports.new_import(account_key, group_key,
+                                               file_name)
 
     try:
         extension, parser = ContactFileParser.get_parser(file_name)
+        chunk_paths = _store_import_chunks(parser, import_id, file_path,
+                                           fields, has_header)
+    except:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        contact_imports.finish_import(
+            import_id, contact_imports.IMPORT_FAILED)
+        user_profile = UserProfile.objects.get(user_account=account_key)
+        _send_import_failed_mail(
+            user_profile, account_key, group_key, file_name, file_path,
+            fields, has_header, exc_type, exc_value,
+            traceback.format_tb(exc_traceback))
+        return
+
+    contact_imports.start_import(import_id, len(chunk_paths))
+    for chunk_id, chunk_path in enumerate(chunk_paths):
+        import_contacts_chunk.delay(
+            account_key, group_key, file_name, file_path, fields,
+            has_header, import_id, chunk_id, chunk_path)
+
+
+@task(ignore_result=True, max_retries=3, default_retry_delay=60)
+def import_contacts_chunk(account_key, group_key, file_name, file_path,
+                          fields, has_header, import_id, chunk_id,
+                          chunk_path):
+    """
+    Import the rows of the file stored at `chunk_path`. A chunk that fails
+    is rolled back and retried, and if it still fails the whole import is
+    rolled back once every chunk has finished.
+    """
+    api = VumiUserApi.from_config_sync(account_key, settings.VUMI_API_CONFIG)
+    contact_store = api.contact_store
+    contact_imports = api.api.contact_imports
 
-        contact_dictionaries = parser.parse_file(file_path, fields,
-            has_header)
-        for counter, contact_dictionary in enumerate(contact_dictionaries):
+    error = None
+    try:
+        contact_dictionaries = ContactFileParser().parse_rows(
+            _read_import_chunk(chunk_path), fields)
+        for batch in chunked(contact_dictionaries, IMPORT_BATCH_SIZE):
+            _import_contacts_batch(contact_store, contact_imports,
+                                   import_id, chunk_id, group_key, batch)
+    except Exception, e:
+        exc_info = sys.exc_info()
+        # Either all of a chunk is written or none of it is.
+        _rollback_chunk(contact_store, contact_imports, import_id, chunk_id)
+        request = import_contacts_chunk.request
+        if request.retries < import_contacts_chunk.max_retries:
+            return import_contacts_chunk.retry(exc=e)
+        error = _format_exception(exc_info)
+
+    default_storage.delete(chunk_path)
+    if contact_imports.finish_chunk(import_id, chunk_id, error):
+        finish_contact_import.delay(account_key, group_key, file_name,
+                                    file_path, fields, has_header,
+                                    import_id)
 
-            # Make sure we set this group they're being uploaded in to
-            contact_dictionary['groups'] = [group.key]
 
-            contact = contact_store.new_contact(**contact_dictionary)
-            written_contacts.append(contact)
+@task(ignore_result=True)
+def finish_contact_import(account_key, group_key, file_name, file_path,
+                          fields, has_header, import_id):
+    """
+    Complete an import once all of its chunks are done and let the user
+    know how it went.
+    """
+    api = VumiUserApi.from_config_sync(account_key, settings.VUMI_API_CONFIG)
+    contact_store = api.contact_store
+    contact_imports = api.api.contact_imports
+    group = contact_store.get_group(group_key)
 
-        send_mail('Contact import completed successfully.',
-            render_to_string('contacts/import_completed_mail.txt', {
-                'count': counter,
-                'group': group,
-                'user': user_profile.user,
-            }), settings.DEFAULT_FROM_EMAIL, [user_profile.user.email],
-            fail_silently=False)
+    # Get the profile for this user so we can email them when the import
+    # has been completed.
+    user_profile = UserProfile.objects.get(user_account=account_key)
 
-    except:
+    progress = contact_imports.get_progress(import_id)
+    if progress['chunks_failed']:
         # Clean up if something went wrong, either everything is written
         # or nothing is written
-        for contact in written_contacts:
-            contact.delete()
-
-        exc_type, exc_value, exc_traceback = sys.exc_info()
-
-        send_mail('Something went wrong while importing the contacts.',
-            render_to_string('contacts/import_failed_mail.txt', {
-                'user': user_profile.user,
-                'group_key': group_key,
-                'account_key': account_key,
-                'file_name': file_name,
-                'file_path': file_path,
-                'fields': fields,
-                'has_header': has_header,
-                'exception_type': exc_type,
-                'exception_value': mark_safe(exc_value),
-                'exception_traceback': mark_safe(
-                    traceback.format_tb(exc_traceback)),
-            }), settings.DEFAULT_FROM_EMAIL, [
-                user_profile.user.email,
-                'support+contact-import@vumi.org',
-            ], fail_silently=False)
+        for chunk_id in range(progress['chunks']):
+            _rollback_chunk(contact_store, contact_imports, import_id,
+                            chunk_id)
+        contact_imports.finish_import(
+            import_id, contact_imports.IMPORT_FAILED)
+        _send_import_failed_mail(
+            user_profile, account_key, group_key, file_name, file_path,
+            fields, has_header,
+            'Failed %s of %s chunk(s)' % (progress['chunks_failed'],
+                                          progress['chunks']),
+            '', progress['error'])
+        return
+
+    progress = contact_imports.finish_import(
+        import_id, contact_imports.IMPORT_COMPLETED)
+    send_mail('Contact import completed successfully.',
+        render_to_string('contacts/import_completed_mail.txt', {
+            'count': progress['written'],
+            'group': group,
+            'user': user_profile.user,
+        }), settings.DEFAULT_FROM_EMAIL, [user_profile.user.email],
+        fail_silently=False)
@@ -1,17 +1,25 @@
 # -*- coding: utf-8 -*-
+import re
+import gzip
+import json
 from os import path
 from StringIO import StringIO
 
 from django.conf import settings
+from django.contrib.auth.models import User
 from django.test import TestCase
 from django.test.client import Client
 from django.core.urlresolvers import reverse
 
 from go.apps.tests.base import DjangoGoApplicationTestCase
 from django.core import mail
+from django.core.files.storage import default_storage
 
+from go.contacts import tasks
 from go.contacts.parsers.base import FieldNormalizer
 
+from mock import patch
+
 TEST_GROUP_NAME = u"Test Group"
 TEST_CONTACT_NAME = u"Name"
 TEST_CONTACT_SURNAME = u"Surname"
@@ -267,6 +275,55 @@ class ContactsTestCase(DjangoGoApplicationTestCase):
         self.assertEqual(len(mail.outbox), 1)
         self.assertTrue('successfully' in mail.outbox[0].subject)
 
+    def test_contact_upload_progress(self):
+        progress_url = reverse('contacts:group_import_progress', kwargs={
+            'group_key': self.group_key,
+        })
+        response = self.client.get(progress_url)
+        self.assertEqual(response.status_code, 404)
+
+        self.clear_groups()
+        csv_file = open(
+            path.join(settings.PROJECT_ROOT, 'base',
+                'fixtures', 'sample-contacts.csv'), 'r')
+        self.client.post(group_url(self.group_key), {
+            'file': csv_file,
+        })
+        self.specify_columns()
+
+        response = self.client.get(progress_url)
+        self.assertEqual(json.loads(response.content), {
+            'status': 'completed',
+            'written': 3,
+            })
+        self.assertTrue('imported 3 of your contact(s)' in mail.outbox[0].body)
+
+    @patch.object(tasks, 'IMPORT_CHUNK_SIZE', 2)
+    def test_contact_upload_in_chunks(self):
+        self.clear_groups()
+        csv_file = open(
+            path.join(settings.PROJECT_ROOT, 'base',
+                'fixtures', 'sample-contacts.csv'), 'r')
+        self.client.post(group_url(self.group_key), {
+            'file': csv_file,
+        })
+        self.specify_columns()
+
+        self.assertEqual(len(list(self.group.backlinks.contacts())), 3)
+        contact_imports = self.user_api.api.contact_imports
+        import_id = contact_imports.get_latest_import(self.group_key)
+        progress = contact_imports.get_progress(import_id)
+        self.assertEqual(progress['status'], 'completed')
+        self.assertEqual(progress['chunks'], 2)
+        self.assertEqual(progress['chunks_done'], 2)
+        self.assertEqual(progress['written'], 3)
+        # Each chunk's rows are removed once the chunk is imported.
+        self.assertEqual(
+            default_storage.listdir('contact_imports/%s' % (import_id,)),
+            ([], []))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertTrue('imported 3 of your contact(s)' in mail.outbox[0].body)
+
     def test_graceful_error_handling_on_upload_failure(self):
         group_url = reverse('contacts:group', kwargs={
             'group_key': self.group_key
@@ -319,6 +376,13 @@ class ContactsTestCase(DjangoGoApplicationTestCase):
         self.assertEqual(len(mail.outbox), 1)
         self.assertTrue('went wrong' in mail.outbox[0].subject)
 
+        contact_imports = self.user_api.api.contact_imports
+        import_id = contact_imports.get_latest_import(group.key)
+        progress = contact_imports.get_progress(import_id)
+        self.assertEqual(progress['status'], 'failed')
+        self.assertEqual(
+            contact_imports.get_written_keys(import_id, 0, 100), [])
+
     def test_normalization(self):
         csv_file = open(path.join(settings.PROJECT_ROOT, 'base',
             'fixtures', 'sample-non-normalized-contacts.csv'))
@@ -512,6 +576,25 @@ class GroupsTestCase(DjangoGoApplicationTestCase):
                                    {'l': first_letter.lower()})
         self.assertContains(response, person_url(self.contact_key))
 
+    @patch('go.contacts.views.CONTACTS_PER_PAGE', 1)
+    def test_group_contact_filter_by_letter_pages(self):
+        other = self.contact_store.new_contact(
+            name=u'Other', surname=TEST_CONTACT_SURNAME,
+            msisdn=u'27761234567', groups=[self.group_key])
+        first_key, second_key = sorted([self.contact_key, other.key])
+        letter = TEST_CONTACT_SURNAME[0].lower()
+
+        response = self.client.get(group_url(self.group_key), {'l': letter})
+        self.assertContains(response, person_url(first_key))
+        self.assertNotContains(response, person_url(second_key))
+        self.assertContains(response, '?p=2&amp;l=%s' % (letter,))
+
+        response = self.client.get(group_url(self.group_key),
+                                   {'l': letter, 'p': 2})
+        self.assertNotContains(response, person_url(first_key))
+        self.assertContains(response, person_url(second_key))
+        self.assertNotContains(response, '?p=3')
+
     def test_group_deletion(self):
         # Create a contact in the group
         response = self.client.post(reverse('contacts:new_person'), {
@@ -539,6 +622,28 @@ class GroupsTestCase(DjangoGoApplicationTestCase):
         self.assertEqual(reloaded_contact.key, contact.key)
         self.assertEqual(reloaded_contact.groups.keys(), [])
 
+    def test_interrupted_group_deletion(self):
+        contact = self.contact_store.new_contact(
+            name=u'New', surname=u'Person', msisdn=u'27761234567',
+            groups=[self.group_key])
+        # Pretend a deletion was started but didn't finish.
+        self.contact_store.start_group_deletion(self.group)
+        self.contact_store.record_group_deletion_progress(self.group_key, 1)
+
+        response = self.client.get(reverse('contacts:groups'))
+        self.assertContains(response, 'Being deleted')
+        self.assertContains(response, '1 contact(s) removed')
+        self.assertNotContains(response, group_url(self.group_key))
+
+        tasks.delete_group(self.user_api.user_account_key, self.group_key)
+        self.assertEqual(self.contact_store.get_group(self.group_key), None)
+        reloaded_contact = self.contact_store.get_contact_by_key(contact.key)
+        self.assertEqual(reloaded_contact.groups.keys(), [])
+        self.assertEqual(self.contact_store.list_group_deletions(), [])
+
+        response = self.client.get(reverse('contacts:groups'))
+        self.assertNotContains(response, 'Being deleted')
+
     def test_group_clearing(self):
         # Create a contact in the group
         response = self.client.post(reverse('contacts:new_person'), {
@@ -564,6 +669,26 @@ class GroupsTestCase(DjangoGoApplicationTestCase):
             self.contact_store.get_contacts_for_group(self.group), [])
         self.assertFalse(contact in self.contact_store.list_contacts())
 
+    def test_interrupted_group_clearing(self):
+        contact = self.contact_store.new_contact(
+            name=u'New', surname=u'Person', msisdn=u'27761234567',
+            groups=[self.group_key])
+        # Pretend clearing the group was started but didn't finish.
+        self.contact_store.start_group_deletion(self.group, contacts_only=True)
+        self.contact_store.record_group_deletion_progress(self.group_key, 1)
+
+        response = self.client.get(reverse('contacts:groups'))
+        self.assertContains(response, 'Being deleted')
+        self.assertContains(response, '(contacts only)')
+        self.assertContains(response, '1 contact(s) removed')
+        self.assertContains(response, group_url(self.group_key))
+
+        tasks.delete_group_contacts(
+            self.user_api.user_account_key, self.group_key)
+        self.assertEqual(
+            self.contact_store.get_contact_by_key(contact.key), None)
+        self.assertEqual(self.contact_store.list_group_deletions(), [])
+
     def test_group_contact_export(self):
         # Clear the group
         group_url = reverse('contacts:group', kwargs={
@@ -602,6 +727,42 @@ class GroupsTestCase(DjangoGoApplicationTestCase):
         self.assertTrue(contents)
         self.assertEqual(mime_type, 'text/csv')
 
+    @patch.object(tasks, 'EXPORT_ATTACHMENT_MAX_SIZE', 0)
+    def test_group_contact_export_download(self):
+        group_url = reverse('contacts:group', kwargs={
+            'group_key': self.group.key,
+        })
+        self.contact.extra['foo'] = u'bar'
+        self.contact.save()
+
+        response = self.client.post(group_url, {
+                '_export_group_contacts': True,
+            })
+
+        self.assertRedirects(response, group_url)
+        [email] = mail.outbox
+        self.assertEqual(email.attachments, [])
+        self.assertTrue('1 contact(s) from group "%s" can be downloaded' % (
+            self.group.name,) in email.body)
+        self.assertTrue('available for %s days' % (
+            settings.EXPORT_RETENTION_DAYS,) in email.body)
+        [export_url] = re.findall(r'http://[^/]+(/\S+)', email.body)
+
+        response = self.client.get(export_url)
+        self.assertEqual(response['Content-Type'], 'application/x-gzip')
+        contents = gzip.GzipFile(
+            fileobj=StringIO(''.join(response))).read()
+        [header, contact, _] = contents.split('\r\n')
+        self.assertTrue(header.endswith('created_at,extras-foo'))
+        self.assertTrue(contact.endswith(',bar'))
+
+        # Other accounts can't download the export.
+        User.objects.create_user('other', 'other@example.com', 'password')
+        other_client = Client()
+        other_client.login(username='other', password='password')
+        response = other_client.get(export_url)
+        self.assertEqual(response.status_code, 404)
+
 
 class SmartGroupsTestCase(DjangoGoApplicationTestCase):
 
@@ -633,6 +794,23 @@ class SmartGroupsTestCase(DjangoGoApplicationTestCase):
         self.assertEqual(u'a smart group', group.name)
         self.assertEqual(u'msisdn:\+12*', group.query)
 
+    def test_smart_group_member_count(self):
+        contact1 = self.mkcontact(msisdn=u'+1234')
+        contact2 = self.mkcontact(msisdn=u'+1235')
+        group = self.mksmart_group('msisdn:\+12*')
+        group_url = reverse('contacts:group', kwargs={'group_key': group.key})
+        response = self.client.get(group_url, {'limit': 1})
+        self.assertContains(response, 'Smart Group (2 members)')
+        self.assertEqual(len(response.context['selected_contacts']), 1)
+
+        self.contact_store.materialize_smart_group(group)
+        self.contact_store.refresh_smart_group(group)
+        response = self.client.get(group_url, {'limit': 1})
+        self.assertContains(response, 'Smart Group (2 members)')
+        selected_keys = [c.key for c in response.context['selected_contacts']]
+        self.assertEqual(selected_keys,
+                         sorted([contact1.key, contact2.key])[:1])
+
     def test_smart_group_deletion(self):
         group = self.mksmart_group('msisdn:\+12*')
         response = self.client.post(
@@ -666,6 +844,46 @@ class SmartGroupsTestCase(DjangoGoApplicationTestCase):
         self.assertEqual(saved_group.name, 'foo')
         self.assertEqual(saved_group.query, 'name:bar')
 
+    def test_smart_group_materialization(self):
+        contact = self.mkcontact()
+        group = self.mksmart_group('msisdn:\+12*')
+        group_url = reverse('contacts:group', kwargs={'group_key': group.key})
+        response = self.client.post(group_url, {'_materialize_group': 1})
+        self.assertRedirects(response, group_url)
+
+        info = self.contact_store.get_smart_group_info(group.key)
+        self.assertEqual(info['count'], 1)
+        self.assertFalse(info['stale'])
+        self.assertEqual(
+            self.contact_store.get_dynamic_contacts_for_group(group),
+            [contact.key])
+        response = self.client.get(group_url)
+        self.assertContains(response, 'Members last updated')
+
+        # Changing the query refreshes the membership.
+        response = self.client.post(group_url, {
+            'name': 'foo', 'query': 'name:bar', '_save_group': 1})
+        self.assertRedirects(response, group_url)
+        group = self.contact_store.get_group(group.key)
+        self.assertEqual(
+            self.contact_store.get_dynamic_contacts_for_group(group), [])
+        self.assertEqual(
+            self.contact_store.get_smart_group_info(group.key)['count'], 0)
+
+    def test_refresh_stale_smart_groups(self):
+        self.mkcontact()
+        group = self.mksmart_group('msisdn:\+12*')
+        self.contact_store.materialize_smart_group(group)
+        self.contact_store.refresh_smart_group(group)
+        self.mkcontact(msisdn=u'+1235')
+        self.assertTrue(
+            self.contact_store.get_smart_group_info(group.key)['stale'])
+
+        tasks.refresh_smart_groups()
+        info = self.contact_store.get_smart_group_info(group.key)
+        self.assertEqual(info['count'], 2)
+        self.assertFalse(info['stale'])
+
     def test_smart_groups_no_matches_results(self):
         response = self.client.post(reverse('contacts:groups'), {
             'name': 'a smart group',
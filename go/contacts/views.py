@@ -1,8 +1,10 @@
 import re
+import json
+import itertools
 
 from urllib import urlencode
 
-from django.http import Http404
+from django.http import Http404, HttpResponse
 from django.shortcuts import render, redirect
 from django.core.urlresolvers import reverse
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
@@ -29,6 +31,35 @@ def _group_url(group_key):
     return reverse('contacts:group', kwargs={'group_key': group_key})
 
 
+# How many contacts are shown at a time when browsing by surname.
+CONTACTS_PER_PAGE = 50
+
+
+def _surname_page(request, contact_store, letter, group=None):
+    """
+    Return a page of the contacts whose surnames start with `letter`, and a
+    dictionary describing the page for the template. We ask for one more
+    contact than we show to find out whether there's a next page, so the
+    matching contacts never need to be counted.
+    """
+    try:
+        number = max(int(request.GET.get('p', 1)), 1)
+    except ValueError:
+        number = 1
+    contacts = contact_store.filter_contacts_on_surname(
+        letter, group=group, start=(number - 1) * CONTACTS_PER_PAGE,
+        limit=CONTACTS_PER_PAGE + 1)
+    surname_page = {
+        'number': number,
+        'previous_page_number': number - 1,
+        'next_page_number': number + 1,
+        'has_previous': number > 1,
+        'has_next': len(contacts) > CONTACTS_PER_PAGE,
+        'params': urlencode({'l': letter}),
+        }
+    return contacts[:CONTACTS_PER_PAGE], surname_page
+
+
 @login_required
 def index(request):
     return redirect(reverse('contacts:groups'))
@@ -87,6 +118,7 @@ def groups(request):
         'page': page,
         'query': query,
         'contact_group_form': contact_group_form,
+        'group_deletions': contact_store.list_group_deletions(),
     })
 
 
@@ -110,6 +142,24 @@ def _group(request, group_key):
         return _static_group(request, contact_store, group)
 
 
+@login_required
+def group_import_progress(request, group_key):
+    """
+    Report the progress of the latest contact import into a group as JSON
+    so that the group page can poll it.
+    """
+    contact_imports = request.user_api.api.contact_imports
+    import_id = contact_imports.get_latest_import(group_key)
+    progress = import_id and contact_imports.get_progress(import_id)
+    if (not progress or
+            progress['account_key'] != request.user_api.user_account_key):
+        raise Http404
+    return HttpResponse(json.dumps({
+        'status': progress['status'],
+        'written': progress['written'],
+        }), content_type='application/json')
+
+
 @login_required
 @csrf_protect
 def _static_group(request, contact_store, group):
@@ -158,9 +208,12 @@ def _static_group(request, contact_store, group):
                                 for i in range(len(sample_row))]
                 fields = zip(field_names, normalizers)
 
+                account_key = request.user_api.user_account_key
+                import_id = request.user_api.api.contact_imports.new_import(
+                    account_key, group.key, file_name)
                 tasks.import_contacts_file.delay(
-                    request.user_api.user_account_key, group.key, file_name,
-                    file_path, fields, has_header)
+                    account_key, group.key, file_name, file_path, fields,
+                    has_header, import_id=import_id)
 
                 messages.info(request, 'The contacts are being imported. '
                     'We will notify you via email when the import has '
@@ -229,8 +282,9 @@ def _static_group(request, contact_store, group):
         for contact_bunch in contact_store.contacts.load_all_bunches(keys):
             selected_contacts.extend(contact_bunch)
     else:
-        selected_contacts = contact_store.filter_contacts_on_surname(
-            selected_letter, group=group)
+        selected_contacts, surname_page = _surname_page(
+            request, contact_store, selected_letter, group=group)
+        context['surname_page'] = surname_page
 
     context.update({
         'query': request.GET.get('q'),
@@ -248,10 +302,26 @@ def _smart_group(request, contact_store, group):
     if '_save_group' in request.POST:
         smart_group_form = SmartGroupForm(request.POST)
         if smart_group_form.is_valid():
+            query_changed = (
+                group.query != smart_group_form.cleaned_data['query'])
             group.name = smart_group_form.cleaned_data['name']
             group.query = smart_group_form.cleaned_data['query']
             group.save()
+            if (query_changed and
+                    contact_store.get_smart_group_info(group.key)):
+                # Stop using the old membership until it's been refreshed.
+                contact_store.unmaterialize_smart_group(group.key)
+                contact_store.materialize_smart_group(group)
+                tasks.refresh_smart_group.delay(
+                    request.user_api.user_account_key, group.key)
             return redirect(_group_url(group.key))
+    elif '_materialize_group' in request.POST:
+        contact_store.materialize_smart_group(group)
+        tasks.refresh_smart_group.delay(
+            request.user_api.user_account_key, group.key)
+        messages.info(request, "The group's members will be kept up to "
+                               "date in the background.")
+        return redirect(_group_url(group.key))
     elif '_export_group_contacts' in request.POST:
         tasks.export_group_contacts.delay(
             request.user_api.user_account_key, group.key, True)
@@ -274,22 +344,36 @@ def _smart_group(request, contact_store, group):
             'query': group.query,
             })
 
-    keys = contact_store.contacts.raw_search(group.query).get_keys()
-    member_count = len(keys)
     limit = int(request.GET.get('limit', 100))
     if limit:
         messages.info(request,
                 'Showing up to %s random contacts matching your query' % (
                     limit,))
-        keys = keys[:limit]
+    info = contact_store.get_smart_group_info(group.key)
+    key_pages = contact_store.get_dynamic_contact_key_pages_for_group(
+        group, page_size=limit or None)
+    if info is not None and info['refreshed_at'] is not None:
+        # Materialized groups know how many members they have, so we only
+        # need the page we show.
+        member_count = info['count']
+        if limit:
+            key_pages = itertools.islice(key_pages, 1)
+    else:
+        # The pages all come from a single search, so we count them rather
+        # than running the search again, but only load the page we show.
+        key_pages = list(key_pages)
+        member_count = sum(len(keys) for keys in key_pages)
+        if limit:
+            key_pages = key_pages[:1]
     selected_contacts = []
-    for contacts in contact_store.contacts.load_all_bunches(keys):
+    for contacts in contact_store.load_contact_pages(key_pages):
         selected_contacts.extend(contacts)
     return render(request, 'contacts/smart_group.html', {
         'group': group,
         'selected_contacts': selected_contacts,
         'group_form': smart_group_form,
         'member_count': member_count,
+        'materialized': info,
     })
 
 
@@ -349,6 +433,7 @@ def _people(request):
     #       in the groups() view. We need a function that does that to avoid
     #       the duplication.
     selected_letter = request.GET.get('l')
+    surname_page = None
     query = request.GET.get('q', '')
     if query:
         if not ':' in query:
@@ -364,8 +449,8 @@ def _people(request):
         for contact_bunch in contact_store.contacts.load_all_bunches(keys):
             selected_contacts.extend(contact_bunch)
     elif selected_letter:
-        selected_contacts = contact_store.filter_contacts_on_surname(
-            selected_letter)
+        selected_contacts, surname_page = _surname_page(
+            request, contact_store, selected_letter)
     else:
         selected_contacts = []
 
@@ -374,6 +459,7 @@ def _people(request):
         'query': request.GET.get('q'),
         'selected_letter': selected_letter,
         'selected_contacts': selected_contacts,
+        'surname_page': surname_page,
         'upload_contacts_form': upload_contacts_form,
         'select_contact_group_form': select_contact_group_form,
         'smart_group_form': smart_group_form,
@@ -389,7 +475,8 @@ def person(request, person_key):
     groups = contact_store.list_groups()
     if request.method == 'POST':
         if '_delete_contact' in request.POST:
-            contact.delete()
+            contact_store.delete_contact(contact)
+            contact_store.note_contacts_changed()
             messages.info(request, 'Contact deleted')
             return redirect(reverse('contacts:index'))
         else:
@@ -402,7 +489,8 @@ def person(request, person_key):
                             contact.add_to_group(group)
                         continue
                     setattr(contact, k, v)
-                contact.save()
+                contact_store.save_contact(contact)
+                contact_store.note_contacts_changed()
                 messages.add_message(request, messages.INFO, 'Profile Updated')
                 return redirect(reverse('contacts:person', kwargs={
                     'person_key': contact.key}))
@@ -199,6 +199,10 @@ class StartConversationView(ConversationView):
 
         if self.conversation_initiator != 'client':
             params['dedupe'] = request.POST.get('dedupe') == '1'
+            if settings.CONVERSATION_RECIPIENT_SNAPSHOTS:
+                params['snapshot_recipients'] = True
+        if settings.CONVERSATION_MESSAGE_SEARCH_INDEX:
+            params['index_messages'] = True
         try:
             conversation.start(**params)
         except ConversationSendError as error:
@@ -215,6 +219,10 @@ class StartConversationView(ConversationView):
 
         if self.conversation_initiator != 'client':
             params['dedupe'] = request.POST.get('dedupe') == '1'
+            if settings.CONVERSATION_RECIPIENT_SNAPSHOTS:
+                params['snapshot_recipients'] = True
+        if settings.CONVERSATION_MESSAGE_SEARCH_INDEX:
+            params['index_messages'] = True
 
         # The URL the user will be redirected to post-confirmation
         redirect_to = self.get_view_url('confirm',
@@ -1,13 +1,59 @@
-from StringIO import StringIO
+import gzip
+import json
+import tempfile
 
 from celery.task import task
 
 from django.conf import settings
 from django.core.mail import EmailMessage
 
+from vumi.message import VUMI_DATE_FORMAT
+
 from go.vumitools.api import VumiUserApi
 from go.base.models import UserProfile
-from go.base.utils import UnicodeCSVWriter
+from go.base.utils import (
+    UnicodeCSVWriter, EXPORT_ATTACHMENT_MAX_SIZE, sorted_lines, store_export)
+
+
+# The field names to export
+EXPORT_FIELDS = [
+    'from_addr',
+    'to_addr',
+    'timestamp',
+    'content',
+    'message_id',
+    'in_reply_to',
+]
+
+
+def _spool_messages(conversation, direction, addr_field, spool):
+    """
+    Write each of the conversation's messages in `direction` to `spool` as a
+    line of JSON prefixed with the end user's address (`addr_field`) and the
+    message timestamp, so the lines sort by address and then timestamp.
+    Messages are loaded a page at a time. Returns the number of messages.
+    """
+    count = 0
+    key_pages = conversation.get_message_key_pages(direction)
+    for messages in conversation.load_message_pages(direction, key_pages):
+        for message in messages:
+            row = [unicode(message.payload.get(fn) or '')
+                   for fn in EXPORT_FIELDS]
+            sort_key = u'%s\t%s' % (
+                message[addr_field] or u'',
+                message['timestamp'].strftime(VUMI_DATE_FORMAT))
+            spool.write('%s\t%s\n' % (
+                sort_key.encode('utf-8'), json.dumps(row)))
+        count += len(messages)
+    return count
+
+
+def _write_export(spooled_lines, export_file):
+    writer = UnicodeCSVWriter(export_file)
+    writer.writerow(EXPORT_FIELDS)
+    for line in spooled_lines:
+        _addr, _timestamp, data = line.split('\t', 2)
+        writer.writerow(json.loads(data))
 
 
 @task(ignore_result=True)
@@ -15,64 +61,52 @@ def export_conversation_messages(account_key, conversation_key):
     """
     Export the messages in a conversation via email.
 
+    Messages are loaded a page at a time and spooled to a temporary file,
+    which is sorted on disk so that the messages of each end user are
+    grouped together in the order they were sent or received. Small exports
+    are attached to the email, larger ones are gzipped and stored and the
+    email has a link to download them.
+
     :param str account_key:
         The account holder's account account_key
     :param str conversation_key:
         The key of the conversation we want to export the messages for.
     """
-
-    # The field names to export
-    field_names = [
-        'from_addr',
-        'to_addr',
-        'timestamp',
-        'content',
-        'message_id',
-        'in_reply_to',
-    ]
-
     api = VumiUserApi.from_config_sync(account_key, settings.VUMI_API_CONFIG)
     user_profile = UserProfile.objects.get(user_account=account_key)
     conversation = api.get_wrapped_conversation(conversation_key)
-    io = StringIO()
-
-    writer = UnicodeCSVWriter(io)
-    writer.writerow(field_names)
-
-    # limiting to 0 results in getting the full set, creating lists of tuples
-    # with direction sort we can sort sent & received messages in a somewhat
-    # threaded fashion further down.
-    sent_messages = [('sent', msg)
-                        for msg in conversation.sent_messages(limit=0)]
-    received_messages = [('received', msg)
-                            for msg in conversation.received_messages(limit=0)]
-
-    def sort_by_addr_and_timestap(entry):
-        """
-        Apply sorting based on direction of the message.
-        The to_addr & from_addr switch depending on whether the message
-        was sent or received. We always need to sort on the addr of the end
-        user which means switching based on direction.
-        """
-        direction, message = entry
-        if direction == 'sent':
-            return (message['to_addr'], message['timestamp'])
-        return (message['from_addr'], message['timestamp'])
-
-    all_messages = [msg for directon, msg in
-                        sorted(sent_messages + received_messages,
-                            key=sort_by_addr_and_timestap)]
-
-    for message in all_messages:
-        writer.writerow([unicode(message.payload.get(fn) or '')
-                            for fn in field_names])
-
-    email = EmailMessage(
-        'Conversation message export: %s' % (conversation.subject,),
-        'Please find the messages of the conversation %s attached.\n' % (
-            conversation.subject),
-        settings.DEFAULT_FROM_EMAIL, [user_profile.user.email])
-    email.attach('messages-export.csv', io.getvalue(), 'text/csv')
+
+    # The to_addr & from_addr switch depending on whether the message was
+    # sent or received. We always need to sort on the addr of the end user.
+    spool = tempfile.TemporaryFile()
+    count = _spool_messages(conversation, 'outbound', 'to_addr', spool)
+    count += _spool_messages(conversation, 'inbound', 'from_addr', spool)
+    spool.seek(0)
+
+    export_file = tempfile.TemporaryFile()
+    gzip_file = gzip.GzipFile(fileobj=export_file, mode='wb')
+    _write_export(sorted_lines(spool), gzip_file)
+    gzip_file.close()
+    spool.close()
+
+    subject = 'Conversation message export: %s' % (conversation.subject,)
+    if export_file.tell() > EXPORT_ATTACHMENT_MAX_SIZE:
+        export_url = store_export(account_key, 'messages', export_file)
+        email = EmailMessage(subject,
+            'The %s message(s) of the conversation %s can be downloaded '
+            'from:\n\n%s\n\nThe download will be available for %s '
+            'days.\n\n' % (count, conversation.subject, export_url,
+                             settings.EXPORT_RETENTION_DAYS),
+            settings.DEFAULT_FROM_EMAIL, [user_profile.user.email])
+    else:
+        export_file.seek(0)
+        email = EmailMessage(subject,
+            'Please find the messages of the conversation %s attached.\n' % (
+                conversation.subject),
+            settings.DEFAULT_FROM_EMAIL, [user_profile.user.email])
+        email.attach('messages-export.csv',
+                     gzip.GzipFile(fileobj=export_file).read(), 'text/csv')
+    export_file.close()
     email.send()
 
 
@@ -69,11 +69,26 @@ def show_conversation_messages(context, conversation, direction=None,
         'message_direction': direction,
     })
 
+    # Batches with a search index can answer most queries straight away.
+    search_keys = None
+    if query and not token:
+        search_keys = conversation.search_message_keys(
+            direction, query, batch_id)
+
     # If we're doing a query we can shortcut the results as we don't
     # need all the message paginator stuff since we're loading the results
     # asynchronously with JavaScript.
     client = ms_client.Client(settings.MESSAGE_STORE_API_URL)
-    if query and not token:
+    if search_keys is not None:
+        message_paginator = Paginator(
+            PagedMessageCache(len(search_keys),
+                lambda start, stop: conversation.load_messages(
+                    direction, search_keys[start:stop])), 20)
+        tag_context.update({
+            'query': query,
+            'token': '',
+            })
+    elif query and not token:
         token = client.match(batch_id, direction, [{
             'key': 'msg.content',
             'pattern': re.escape(query),
@@ -1,10 +1,19 @@
+import re
+import csv
+import gzip
 from os import path
+from StringIO import StringIO
 
 from django.test.client import Client
+from django.core import mail
 from django.core.urlresolvers import reverse
 from django.conf import settings
+from django.contrib.auth.models import User
+
+from mock import patch
 
 from go.apps.tests.base import DjangoGoApplicationTestCase
+from go.conversation import tasks
 from go.conversation.templatetags.conversation_tags import scrub_tokens
 
 
@@ -108,6 +117,53 @@ class ConversationTestCase(DjangoGoApplicationTestCase):
         [reply_msg] = conversation.received_messages()
         self.assertTrue(reply_msg, msg)
 
+    def get_exported_addrs(self, content):
+        rows = list(csv.reader(StringIO(content)))
+        self.assertEqual(rows[0], tasks.EXPORT_FIELDS)
+        # The end user is the sender of inbound messages and the recipient
+        # of outbound ones.
+        return [from_addr if from_addr.startswith('from-') else to_addr
+                for from_addr, to_addr in (row[:2] for row in rows[1:])]
+
+    def test_export_conversation_messages(self):
+        self.put_sample_messages_in_conversation(self.user_api,
+                                                 self.conv_key, 3)
+        tasks.export_conversation_messages(
+            self.user_api.user_account_key, self.conv_key)
+        [email] = mail.outbox
+        self.assertEqual(email.recipients(), [self.user.email])
+        [(file_name, content, mime_type)] = email.attachments
+        self.assertEqual(file_name, 'messages-export.csv')
+        self.assertEqual(mime_type, 'text/csv')
+        self.assertEqual(self.get_exported_addrs(content), [
+            'from-0', 'from-0', 'from-1', 'from-1', 'from-2', 'from-2'])
+
+    @patch.object(tasks, 'EXPORT_ATTACHMENT_MAX_SIZE', 0)
+    def test_export_conversation_messages_download(self):
+        self.put_sample_messages_in_conversation(self.user_api,
+                                                 self.conv_key, 2)
+        tasks.export_conversation_messages(
+            self.user_api.user_account_key, self.conv_key)
+        [email] = mail.outbox
+        self.assertEqual(email.attachments, [])
+        self.assertTrue('4 message(s)' in email.body)
+        self.assertTrue('available for %s days' % (
+            settings.EXPORT_RETENTION_DAYS,) in email.body)
+        [export_url] = re.findall(r'http://[^/]+(/\S+)', email.body)
+
+        response = self.client.get(export_url)
+        self.assertEqual(response['Content-Type'], 'application/x-gzip')
+        content = gzip.GzipFile(fileobj=StringIO(''.join(response))).read()
+        self.assertEqual(self.get_exported_addrs(content),
+                         ['from-0', 'from-0', 'from-1', 'from-1'])
+
+        # Other accounts can't download the export.
+        User.objects.create_user('other', 'other@example.com', 'password')
+        other_client = Client()
+        other_client.login(username='other', password='password')
+        response = other_client.get(export_url)
+        self.assertEqual(response.status_code, 404)
+
     def test_end_conversation(self):
         """
         Test the end_conversation helper function
@@ -289,6 +289,20 @@ GOOGLE_ANALYTICS_UA = None
 
 MESSAGE_STORE_API_URL = 'http://localhost:8080/api/v1/'
 
+# Set this to have the application worker resolve a conversation's
+# recipients once when it is started and store them in Redis, instead of
+# resolving them from groups and contacts in Riak every time it sends.
+CONVERSATION_RECIPIENT_SNAPSHOTS = False
+
+# Set this to add the messages of conversations started from now on to a
+# search index in Redis, which answers message searches without a MapReduce
+# over the conversation's messages in Riak.
+CONVERSATION_MESSAGE_SEARCH_INDEX = False
+
+# Contact and message exports that are too big to email are stored for
+# download for this many days.
+EXPORT_RETENTION_DAYS = 7
+
 from celery.schedules import crontab
 CELERYBEAT_SCHEDULE = {
     'send-weekly-account-summary': {
@@ -301,6 +315,14 @@ CELERYBEAT_SCHEDULE = {
         'schedule': crontab(hour=0, minute=0),
         'args': ('daily',)
     },
+    'refresh-smart-groups': {
+        'task': 'go.contacts.tasks.refresh_smart_groups',
+        'schedule': crontab(minute='*/5'),
+    },
+    'delete-expired-exports': {
+        'task': 'go.base.tasks.delete_expired_exports',
+        'schedule': crontab(hour=1, minute=0),
+    },
 }
 
 try:
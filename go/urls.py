@@ -30,6 +30,10 @@ urlpatterns = patterns('',
     url(r'^t/task/$', 'go.base.views.token_task', name='token_task'),
     url(r'^t/(?P<token>\w+)/$', 'go.base.views.token', name='token'),
 
+    # stored contact and message exports
+    url(r'^exports/(?P<export_name>(?:contacts|messages)-export-\w+\.csv\.gz)'
+        r'/$', 'go.base.views.export', name='export'),
+
     # vumi go!
     url(r'^$', RedirectView.as_view(url='/conversations/', permanent=False,
                                     query_string=True), name='home'),
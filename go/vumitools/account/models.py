@@ -75,10 +75,15 @@ class AccountStore(object):
 
 
 class PerAccountStore(object):
-    def __init__(self, base_manager, user_account_key):
+    def __init__(self, base_manager, user_account_key, redis=None):
         self.base_manager = base_manager
         self.user_account_key = user_account_key
         self.manager = self.base_manager.sub_manager(user_account_key)
+        # Some stores keep indexes in Redis. Those that don't, or that
+        # weren't given a Redis manager, fall back to Riak.
+        self.redis = None
+        if redis is not None:
+            self.redis = redis.sub_manager(user_account_key)
         self.setup_proxies()
 
     @classmethod
@@ -10,8 +10,6 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 from vumi.errors import VumiError
 from vumi.service import Publisher
 from vumi.message import Message
-from vumi.components.tagpool import TagpoolManager
-from vumi.components.message_store import MessageStore
 from vumi.persist.model import Manager
 from vumi.persist.riak_manager import RiakManager
 from vumi.persist.txriak_manager import TxRiakManager
@@ -22,12 +20,19 @@ from vumi import log
 
 from go.vumitools.account import AccountStore
 from go.vumitools.contact import ContactStore
+from go.vumitools.contact_imports import ContactImportManager
 from go.vumitools.conversation import ConversationStore
-from go.vumitools.conversation.models import CONVERSATION_DRAFT
+from go.vumitools.conversation.models import (
+    CONVERSATION_DRAFT, CONVERSATION_RUNNING)
 from go.vumitools.conversation.utils import ConversationWrapper
 from go.vumitools.credit import CreditManager
+from go.vumitools.message_store import GoMessageStore
 from go.vumitools.middleware import DebitAccountMiddleware
+from go.vumitools.opt_out import OptOutStore
+from go.vumitools.routing import ConversationRoutingIndex
+from go.vumitools.tagpool import GoTagpoolManager
 from go.vumitools.token_manager import TokenManager
+from go.vumitools.utils import load_bunches, collect_bunches
 
 from django.conf import settings
 from django.utils.datastructures import SortedDict
@@ -94,9 +99,11 @@ class VumiUserApi(object):
         self.manager = self.api.manager
         self.user_account_key = user_account_key
         self.conversation_store = ConversationStore(self.api.manager,
-                                                    self.user_account_key)
+                                                    self.user_account_key,
+                                                    self.api.redis)
         self.contact_store = ContactStore(self.api.manager,
-                                          self.user_account_key)
+                                          self.user_account_key,
+                                          self.api.redis)
 
     def exists(self):
         return self.api.user_exists(self.user_account_key)
@@ -113,6 +120,19 @@ class VumiUserApi(object):
     def get_user_account(self):
         return self.api.get_user_account(self.user_account_key)
 
+    @Manager.calls_manager
+    def mark_indexes_built(self):
+        """
+        Mark the account's Redis indexes as built. This is only safe for a
+        new account, which has nothing in Riak that isn't indexed yet.
+        Everything stored from then on is indexed as it's stored.
+        """
+        opt_out_store = OptOutStore(
+            self.api.manager, self.user_account_key, self.api.redis)
+        yield self.conversation_store.mark_status_index_built()
+        yield self.contact_store.mark_surname_index_built()
+        yield opt_out_store.mark_opt_out_index_built()
+
     def wrap_conversation(self, conversation):
         """Wrap a conversation with a ConversationWrapper.
 
@@ -132,42 +152,61 @@ class VumiUserApi(object):
         if conversation:
             returnValue(self.wrap_conversation(conversation))
 
+    @Manager.calls_manager
+    def _load_conversations(self, keys):
+        convs = yield collect_bunches(
+            load_bunches(self.conversation_store.conversations, keys))
+        returnValue(convs)
+
     @Manager.calls_manager
     def finished_conversations(self):
-        conv_store = self.conversation_store
-        keys = yield conv_store.list_conversations()
-        conversations = []
-        for bunch in conv_store.conversations.load_all_bunches(keys):
-            conversations.extend((yield bunch))
+        keys = yield self.conversation_store.list_conversations()
+        conversations = yield self._load_conversations(keys)
         returnValue([c for c in conversations if c.ended()])
 
-    @Manager.calls_manager
     def active_conversations(self):
-        conversations = self.conversation_store.conversations
-        keys = yield conversations.index_lookup(
-            'end_timestamp', None).get_keys()
-        # NOTE: This assumes that we don't have very large numbers of active
-        #       conversations.
-        convs = []
-        for convs_bunch in conversations.load_all_bunches(keys):
-            convs.extend((yield convs_bunch))
-        returnValue(convs)
+        return self.conversation_store.load_active_conversations()
 
     @Manager.calls_manager
+    def _conversations_with_status(self, status):
+        conv_store = self.conversation_store
+        indexed = yield conv_store.status_index_built()
+        if not indexed:
+            conversations = yield self.active_conversations()
+            returnValue([c for c in conversations
+                            if c.get_status() == status])
+        # The status index lets us load only the conversations we want.
+        keys = yield conv_store.list_conversation_keys([status])
+        conversations = yield self._load_conversations(keys)
+        returnValue(conversations)
+
     def running_conversations(self):
-        conversations = yield self.active_conversations()
-        returnValue([c for c in conversations if c.running()])
+        return self._conversations_with_status(CONVERSATION_RUNNING)
 
-    @Manager.calls_manager
     def draft_conversations(self):
-        conversations = yield self.active_conversations()
-        returnValue([c for c in conversations
-                        if c.get_status() == CONVERSATION_DRAFT])
+        return self._conversations_with_status(CONVERSATION_DRAFT)
+
+    def active_conversation_summaries(self):
+        """
+        Return summaries of the draft and running conversations. These
+        come from the conversation status index without loading any
+        conversations if the index has been built.
+        """
+        return self.conversation_store.list_conversation_summaries()
+
+    def running_conversation_summaries(self):
+        """
+        Return summaries of the running conversations. These come from the
+        conversation status index without loading any conversations if the
+        index has been built.
+        """
+        return self.conversation_store.list_conversation_summaries(
+            [CONVERSATION_RUNNING])
 
     @Manager.calls_manager
     def tagpools(self):
         user_account = yield self.get_user_account()
-        active_conversations = yield self.active_conversations()
+        active_conversations = yield self.active_conversation_summaries()
 
         tp_usage = defaultdict(int)
         for conv in active_conversations:
@@ -216,7 +255,7 @@ class VumiUserApi(object):
         """
         # XXX: Do we need both this method and the following method?
         tags = set()
-        convs = yield self.active_conversations()
+        convs = yield self.active_conversation_summaries()
         for conv in convs:
             tag = (conv.delivery_tag_pool, conv.delivery_tag)
             tags.add(tag)
@@ -344,13 +383,17 @@ class VumiApi(object):
         self.manager = manager
         self.redis = redis
 
-        self.tpm = TagpoolManager(self.redis.sub_manager('tagpool_store'))
+        self.tpm = GoTagpoolManager(self.redis.sub_manager('tagpool_store'))
         self.cm = CreditManager(self.redis.sub_manager('credit_store'))
-        self.mdb = MessageStore(self.manager,
-                                self.redis.sub_manager('message_store'))
+        self.mdb = GoMessageStore(self.manager,
+                                  self.redis.sub_manager('message_store'))
         self.account_store = AccountStore(self.manager)
         self.token_manager = TokenManager(
                                 self.redis.sub_manager('token_manager'))
+        self.routing_index = ConversationRoutingIndex(
+                                self.redis.sub_manager('routing_index'))
+        self.contact_imports = ContactImportManager(
+                                self.redis.sub_manager('contact_imports'))
         self.mapi = sender
 
     @staticmethod
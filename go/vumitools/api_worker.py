@@ -198,8 +198,10 @@ class GoApplicationRouter(BaseDispatchRouter):
     def find_application_for_event(self, event):
         """
         Look up the application for a given event by first looking up the
-        outbound message that the event is for and then using that messages'
-        batch to find which conversation it is associated with.
+        outbound message that the event is for and then that message's
+        batch in the routing index. If the batch isn't indexed we fall back
+        to finding the conversation through the batch and add the batch to
+        the index for next time.
         """
         user_message_id = event.get('user_message_id')
         if user_message_id is None:
@@ -213,6 +215,17 @@ class GoApplicationRouter(BaseDispatchRouter):
                         event,))
             return
 
+        batch_key = outbound_message.batch.key
+        if batch_key is None:
+            log.error(
+                'Outbound message without a batch id. Result of bad routing')
+            return
+
+        batch_info = yield self.vumi_api.routing_index.get_batch(batch_key)
+        if batch_info is not None:
+            returnValue(
+                self.conversation_mappings[batch_info['conversation_type']])
+
         batch = yield outbound_message.batch.get()
         if batch is None:
             log.error(
@@ -227,6 +240,7 @@ class GoApplicationRouter(BaseDispatchRouter):
 
         conv = yield user_api.get_wrapped_conversation(conv_key)
         if conv:
+            yield conv.index_batch(batch.key)
             returnValue(self.conversation_mappings[conv.conversation_type])
 
     @inlineCallbacks
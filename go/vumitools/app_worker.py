@@ -124,11 +124,29 @@ class GoApplicationMixin(object):
         args = command_message['args']
         kwargs = command_message['kwargs']
         cmd_method = getattr(self, cmd_method_name, None)
+        snapshot = kwargs.pop('snapshot_recipients', False)
+        if cmd_method and snapshot:
+            d = self.snapshot_recipients(
+                kwargs['batch_id'], kwargs['conversation_key'])
+            return d.addCallback(lambda _: cmd_method(*args, **kwargs))
         if cmd_method:
             return cmd_method(*args, **kwargs)
         else:
             return self.process_unknown_cmd(cmd_method_name, *args, **kwargs)
 
+    @inlineCallbacks
+    def snapshot_recipients(self, batch_id, conversation_key):
+        """
+        Take the recipient snapshot a conversation asked for when it was
+        started, before the start command is processed.
+        """
+        conv = yield self.get_conversation(batch_id, conversation_key)
+        if conv is None:
+            return
+        count = yield conv.snapshot_recipients()
+        log.info('Took a snapshot of %s recipients for conversation %s.' % (
+            count, conversation_key))
+
     @inlineCallbacks
     def process_command_collect_metrics(self, conversation_key,
                                         user_account_key):
@@ -0,0 +1,72 @@
+# -*- test-case-name: go.vumitools.tests.test_cache -*-
+
+"""Small in-process caches for hot lookups."""
+
+from collections import OrderedDict
+
+from twisted.internet import reactor
+
+
+class LRUCache(object):
+    """A size bounded, least recently used cache with expiring entries.
+
+    This is meant for per-process caching of values that are expensive to
+    look up and change rarely. Nothing is shared between processes, so
+    anything stored here can be up to `ttl` seconds stale unless it is
+    explicitly invalidated in the process that holds it.
+
+    :param int max_size:
+        The maximum number of entries to hold. The least recently used
+        entry is evicted when this is exceeded.
+    :param float ttl:
+        How long (in seconds) an entry is valid for. `None` means entries
+        never expire and are only evicted when the cache is full.
+    :param clock:
+        Something with a `seconds()` method. Defaults to the reactor.
+    """
+
+    def __init__(self, max_size=10000, ttl=None, clock=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock or reactor
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self._get_entry(key) is not None
+
+    def _get_entry(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, _value = entry
+        if expires_at is not None and expires_at <= self.clock.seconds():
+            del self._entries[key]
+            return None
+        return entry
+
+    def get(self, key, default=None):
+        entry = self._get_entry(key)
+        if entry is None:
+            return default
+        # Move the entry to the most recently used end.
+        del self._entries[key]
+        self._entries[key] = entry
+        return entry[1]
+
+    def set(self, key, value):
+        expires_at = None
+        if self.ttl is not None:
+            expires_at = self.clock.seconds() + self.ttl
+        self._entries.pop(key, None)
+        self._entries[key] = (expires_at, value)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
@@ -1,5 +1,5 @@
 from go.vumitools.contact.models import (
-    ContactGroup, Contact, ContactStore)
+    ContactGroup, Contact, ContactAddress, ContactStore)
 
 
-__all__ = ['ContactGroup', 'Contact', 'ContactStore']
+__all__ = ['ContactGroup', 'Contact', 'ContactAddress', 'ContactStore']
@@ -1,16 +1,23 @@
 # -*- test-case-name: go.vumitools.tests.test_contact -*-
 
+import string
+import itertools
+from operator import itemgetter
 from uuid import uuid4
 from datetime import datetime
 
 from twisted.internet.defer import returnValue
 
+from vumi.message import VUMI_DATE_FORMAT
 from vumi.persist.model import Model, Manager
 from vumi.persist.fields import (Unicode, ManyToMany, ForeignKey, Timestamp,
                                     Dynamic)
 
 from go.vumitools.account import UserAccount, PerAccountStore
+from go.vumitools.cache import LRUCache
 from go.vumitools.opt_out import OptOutStore
+from go.vumitools.utils import (
+    gather_results, map_pages, load_bunches, collect_bunches)
 
 
 class ContactGroup(Model):
@@ -52,6 +59,43 @@ class Contact(Model):
     extra = Dynamic(prefix='extras-')
     subscription = Dynamic(prefix='subscription-')
 
+    # Secondary indexes on the first letter of the surname, on its own and
+    # combined with each of the contact's groups, for browsing contacts by
+    # surname. These are derived from other fields, so they're set whenever
+    # the contact is saved rather than through a field descriptor.
+    SURNAME_LETTER_INDEX = 'surname_letter_bin'
+    GROUP_SURNAME_LETTER_INDEX = 'group_surname_letter_bin'
+
+    @staticmethod
+    def group_surname_letter(group_key, letter):
+        return "%s:%s" % (group_key, letter)
+
+    def surname_letter(self):
+        """
+        Return the lowercase first letter of the surname, or `None` if the
+        surname doesn't start with an ASCII letter.
+        """
+        letter = (self.surname or u'')[:1].lower()
+        if letter and letter in string.ascii_lowercase:
+            return str(letter)
+        return None
+
+    def _set_surname_indexes(self):
+        riak_object = self._riak_object
+        riak_object.remove_index(self.SURNAME_LETTER_INDEX)
+        riak_object.remove_index(self.GROUP_SURNAME_LETTER_INDEX)
+        letter = self.surname_letter()
+        if letter is None:
+            return
+        riak_object.add_index(self.SURNAME_LETTER_INDEX, letter)
+        for group_key in self.groups.keys():
+            riak_object.add_index(self.GROUP_SURNAME_LETTER_INDEX,
+                                  self.group_surname_letter(group_key, letter))
+
+    def save(self):
+        self._set_surname_indexes()
+        return super(Contact, self).save()
+
     def add_to_group(self, group):
         if isinstance(group, ContactGroup):
             self.groups.add(group)
@@ -78,11 +122,109 @@ class Contact(Model):
                 or 'Unknown User')
 
 
+class ContactAddress(object):
+    """
+    The key and addresses of a contact. Sending messages only needs these,
+    so they are extracted in Riak rather than loading whole contacts.
+    """
+
+    __slots__ = ('key', 'msisdn', 'gtalk_id', 'twitter_handle')
+
+    def __init__(self, key, msisdn=None, gtalk_id=None, twitter_handle=None):
+        self.key = key
+        self.msisdn = msisdn
+        self.gtalk_id = gtalk_id
+        self.twitter_handle = twitter_handle
+
+    def addr_for(self, delivery_class):
+        field = ContactStore.ADDR_FIELDS.get(delivery_class)
+        if field is None:
+            return None
+        return getattr(self, field)
+
+    def __repr__(self):
+        return '<ContactAddress %s>' % (self.key,)
+
+
 class ContactStore(PerAccountStore):
+    """
+    Contacts and groups for an account.
+
+    If the store has a Redis manager it also keeps track of groups that are
+    being deleted, or having their contacts deleted. Groups being deleted
+    are left out of :meth:`list_groups` so that nothing new is added to them
+    while their contacts are being removed. Progress is shown for both while
+    the deletion runs.
+
+    Contacts are looked up by address in an index of contact keys, kept in
+    Redis and in an in-process cache, before resorting to a Riak search.
+    Contacts created with :meth:`new_contact`, and saved or deleted with
+    :meth:`save_contact` or :meth:`delete_contact`, keep the index up to
+    date. Contacts are saved from too many places for the index to be
+    complete though, so every hit is checked against the contact it points
+    to and a miss still falls back to a search (which then updates the
+    index). Searches that find nothing are remembered in Redis for
+    `ADDR_MISS_TTL` seconds, so that messages from unknown addresses don't
+    each cost a search. The `go_rebuild_contact_addr_index` management
+    command backfills the index.
+
+    Contacts are browsed by the first letter of their surname through Riak
+    secondary indexes that are set whenever a contact is saved. Contacts
+    saved before these indexes existed don't have them, so they're only used
+    once the `go_rebuild_contact_surname_index` management command has
+    re-saved every contact for the account and marked the index as built in
+    Redis, or once the index has been marked as built for a new account.
+    Until then we fall back to a MapReduce over the contacts bucket.
+    """
+
+    GROUPS_DELETING_KEY = 'groups_deleting'
+    GROUPS_CLEARING_KEY = 'groups_clearing'
+    SURNAME_INDEXED_KEY = 'contacts_surname_indexed'
+    SMART_GROUPS_KEY = 'smart_groups_materialized'
+
+    # How many contact keys the paged methods hand out at a time. This is
+    # the Riak manager's default load bunch size, so each page of keys is
+    # loaded in a single bunch.
+    KEY_PAGE_SIZE = 100
+    CONTACTS_VERSION_KEY = 'contacts_version'
+
+    # The contact field holding the address for each delivery class.
+    ADDR_FIELDS = {
+        'sms': 'msisdn',
+        'ussd': 'msisdn',
+        'gtalk': 'gtalk_id',
+        'twitter': 'twitter_handle',
+    }
+
+    # Contact keys by address, shared by every store in the process.
+    addr_cache = LRUCache(max_size=10000, ttl=300)
+    ADDR_MISS_TTL = 60
+
     def setup_proxies(self):
         self.contacts = self.manager.proxy(Contact)
         self.groups = self.manager.proxy(ContactGroup)
 
+    def group_deletion_key(self, group_key):
+        return "group_deletion:%s" % (group_key,)
+
+    def smart_group_key(self, group_key):
+        return "smart_group:%s" % (group_key,)
+
+    def smart_group_members_key(self, group_key):
+        return "smart_group:%s:members" % (group_key,)
+
+    def addr_index_key(self, field):
+        return "contacts_by_addr:%s" % (field,)
+
+    def addr_miss_key(self, field, addr):
+        return "contacts_addr_miss:%s:%s" % (field, addr.encode('utf-8'))
+
+    def contact_addrs_key(self, contact_key):
+        return "contact_addrs:%s" % (contact_key,)
+
+    def _addr_cache_key(self, field, addr):
+        return (self.manager.bucket_prefix, field, addr)
+
     @Manager.calls_manager
     def new_contact(self, **fields):
         contact_id = uuid4().get_hex()
@@ -96,6 +238,8 @@ class ContactStore(PerAccountStore):
             contact.add_to_group(group)
 
         yield contact.save()
+        yield self.index_contact_addrs(contact)
+        yield self.note_contacts_changed()
         returnValue(contact)
 
     @Manager.calls_manager
@@ -120,6 +264,22 @@ class ContactStore(PerAccountStore):
     def get_contact_by_key(self, key):
         return self.contacts.load(key)
 
+    @Manager.calls_manager
+    def save_contact(self, contact):
+        """
+        Save `contact` and update the address index with its addresses.
+        """
+        yield contact.save()
+        yield self.index_contact_addrs(contact)
+
+    @Manager.calls_manager
+    def delete_contact(self, contact):
+        """
+        Delete `contact` and remove its addresses from the address index.
+        """
+        yield contact.delete()
+        yield self.unindex_contact_addrs(contact)
+
     def get_group(self, name):
         return self.groups.load(name)
 
@@ -155,22 +315,339 @@ class ContactStore(PerAccountStore):
         """
         return group.backlinks.contacts()
 
+    @Manager.calls_manager
     def get_dynamic_contacts_for_group(self, group):
         """
-        Use Riak search to find matching contacts.
+        Use the materialized membership of the smart group if it has one,
+        otherwise use Riak search to find matching contacts.
+        """
+        info = yield self.get_smart_group_info(group.key)
+        if self._is_materialized(info):
+            keys = yield self.redis.zrange(
+                self.smart_group_members_key(group.key), 0, -1)
+            returnValue(keys)
+        keys = yield self.contacts.raw_search(group.query).get_keys()
+        returnValue(keys)
+
+    # The paged methods below return iterators over (possibly deferred)
+    # pages of contact keys, like `load_all_bunches` does for model
+    # instances. Only materialized smart groups can be read from Redis a page
+    # at a time. Neither Riak 2i nor Riak search can be paged with the Riak
+    # client we use, so keys from those are fetched once and handed out in
+    # pages. Either way, callers only need to hold one page of contacts at a
+    # time.
+
+    def _key_pages(self, keys, page_size):
+        for i in xrange(0, len(keys), page_size):
+            yield keys[i:i + page_size]
+
+    @Manager.calls_manager
+    def get_smart_group_key_page(self, group_key, cursor=0, page_size=None):
+        """
+        Return the page of keys at `cursor` in the materialized membership
+        of the smart group `group_key`, and the cursor for the next page
+        (`None` once a page comes back short). Paging until a short page
+        rather than up to a member count taken beforehand picks up members
+        added while we read, which a smart group refresh does before it
+        updates the count.
+        """
+        page_size = page_size or self.KEY_PAGE_SIZE
+        keys = yield self.redis.zrange(
+            self.smart_group_members_key(group_key), cursor,
+            cursor + page_size - 1)
+        next_cursor = None
+        if len(keys) == page_size:
+            next_cursor = cursor + page_size
+        returnValue((keys, next_cursor))
+
+    @Manager.calls_manager
+    def _smart_group_key_pages(self, group_key, page_size):
+        # Each page is fetched on its own through the cursor, so the pages
+        # can be asked for in any order. Members added after the size was
+        # taken are left out.
+        size = yield self.redis.zcard(self.smart_group_members_key(group_key))
+        pages = (self.get_smart_group_key_page(group_key, cursor, page_size)
+                 for cursor in xrange(0, size, page_size))
+        returnValue(map_pages(pages, itemgetter(0)))
+
+    def _unseen_keys(self, keys, seen_keys):
+        keys = [key for key in keys if key not in seen_keys]
+        seen_keys.update(keys)
+        return keys
+
+    @Manager.calls_manager
+    def get_static_contact_key_pages_for_group(self, group, page_size=None):
+        keys = yield self.get_static_contacts_for_group(group)
+        returnValue(self._key_pages(keys, page_size or self.KEY_PAGE_SIZE))
+
+    @Manager.calls_manager
+    def get_dynamic_contact_key_pages_for_group(self, group, page_size=None):
+        page_size = page_size or self.KEY_PAGE_SIZE
+        info = yield self.get_smart_group_info(group.key)
+        if self._is_materialized(info):
+            pages = yield self._smart_group_key_pages(group.key, page_size)
+            returnValue(pages)
+        keys = yield self.contacts.raw_search(group.query).get_keys()
+        returnValue(self._key_pages(keys, page_size))
+
+    @Manager.calls_manager
+    def get_contact_key_pages_for_group(self, group, page_size=None,
+                                        seen_keys=None):
+        """
+        Return an iterator over pages of keys for the contacts in the group.
+        Keys in `seen_keys` are left out, and keys are added to it as their
+        pages are handed out.
+        """
+        if seen_keys is None:
+            seen_keys = set()
+        pages = yield self.get_static_contact_key_pages_for_group(
+            group, page_size)
+        if group.is_smart_group():
+            dynamic_pages = yield self.get_dynamic_contact_key_pages_for_group(
+                group, page_size)
+            pages = itertools.chain(pages, dynamic_pages)
+        returnValue(map_pages(pages, self._unseen_keys, seen_keys))
+
+    @Manager.calls_manager
+    def get_contact_key_pages_for_conversation(self, conversation,
+                                               page_size=None):
+        """
+        Return an iterator over pages of keys for the contacts in the
+        conversation's static and dynamic groups.
+        """
+        seen_keys = set()
+        group_pages = []
+        for groups in conversation.groups.load_all_bunches():
+            for group in (yield groups):
+                pages = yield self.get_contact_key_pages_for_group(
+                    group, page_size, seen_keys)
+                group_pages.append(pages)
+        returnValue(itertools.chain(*group_pages))
+
+    def load_contact_pages(self, key_pages):
+        """
+        Return an iterator over (possibly deferred) lists of the contacts for
+        each page of keys in `key_pages`. Contacts that no longer exist are
+        left out.
+        """
+        return map_pages(key_pages, self._load_contact_page)
+
+    def _load_contact_page(self, keys):
+        return collect_bunches(load_bunches(self.contacts, keys))
+
+    def load_contact_address_pages(self, key_pages):
+        """
+        Like :meth:`load_contact_pages`, but for :class:`ContactAddress`
+        objects.
         """
-        return self.contacts.raw_search(group.query).get_keys()
+        return map_pages(key_pages, self.load_contact_addresses)
+
+    @Manager.calls_manager
+    def load_contact_addresses(self, keys):
+        """
+        Return :class:`ContactAddress` objects for the contacts with the
+        given keys. Contacts that no longer exist are left out.
+        """
+        if not keys:
+            returnValue([])
+        mr = self.manager.riak_map_reduce()
+        bucket = self.manager.bucket_name(Contact)
+        for key in keys:
+            mr.add_bucket_key_data(bucket, key, None)
+        # Only the addresses leave Riak. Deleted contacts (and contacts that
+        # were never there) have no live values and are skipped.
+        js_function = """function(value, keyData, arg){
+            if (value.not_found) {
+                return [];
+            }
+            for (i in value.values) {
+                var val = value.values[i]
+                if (!val.metadata['X-Riak-Deleted']) {
+                    var data = JSON.parse(val.data);
+                    return [[value.key, data.msisdn || null,
+                             data.gtalk_id || null,
+                             data.twitter_handle || null]];
+                }
+            }
+            return [];
+        }"""
+        mr.map(js_function)
+        addresses = yield self.manager.run_map_reduce(mr,
+            lambda manager, result: ContactAddress(*result))
+        returnValue(addresses)
 
+    @Manager.calls_manager
     def count_contacts_for_group(self, group):
         if group.is_smart_group():
-            return self.contacts.raw_search(group.query).get_count()
+            info = yield self.get_smart_group_info(group.key)
+            if self._is_materialized(info):
+                returnValue(info['count'])
+            count = yield self.contacts.raw_search(group.query).get_count()
         else:
-            return self.contacts.index_lookup('groups', group.key).get_count()
+            count = yield self.contacts.index_lookup(
+                'groups', group.key).get_count()
+        returnValue(count)
+
+    def note_contacts_changed(self):
+        """
+        Record that the account's contacts have changed, so that smart
+        groups refreshed before now are stale.
+        """
+        if self.redis is not None:
+            return self.redis.incr(self.CONTACTS_VERSION_KEY)
 
     @Manager.calls_manager
-    def filter_contacts_on_surname(self, letter, group=None):
-        # FIXME: This does a mapreduce over a bucket, which means hitting every
-        #        key in riak.
+    def materialize_smart_group(self, group):
+        """
+        Start keeping the membership of the smart group in Redis. The group
+        is used as before until its membership is first refreshed with
+        :meth:`refresh_smart_group`.
+        """
+        if self.redis is None:
+            raise ValueError("Can't materialize a smart group without Redis.")
+        if not group.is_smart_group():
+            raise ValueError("Group %r is not a smart group." % (group.key,))
+        yield self.redis.sadd(self.SMART_GROUPS_KEY, group.key)
+        yield self.redis.hsetnx(self.smart_group_key(group.key), 'count', 0)
+
+    @Manager.calls_manager
+    def unmaterialize_smart_group(self, group_key):
+        if self.redis is None:
+            return
+        yield self.redis.srem(self.SMART_GROUPS_KEY, group_key)
+        yield self.redis.delete(self.smart_group_key(group_key))
+        yield self.redis.delete(self.smart_group_members_key(group_key))
+
+    def _is_materialized(self, info):
+        # A group's materialized membership is only usable once it has been
+        # refreshed.
+        return info is not None and info['refreshed_at'] is not None
+
+    @Manager.calls_manager
+    def get_smart_group_info(self, group_key):
+        """
+        Return a dictionary with the `count` of members in a materialized
+        smart group, when it was `refreshed_at` (`None` if it hasn't been
+        yet) and whether it is `stale`. Returns `None` if the group isn't
+        materialized.
+        """
+        if self.redis is None:
+            return
+        info = yield self.redis.hgetall(self.smart_group_key(group_key))
+        if not info:
+            return
+        version = yield self.redis.get(self.CONTACTS_VERSION_KEY)
+        refreshed_at = info.get('refreshed_at')
+        if refreshed_at is not None:
+            refreshed_at = datetime.strptime(refreshed_at, VUMI_DATE_FORMAT)
+        returnValue({
+            'count': int(info['count']),
+            'refreshed_at': refreshed_at,
+            'stale': (refreshed_at is None or
+                      info.get('version') != (version or '0')),
+            })
+
+    @Manager.calls_manager
+    def list_smart_groups_to_refresh(self, max_age):
+        """
+        Return the keys of materialized smart groups that are stale, or were
+        last refreshed more than `max_age` (a timedelta) ago. The latter
+        catches contacts changed without going through this store.
+        """
+        if self.redis is None:
+            returnValue([])
+        group_keys = yield self.redis.smembers(self.SMART_GROUPS_KEY)
+        cutoff = datetime.utcnow() - max_age
+        refresh_keys = []
+        for group_key in sorted(group_keys):
+            info = yield self.get_smart_group_info(group_key)
+            if info is None:
+                continue
+            if info['stale'] or info['refreshed_at'] < cutoff:
+                refresh_keys.append(group_key)
+        returnValue(refresh_keys)
+
+    @Manager.calls_manager
+    def refresh_smart_group(self, group):
+        """
+        Bring the materialized membership of the smart group up to date with
+        a Riak search. Only the differences are written, so the membership
+        stays usable while this runs. Returns the number of members.
+        """
+        if self.redis is None:
+            raise ValueError("Can't materialize a smart group without Redis.")
+        # Contacts changed after this point make the group stale again.
+        version = yield self.redis.get(self.CONTACTS_VERSION_KEY)
+        refreshed_at = datetime.utcnow()
+
+        members_key = self.smart_group_members_key(group.key)
+        keys = yield self.contacts.raw_search(group.query).get_keys()
+        keys = set(keys)
+        # Members are kept in a sorted set with equal scores, which orders
+        # them by key and lets them be read a page at a time.
+        old_keys = yield self.redis.zrange(members_key, 0, -1)
+        for key in keys.difference(old_keys):
+            yield self.redis.zadd(members_key, **{key: 0})
+        for key in set(old_keys).difference(keys):
+            yield self.redis.zrem(members_key, key)
+
+        yield self.redis.hmset(self.smart_group_key(group.key), {
+            'count': len(keys),
+            'refreshed_at': refreshed_at.strftime(VUMI_DATE_FORMAT),
+            'version': version or '0',
+            })
+        returnValue(len(keys))
+
+    @Manager.calls_manager
+    def surname_index_built(self):
+        if self.redis is None:
+            returnValue(False)
+        indexed = yield self.redis.exists(self.SURNAME_INDEXED_KEY)
+        returnValue(bool(indexed))
+
+    def mark_surname_index_built(self):
+        return self.redis.set(self.SURNAME_INDEXED_KEY, '1')
+
+    @Manager.calls_manager
+    def list_contact_keys_for_surname(self, letter, group=None):
+        """
+        Return the sorted keys of the contacts (in `group`, if given) whose
+        surnames start with `letter`, using the surname letter index.
+        """
+        letter = letter.lower()
+        if group is None:
+            keys = yield self.manager.index_keys(
+                Contact, Contact.SURNAME_LETTER_INDEX, letter)
+        else:
+            keys = yield self.manager.index_keys(
+                Contact, Contact.GROUP_SURNAME_LETTER_INDEX,
+                Contact.group_surname_letter(group.key, letter))
+        returnValue(sorted(keys))
+
+    @Manager.calls_manager
+    def filter_contacts_on_surname(self, letter, group=None, start=0,
+                                   limit=None):
+        """
+        Return the contacts (in `group`, if given) whose surnames start with
+        `letter`, ordered by key. `start` and `limit` select a page of them.
+        """
+        stop = None if limit is None else start + limit
+        indexed = yield self.surname_index_built()
+        if not indexed:
+            contacts = yield self._map_reduce_contacts_on_surname(
+                letter, group)
+            contacts.sort(key=lambda contact: contact.key)
+            returnValue(contacts[start:stop])
+
+        keys = yield self.list_contact_keys_for_surname(letter, group)
+        contacts = yield collect_bunches(
+            load_bunches(self.contacts, keys[start:stop]))
+        returnValue(contacts)
+
+    @Manager.calls_manager
+    def _map_reduce_contacts_on_surname(self, letter, group=None):
+        # NOTE: This does a mapreduce over a bucket, which means hitting every
+        #       key in riak. It's only used until the surname index is built.
         # TODO: vumi.persist needs to have better ways of supporting
         #       generic map reduce functions. There's a bunch of boilerplate
         #       around getting bucket names and indexes that I'm doing
@@ -202,7 +679,7 @@ class ContactStore(PerAccountStore):
         contacts = yield self.manager.run_map_reduce(mr,
             lambda manager, result: Contact.load(
                 manager, result[0], result[1]))
-        returnValue(contacts)
+        returnValue(list(contacts))
 
     @Manager.calls_manager
     def list_contacts(self):
@@ -216,11 +693,84 @@ class ContactStore(PerAccountStore):
         user_account = yield self.get_user_account()
         group_keys = yield user_account.backlinks.contactgroups(self.manager)
         # NOTE: This assumes that we don't have very large numbers of groups.
-        groups = []
-        for groups_bunch in self.groups.load_all_bunches(group_keys):
-            groups.extend((yield groups_bunch))
+        deleting = set()
+        if self.redis is not None:
+            deleting = yield self.redis.smembers(self.GROUPS_DELETING_KEY)
+        group_keys = [key for key in group_keys if key not in deleting]
+        groups = yield collect_bunches(load_bunches(self.groups, group_keys))
         returnValue(sorted(groups, key=lambda group: group.name))
 
+    @Manager.calls_manager
+    def start_group_deletion(self, group, contacts_only=False):
+        """
+        Start tracking the deletion of `group`, or of just its contacts if
+        `contacts_only` is set. Starting a deletion that is already being
+        tracked (because the task deleting it was interrupted) keeps its
+        progress.
+        """
+        if self.redis is None:
+            return
+        deletion_key = self.group_deletion_key(group.key)
+        yield self.redis.hsetnx(deletion_key, 'deleted', 0)
+        yield self.redis.hmset(deletion_key, {
+            'group_key': group.key,
+            'name': group.name,
+            'contacts_only': '1' if contacts_only else '0',
+            })
+        if contacts_only:
+            yield self.redis.sadd(self.GROUPS_CLEARING_KEY, group.key)
+        else:
+            yield self.redis.sadd(self.GROUPS_DELETING_KEY, group.key)
+
+    @Manager.calls_manager
+    def record_group_deletion_progress(self, group_key, count):
+        """
+        Record that another `count` of the group's contacts have been
+        dealt with.
+        """
+        if self.redis is not None:
+            yield self.redis.hincrby(
+                self.group_deletion_key(group_key), 'deleted', count)
+
+    @Manager.calls_manager
+    def get_group_deletion_progress(self, group_key):
+        """
+        Return a dictionary describing the deletion of the group or its
+        contacts, or `None` if it isn't being deleted.
+        """
+        if self.redis is None:
+            return
+        progress = yield self.redis.hgetall(self.group_deletion_key(group_key))
+        if not progress:
+            return
+        progress['deleted'] = int(progress['deleted'])
+        progress['contacts_only'] = progress['contacts_only'] == '1'
+        returnValue(progress)
+
+    @Manager.calls_manager
+    def list_group_deletions(self):
+        """
+        Return the progress of all the groups being deleted or having their
+        contacts deleted.
+        """
+        if self.redis is None:
+            returnValue([])
+        deleting = yield self.redis.smembers(self.GROUPS_DELETING_KEY)
+        clearing = yield self.redis.smembers(self.GROUPS_CLEARING_KEY)
+        deletions = []
+        for group_key in sorted(set(deleting) | set(clearing)):
+            progress = yield self.get_group_deletion_progress(group_key)
+            if progress is not None:
+                deletions.append(progress)
+        returnValue(deletions)
+
+    @Manager.calls_manager
+    def finish_group_deletion(self, group_key):
+        if self.redis is not None:
+            yield self.redis.srem(self.GROUPS_DELETING_KEY, group_key)
+            yield self.redis.srem(self.GROUPS_CLEARING_KEY, group_key)
+            yield self.redis.delete(self.group_deletion_key(group_key))
+
     @Manager.calls_manager
     def contact_has_opted_out(self, contact):
         # FIXME:    opt-outs are currently had coded to only work for msisdns
@@ -232,13 +782,159 @@ class ContactStore(PerAccountStore):
         opt_out = yield opt_out_store.get_opt_out('msisdn', contact.msisdn)
         returnValue(opt_out)
 
+    def _contact_addrs(self, contact):
+        addrs = {}
+        for field in set(self.ADDR_FIELDS.values()):
+            addr = getattr(contact, field)
+            # Contacts without an msisdn get a placeholder one.
+            if addr and addr != u'unknown':
+                addrs[field] = addr
+        return addrs
+
+    @Manager.calls_manager
+    def _indexed_contact_addrs(self, contact_key):
+        if self.redis is None:
+            returnValue({})
+        addrs = yield self.redis.hgetall(self.contact_addrs_key(contact_key))
+        returnValue(dict((field, addr.decode('utf-8'))
+                         for field, addr in addrs.iteritems()))
+
+    @Manager.calls_manager
+    def index_contact_addrs(self, contact):
+        """
+        Add the contact's addresses to the address index, and remove any
+        addresses it was indexed under before that it no longer has.
+        """
+        addrs = self._contact_addrs(contact)
+        old_addrs = yield self._indexed_contact_addrs(contact.key)
+        for field, addr in old_addrs.iteritems():
+            if addrs.get(field) != addr:
+                yield self._unindex_addr(field, addr, contact.key)
+        for field, addr in addrs.iteritems():
+            yield self._index_addr(field, addr, contact.key)
+        if self.redis is not None:
+            contact_addrs_key = self.contact_addrs_key(contact.key)
+            yield self.redis.delete(contact_addrs_key)
+            if addrs:
+                yield self.redis.hmset(contact_addrs_key, addrs)
+
+    @Manager.calls_manager
+    def unindex_contact_addrs(self, contact):
+        """
+        Remove the contact's addresses from the address index.
+        """
+        addrs = yield self._indexed_contact_addrs(contact.key)
+        addrs.update(self._contact_addrs(contact))
+        for field, addr in addrs.iteritems():
+            yield self._unindex_addr(field, addr, contact.key)
+        if self.redis is not None:
+            yield self.redis.delete(self.contact_addrs_key(contact.key))
+
+    @Manager.calls_manager
+    def _index_addr(self, field, addr, contact_key):
+        self.addr_cache.set(self._addr_cache_key(field, addr), contact_key)
+        if self.redis is not None:
+            yield self.redis.hset(self.addr_index_key(field), addr,
+                                  contact_key)
+            yield self.redis.delete(self.addr_miss_key(field, addr))
+
+    @Manager.calls_manager
+    def _unindex_addr(self, field, addr, contact_key=None):
+        """
+        Remove `addr` from the index, but only if it still points at
+        `contact_key` when that is given, since another contact may have
+        taken the address since.
+        """
+        cache_key = self._addr_cache_key(field, addr)
+        cached_key = self.addr_cache.get(cache_key)
+        if contact_key is None or cached_key == contact_key:
+            self.addr_cache.delete(cache_key)
+        if self.redis is None:
+            return
+        index_key = self.addr_index_key(field)
+        if contact_key is not None:
+            indexed_key = yield self.redis.hget(index_key, addr)
+            if indexed_key != contact_key:
+                return
+        yield self.redis.hdel(index_key, addr)
+
+    @Manager.calls_manager
+    def find_contact_for_addr(self, field, addr):
+        """
+        Return the contact with `addr` in the address field `field`, or
+        `None` if there isn't one.
+        """
+        contact_key = self.addr_cache.get(self._addr_cache_key(field, addr))
+        missed = False
+        if contact_key is None and self.redis is not None:
+            contact_key, missed = yield gather_results([
+                self.redis.hget(self.addr_index_key(field), addr),
+                self.redis.exists(self.addr_miss_key(field, addr)),
+                ])
+        if contact_key is not None:
+            contact = yield self.contacts.load(contact_key)
+            if contact is not None and getattr(contact, field) == addr:
+                self.addr_cache.set(
+                    self._addr_cache_key(field, addr), contact_key)
+                returnValue(contact)
+            # The contact has been deleted or its address has changed.
+            yield self._unindex_addr(field, addr)
+        elif missed:
+            return
+
+        keys = yield self.contacts.search(**{field: addr}).get_keys()
+        if not keys:
+            if self.redis is not None:
+                yield self.redis.setex(self.addr_miss_key(field, addr),
+                                       self.ADDR_MISS_TTL, '1')
+            return
+        contact = yield self.contacts.load(keys[0])
+        if contact is not None:
+            yield self._index_addr(field, addr, contact.key)
+        returnValue(contact)
+
+    @Manager.calls_manager
+    def rebuild_addr_index(self):
+        """
+        Rebuild the Redis address index from the contacts in Riak. Returns
+        the number of contacts indexed.
+        """
+        if self.redis is None:
+            raise ValueError("Can't build an address index without Redis.")
+        for field in set(self.ADDR_FIELDS.values()):
+            yield self.redis.delete(self.addr_index_key(field))
+        contact_keys = yield self.list_contacts()
+        count = 0
+        for bunch in load_bunches(self.contacts, contact_keys):
+            for contact in (yield bunch):
+                yield self.index_contact_addrs(contact)
+                count += 1
+        returnValue(count)
+
+    @Manager.calls_manager
+    def rebuild_surname_index(self):
+        """
+        Re-save every contact in Riak so that it has surname letter indexes,
+        and mark the index as usable. Returns the number of contacts indexed.
+        """
+        if self.redis is None:
+            raise ValueError("Can't mark a surname index as built without "
+                             "Redis.")
+        contact_keys = yield self.list_contacts()
+        count = 0
+        for bunch in load_bunches(self.contacts, contact_keys):
+            for contact in (yield bunch):
+                yield contact.save()
+                count += 1
+        yield self.mark_surname_index_built()
+        returnValue(count)
+
     @Manager.calls_manager
     def contact_for_addr(self, delivery_class, addr):
         if delivery_class in ('sms', 'ussd'):
             addr = '+' + addr.lstrip('+')
-            keys = yield self.contacts.search(msisdn=addr).get_keys()
-            if keys:
-                contact = yield self.contacts.load(keys[0])
+            contact = yield self.find_contact_for_addr('msisdn', addr)
+            if contact is not None:
                 returnValue(contact)
             contact_id = uuid4().get_hex()
             returnValue(self.contacts(contact_id,
@@ -246,9 +942,8 @@ class ContactStore(PerAccountStore):
                                       msisdn=addr))
         elif delivery_class == 'gtalk':
             addr = addr.partition('/')[0]
-            keys = yield self.contacts.search(gtalk_id=addr).get_keys()
-            if keys:
-                contact = yield self.contacts.load(keys[0])
+            contact = yield self.find_contact_for_addr('gtalk_id', addr)
+            if contact is not None:
                 returnValue(contact)
             contact_id = uuid4().get_hex()
             contact = self.contacts(contact_id,
@@ -256,9 +951,8 @@ class ContactStore(PerAccountStore):
                                     gtalk_id=addr, msisdn=u'unknown')
             returnValue(contact)
         elif delivery_class == 'twitter':
-            keys = yield self.contacts.search(twitter_handle=addr).get_keys()
-            if keys:
-                contact = yield self.contacts.load(keys[0])
+            contact = yield self.find_contact_for_addr('twitter_handle', addr)
+            if contact is not None:
                 returnValue(contact)
             contact_id = uuid4().get_hex()
             contact = self.contacts(contact_id,
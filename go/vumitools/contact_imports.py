@@ -0,0 +1,142 @@
+# -*- test-case-name: go.vumitools.tests.test_contact_imports -*-
+from uuid import uuid4
+
+from twisted.internet.defer import returnValue
+from vumi.persist.redis_base import Manager
+
+
+class ContactImportManager(object):
+    """
+    Keeps track of contact imports in Redis.
+
+    Each import has a hash holding its status and how many contacts have been
+    written so far, which the UI can poll while the import runs. An import is
+    split into chunks of rows which may be written in parallel. Each chunk
+    has a list of the keys of the contacts it has written, which is all that
+    is needed to roll the chunk (or the whole import) back if it fails.
+    """
+
+    IMPORT_PENDING = 'pending'
+    IMPORT_RUNNING = 'running'
+    IMPORT_COMPLETED = 'completed'
+    IMPORT_FAILED = 'failed'
+
+    # How long we keep an import's progress around once it is done, in
+    # seconds.
+    DEFAULT_LIFETIME = 60 * 60 * 24
+
+    INT_FIELDS = ('written', 'chunks', 'chunks_done', 'chunks_failed')
+
+    def __init__(self, redis):
+        self.manager = self.redis = redis
+
+    def written_keys_key(self, import_id, chunk_id=0):
+        return "%s:written:%s" % (import_id, chunk_id)
+
+    def latest_import_key(self, group_key):
+        return "group:%s" % (group_key,)
+
+    @Manager.calls_manager
+    def new_import(self, account_key, group_key, file_name):
+        """
+        Register a new import into `group_key` and return its id.
+        """
+        import_id = uuid4().get_hex()
+        yield self.redis.hmset(import_id, {
+            'account_key': account_key,
+            'group_key': group_key,
+            'file_name': file_name,
+            'status': self.IMPORT_PENDING,
+            'written': 0,
+            })
+        yield self.redis.set(self.latest_import_key(group_key), import_id)
+        returnValue(import_id)
+
+    @Manager.calls_manager
+    def get_progress(self, import_id):
+        """
+        Return a dictionary describing the import, or `None` if it doesn't
+        exist (or finished long enough ago to have expired).
+        """
+        progress = yield self.redis.hgetall(import_id)
+        if not progress:
+            return
+        for field in self.INT_FIELDS:
+            if field in progress:
+                progress[field] = int(progress[field])
+        returnValue(progress)
+
+    def get_latest_import(self, group_key):
+        return self.redis.get(self.latest_import_key(group_key))
+
+    def start_import(self, import_id, chunks=1):
+        """
+        Mark the import as running, split into `chunks` chunks.
+        """
+        return self.redis.hmset(import_id, {
+            'status': self.IMPORT_RUNNING,
+            'chunks': chunks,
+            'chunks_done': 0,
+            'chunks_failed': 0,
+            })
+
+    @Manager.calls_manager
+    def record_written(self, import_id, contact_keys, chunk_id=0):
+        """
+        Record that the contacts for `contact_keys` have been written.
+        """
+        written_keys_key = self.written_keys_key(import_id, chunk_id)
+        for contact_key in contact_keys:
+            yield self.redis.rpush(written_keys_key, contact_key)
+        yield self.redis.hincrby(import_id, 'written', len(contact_keys))
+
+    def get_written_keys(self, import_id, start, count, chunk_id=0):
+        """
+        Return up to `count` of the keys written by a chunk of the import,
+        starting at `start`.
+        """
+        return self.redis.lrange(self.written_keys_key(import_id, chunk_id),
+                                 start, start + count - 1)
+
+    @Manager.calls_manager
+    def discard_written(self, import_id, chunk_id=0):
+        """
+        Forget the contacts written by a chunk once they've been rolled back.
+        """
+        written_keys_key = self.written_keys_key(import_id, chunk_id)
+        count = yield self.redis.llen(written_keys_key)
+        yield self.redis.delete(written_keys_key)
+        yield self.redis.hincrby(import_id, 'written', -count)
+
+    @Manager.calls_manager
+    def finish_chunk(self, import_id, chunk_id, error=None):
+        """
+        Record that a chunk is done, and whether it failed with `error`.
+        Returns `True` for the last chunk of the import to finish, which is
+        then responsible for finishing the import.
+        """
+        if error is not None:
+            yield self.redis.hincrby(import_id, 'chunks_failed', 1)
+            # Only the first error is kept for reporting.
+            yield self.redis.hsetnx(import_id, 'error', error)
+        chunks_done = yield self.redis.hincrby(import_id, 'chunks_done', 1)
+        chunks = yield self.redis.hget(import_id, 'chunks')
+        returnValue(chunks_done == int(chunks))
+
+    @Manager.calls_manager
+    def finish_import(self, import_id, status, lifetime=None):
+        """
+        Mark the import as done with the given `status` and let its progress
+        expire after `lifetime` seconds. Returns the final progress.
+        """
+        lifetime = lifetime or self.DEFAULT_LIFETIME
+        progress = yield self.get_progress(import_id)
+        yield self.redis.hset(import_id, 'status', status)
+        yield self.redis.expire(import_id, lifetime)
+        # The written keys are only needed for rolling back a running import.
+        for chunk_id in range(progress.get('chunks', 1)):
+            yield self.redis.delete(self.written_keys_key(import_id, chunk_id))
+        yield self.redis.expire(
+            self.latest_import_key(progress['group_key']), lifetime)
+        progress['status'] = status
+        returnValue(progress)
@@ -1,4 +1,5 @@
 from go.vumitools.conversation.models import (
-    CONVERSATION_TYPES, Conversation, ConversationStore)
+    CONVERSATION_TYPES, Conversation, ConversationStore, ConversationSummary)
 
-__all__ = ['CONVERSATION_TYPES', 'Conversation', 'ConversationStore']
+__all__ = ['CONVERSATION_TYPES', 'Conversation', 'ConversationStore',
+           'ConversationSummary']
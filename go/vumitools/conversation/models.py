@@ -1,5 +1,6 @@
 # -*- test-case-name: go.vumitools.tests.test_conversation -*-
 
+import json
 from uuid import uuid4
 from datetime import datetime
 
@@ -12,6 +13,7 @@ from twisted.internet.defer import returnValue
 
 from go.vumitools.account import UserAccount, PerAccountStore
 from go.vumitools.contact import ContactGroup
+from go.vumitools.utils import gather_results, load_bunches, collect_bunches
 
 
 CONVERSATION_TYPES = [
@@ -86,10 +88,72 @@ class Conversation(Model):
         return [addr for addr in addrs if addr]
 
 
+class ConversationSummary(object):
+    """
+    The few fields of a conversation that are needed to list conversations
+    and their endpoints without loading the full conversation from Riak.
+    """
+
+    FIELDS = ('conversation_type', 'subject', 'delivery_class',
+              'delivery_tag_pool', 'delivery_tag')
+
+    def __init__(self, key, user_account_key, status, **fields):
+        self.key = key
+        self.user_account_key = user_account_key
+        self.status = status
+        for field in self.FIELDS:
+            setattr(self, field, fields.get(field))
+
+    @classmethod
+    def from_conversation(cls, conversation):
+        fields = dict((field, getattr(conversation, field))
+                      for field in cls.FIELDS)
+        return cls(conversation.key, conversation.user_account.key,
+                   conversation.get_status(), **fields)
+
+    @classmethod
+    def from_json(cls, key, user_account_key, status, data):
+        fields = dict((str(field), value)
+                      for field, value in json.loads(data).iteritems())
+        return cls(key, user_account_key, status, **fields)
+
+    def to_json(self):
+        return json.dumps(dict((field, getattr(self, field))
+                               for field in self.FIELDS))
+
+    def __repr__(self):
+        return '<ConversationSummary %s (%s)>' % (self.key, self.status)
+
+
 class ConversationStore(PerAccountStore):
+    """
+    Conversations for an account.
+
+    If the store has a Redis manager it also keeps a hash of summaries for
+    each of the draft and running conversations in the account, so that
+    active conversations can be listed with a single Redis call instead of
+    an index lookup and a load of every active conversation. The index is
+    only used once it has been built with :meth:`rebuild_status_index` (see
+    the `go_rebuild_conversation_status_index` management command), or
+    marked as built when the account was created, until then listings go to
+    Riak.
+    """
+
+    INDEXED_KEY = 'conversation_status_indexed'
+    INDEXED_STATUSES = (CONVERSATION_DRAFT, CONVERSATION_RUNNING)
+    # While the index is being rebuilt, conversations indexed by anything
+    # else are noted so the rebuild can reindex them from Riak.
+    REBUILDING_KEY = 'conversation_status_rebuilding'
+    REBUILD_CHANGES_KEY = 'conversation_status_rebuild_changes'
+    # How long a rebuild that died part way through is waited for.
+    REBUILD_TIMEOUT = 60 * 60
+
     def setup_proxies(self):
         self.conversations = self.manager.proxy(Conversation)
 
+    def status_index_key(self, status):
+        return "conversations:%s" % (status,)
+
     @Manager.calls_manager
     def list_conversations(self):
         # Not stale, because we're using backlinks.
@@ -120,4 +184,140 @@ class ConversationStore(PerAccountStore):
             conversation.add_group(group)
 
         conversation = yield conversation.save()
+        yield self.update_status_index(conversation)
         returnValue(conversation)
+
+    @Manager.calls_manager
+    def update_status_index(self, conversation):
+        """
+        Record the current status of `conversation` in the status index.
+        This must be called whenever a conversation is created, started or
+        ended.
+        """
+        if self.redis is not None:
+            yield self._index_conversation(
+                ConversationSummary.from_conversation(conversation))
+
+    @Manager.calls_manager('redis')
+    def _index_conversation(self, summary):
+        rebuilding = yield self.redis.exists(self.REBUILDING_KEY)
+        if rebuilding:
+            yield self.redis.sadd(self.REBUILD_CHANGES_KEY, summary.key)
+        yield self._write_summary(summary)
+
+    @Manager.calls_manager('redis')
+    def _write_summary(self, summary):
+        for status in self.INDEXED_STATUSES:
+            if status != summary.status:
+                yield self.redis.hdel(
+                    self.status_index_key(status), summary.key)
+        if summary.status in self.INDEXED_STATUSES:
+            yield self.redis.hset(self.status_index_key(summary.status),
+                                  summary.key, summary.to_json())
+
+    @Manager.calls_manager
+    def status_index_built(self):
+        if self.redis is None:
+            returnValue(False)
+        indexed = yield self.redis.exists(self.INDEXED_KEY)
+        returnValue(bool(indexed))
+
+    def mark_status_index_built(self):
+        return self.redis.set(self.INDEXED_KEY, '1')
+
+    @Manager.calls_manager
+    def load_active_conversations(self):
+        keys = yield self.conversations.index_lookup(
+            'end_timestamp', None).get_keys()
+        # NOTE: This assumes that we don't have very large numbers of active
+        #       conversations.
+        convs = yield collect_bunches(load_bunches(self.conversations, keys))
+        returnValue(convs)
+
+    @Manager.calls_manager
+    def list_conversation_summaries(self, statuses=INDEXED_STATUSES):
+        """
+        Return :class:`ConversationSummary` objects for the conversations
+        with one of the given `statuses`, which must be draft or running.
+        """
+        indexed = yield self.status_index_built()
+        if not indexed:
+            convs = yield self.load_active_conversations()
+            summaries = [ConversationSummary.from_conversation(conv)
+                         for conv in convs]
+            returnValue([summary for summary in summaries
+                         if summary.status in statuses])
+
+        results = yield gather_results(
+            self.redis.hgetall(self.status_index_key(status))
+            for status in statuses)
+        summaries = []
+        for status, summary_data in zip(statuses, results):
+            for key, data in sorted(summary_data.iteritems()):
+                summaries.append(ConversationSummary.from_json(
+                    key, self.user_account_key, status, data))
+        returnValue(summaries)
+
+    @Manager.calls_manager
+    def list_conversation_keys(self, statuses=INDEXED_STATUSES):
+        """
+        Return the keys of the conversations with one of the given
+        `statuses`, which must be draft or running.
+        """
+        summaries = yield self.list_conversation_summaries(statuses)
+        returnValue([summary.key for summary in summaries])
+
+    @Manager.calls_manager
+    def rebuild_status_index(self):
+        """
+        Rebuild the Redis status index from the active conversations in
+        Riak and mark it as usable. Returns the number of conversations
+        indexed.
+
+        The index is updated in place, so it stays usable while it's
+        rebuilt. Conversations that are indexed by something else during
+        the rebuild may have been loaded before they changed, so they're
+        loaded again and reindexed once everything else has been written.
+        """
+        if self.redis is None:
+            raise ValueError(
+                "Can't build a conversation status index without Redis.")
+        yield self.redis.delete(self.REBUILD_CHANGES_KEY)
+        yield self.redis.setex(
+            self.REBUILDING_KEY, self.REBUILD_TIMEOUT, '1')
+
+        indexed = yield gather_results(
+            self.redis.hgetall(self.status_index_key(status))
+            for status in self.INDEXED_STATUSES)
+        convs = yield self.load_active_conversations()
+        summaries = [ConversationSummary.from_conversation(conv)
+                     for conv in convs]
+        active_keys = set(summary.key for summary in summaries)
+        for status, summary_data in zip(self.INDEXED_STATUSES, indexed):
+            for key in set(summary_data) - active_keys:
+                yield self.redis.hdel(self.status_index_key(status), key)
+        for summary in summaries:
+            yield self._write_summary(summary)
+
+        yield self._reindex_rebuild_changes()
+        yield self.redis.delete(self.REBUILDING_KEY)
+        # Anything that saw the rebuild running before we stopped it.
+        yield self._reindex_rebuild_changes()
+
+        yield self.mark_status_index_built()
+        returnValue(len(convs))
+
+    @Manager.calls_manager
+    def _reindex_rebuild_changes(self):
+        while True:
+            key = yield self.redis.spop(self.REBUILD_CHANGES_KEY)
+            if key is None:
+                return
+            conv = yield self.get_conversation_by_key(key)
+            if conv is None:
+                yield gather_results(
+                    self.redis.hdel(self.status_index_key(status), key)
+                    for status in self.INDEXED_STATUSES)
+            else:
+                yield self._write_summary(
+                    ConversationSummary.from_conversation(conv))
@@ -0,0 +1,203 @@
+# -*- test-case-name: go.vumitools.conversation.tests.test_recipients -*-
+from datetime import datetime
+
+from twisted.internet.defer import Deferred, returnValue
+from vumi.message import VUMI_DATE_FORMAT
+from vumi.persist.redis_base import Manager
+
+from go.vumitools.contact import ContactAddress, ContactStore
+from go.vumitools.utils import gather_results
+
+
+class RecipientSnapshot(object):
+    """
+    The opted-in recipients of a conversation, resolved once when the
+    conversation is started so that application workers don't have to go
+    through groups, contact keys, contacts and opt-outs in Riak every time
+    they send.
+
+    The recipients are kept in Redis as a list of bunches, each one a
+    newline separated string of `<contact key>:<address>` entries, so that
+    a whole bunch is written with a single RPUSH and read with a single
+    LRANGE. There is one entry for each distinct address for the
+    conversation's delivery class. A hash holds the delivery class, how
+    many recipients and bunches there are and when the snapshot was taken.
+    The hash is only written once the list is complete, so a snapshot that
+    was interrupted while being taken is never used.
+
+    While the snapshot is being taken, the addresses seen so far are kept
+    in a Redis set rather than in memory, so only one bunch of recipients
+    is held at a time. The set is deleted once the snapshot is complete,
+    and expires `SEEN_ADDRS_LIFETIME` seconds after the last bunch if
+    taking the snapshot doesn't finish.
+    """
+
+    DEFAULT_BUNCH_SIZE = 100
+    SEEN_ADDRS_LIFETIME = 24 * 60 * 60
+
+    def __init__(self, redis, conversation_key):
+        self.redis = redis
+        self.conversation_key = conversation_key
+
+    def recipients_key(self):
+        return "recipients:%s" % (self.conversation_key,)
+
+    def info_key(self):
+        return "recipients:%s:info" % (self.conversation_key,)
+
+    def seen_addrs_key(self):
+        return "recipients:%s:seen" % (self.conversation_key,)
+
+    def _store_bunch(self, entries):
+        bunch = u"\n".join(entries)
+        return self.redis.rpush(self.recipients_key(), bunch.encode('utf-8'))
+
+    @Manager.calls_manager
+    def take(self, address_bunches, delivery_class,
+             bunch_size=DEFAULT_BUNCH_SIZE):
+        """
+        Replace the snapshot with the addresses for `delivery_class` of the
+        :class:`ContactAddress` objects in `address_bunches`, an iterator
+        over (possibly deferred) lists of them. Only the first contact with
+        each address is kept. Returns the number of recipients.
+        """
+        yield self.delete()
+        entries = []
+        count = 0
+        bunches = 0
+        for bunch in address_bunches:
+            addresses = yield bunch
+            unseen = yield self._unseen_addrs(addresses, delivery_class)
+            for address, addr in unseen:
+                entries.append(u"%s:%s" % (address.key, addr))
+                count += 1
+                if len(entries) >= bunch_size:
+                    yield self._store_bunch(entries)
+                    bunches += 1
+                    entries = []
+        if entries:
+            yield self._store_bunch(entries)
+            bunches += 1
+        yield self.redis.hmset(self.info_key(), {
+            'delivery_class': delivery_class,
+            'count': count,
+            'bunches': bunches,
+            'taken_at': datetime.utcnow().strftime(VUMI_DATE_FORMAT),
+            })
+        yield self.redis.delete(self.seen_addrs_key())
+        returnValue(count)
+
+    @Manager.calls_manager
+    def _unseen_addrs(self, addresses, delivery_class):
+        """
+        Return `(address, addr)` pairs for the `addresses` whose `addr` for
+        `delivery_class` hasn't been seen in this snapshot yet.
+        """
+        candidates = []
+        for address in addresses:
+            addr = address.addr_for(delivery_class)
+            if addr:
+                candidates.append((address, addr))
+        if not candidates:
+            returnValue([])
+        seen_addrs_key = self.seen_addrs_key()
+        added = yield gather_results([
+            self.redis.sadd(seen_addrs_key, addr)
+            for _address, addr in candidates])
+        yield self.redis.expire(seen_addrs_key, self.SEEN_ADDRS_LIFETIME)
+        returnValue([candidate for candidate, is_new
+                     in zip(candidates, added) if is_new])
+
+    @Manager.calls_manager
+    def delete(self):
+        yield self.redis.delete(self.info_key())
+        yield self.redis.delete(self.recipients_key())
+        yield self.redis.delete(self.seen_addrs_key())
+
+    @Manager.calls_manager
+    def get_info(self):
+        """
+        Return a dictionary with the `delivery_class`, `count` of
+        recipients, number of `bunches` and `taken_at` time of the
+        snapshot, or `None` if there isn't one.
+        """
+        info = yield self.redis.hgetall(self.info_key())
+        if not info:
+            return
+        returnValue({
+            'delivery_class': info['delivery_class'],
+            'count': int(info['count']),
+            'bunches': int(info['bunches']),
+            'taken_at': datetime.strptime(info['taken_at'], VUMI_DATE_FORMAT),
+            })
+
+    def _split_bunch(self, bunches):
+        # LRANGE gives us a list holding the one bunch we asked for.
+        if not bunches or not bunches[0]:
+            return []
+        return bunches[0].decode('utf-8').split(u'\n')
+
+    def _parse_entries(self, entries, delivery_class):
+        field = ContactStore.ADDR_FIELDS[delivery_class]
+        recipients = []
+        for entry in entries:
+            contact_key, _, addr = entry.partition(u':')
+            recipient = ContactAddress(contact_key)
+            setattr(recipient, field, addr)
+            recipients.append(recipient)
+        return recipients
+
+    @Manager.calls_manager
+    def get_recipients(self, cursor=0):
+        """
+        Return the bunch of recipients at `cursor` as a list of
+        :class:`ContactAddress` objects, and the cursor for the next call
+        (`None` once there are no more).
+        """
+        info = yield self.get_info()
+        if info is None or cursor >= info['bunches']:
+            returnValue(([], None))
+        bunches = yield self.redis.lrange(
+            self.recipients_key(), cursor, cursor)
+        next_cursor = cursor + 1
+        if next_cursor >= info['bunches']:
+            next_cursor = None
+        returnValue(
+            (self._parse_entries(
+                self._split_bunch(bunches), info['delivery_class']),
+             next_cursor))
+
+    def _iter_bunches(self, info, parse):
+        for cursor in xrange(info['bunches']):
+            bunches = self.redis.lrange(self.recipients_key(), cursor, cursor)
+            if isinstance(bunches, Deferred):
+                yield bunches.addCallback(self._split_bunch).addCallback(parse)
+            else:
+                yield parse(self._split_bunch(bunches))
+
+    @Manager.calls_manager
+    def get_recipient_bunches(self):
+        """
+        Return an iterator over (possibly deferred) lists of the recipients
+        in each bunch, as :class:`ContactAddress` objects.
+        """
+        info = yield self.get_info()
+        if info is None:
+            returnValue(iter([]))
+        returnValue(self._iter_bunches(
+            info,
+            lambda entries: self._parse_entries(
+                entries, info['delivery_class'])))
+
+    @Manager.calls_manager
+    def get_contact_key_pages(self):
+        """
+        Return an iterator over (possibly deferred) pages of the recipients'
+        contact keys, one for each bunch.
+        """
+        info = yield self.get_info()
+        if info is None:
+            returnValue(iter([]))
+        returnValue(self._iter_bunches(
+            info,
+            lambda entries: [entry.partition(u':')[0] for entry in entries]))
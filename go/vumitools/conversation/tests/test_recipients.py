@@ -0,0 +1,122 @@
+"""Tests for go.vumitools.conversation.recipients."""
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from go.vumitools.tests.utils import GoPersistenceMixin
+from go.vumitools.contact import ContactAddress
+from go.vumitools.conversation.recipients import RecipientSnapshot
+
+
+class RecipientSnapshotTestCase(GoPersistenceMixin, TestCase):
+
+    use_riak = False
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.redis = yield self.get_redis_manager()
+        self.snapshot = RecipientSnapshot(self.redis, 'conv-1')
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    def mk_addresses(self, count):
+        return [ContactAddress('contact-%s' % (i,), msisdn=u'+2783%s' % (i,))
+                for i in range(count)]
+
+    @inlineCallbacks
+    def collect_bunches(self, bunches):
+        collected = []
+        for bunch in bunches:
+            collected.append((yield bunch))
+        returnValue(collected)
+
+    @inlineCallbacks
+    def test_take(self):
+        self.assertEqual((yield self.snapshot.get_info()), None)
+        addresses = self.mk_addresses(3)
+        addresses.append(ContactAddress('contact-x', gtalk_id=u'x@example'))
+        count = yield self.snapshot.take(
+            iter([addresses[:2], addresses[2:]]), 'sms', bunch_size=2)
+        self.assertEqual(count, 3)
+        info = yield self.snapshot.get_info()
+        self.assertEqual(info['count'], 3)
+        self.assertEqual(info['bunches'], 2)
+        self.assertEqual(info['delivery_class'], 'sms')
+        # Each bunch is stored as a single list entry.
+        self.assertEqual(
+            (yield self.redis.llen(self.snapshot.recipients_key())), 2)
+
+        bunches = yield self.collect_bunches(
+            (yield self.snapshot.get_recipient_bunches()))
+        self.assertEqual(
+            [[(r.key, r.addr_for('sms')) for r in bunch] for bunch in bunches],
+            [[(u'contact-0', u'+27830'), (u'contact-1', u'+27831')],
+             [(u'contact-2', u'+27832')]])
+        pages = yield self.collect_bunches(
+            (yield self.snapshot.get_contact_key_pages()))
+        self.assertEqual(
+            pages, [[u'contact-0', u'contact-1'], [u'contact-2']])
+
+    @inlineCallbacks
+    def test_take_dedupes_addresses(self):
+        addresses = self.mk_addresses(2)
+        addresses.append(ContactAddress('contact-y', msisdn=u'+27830'))
+        count = yield self.snapshot.take([addresses[:1], addresses[1:]], 'sms')
+        self.assertEqual(count, 2)
+        [bunch] = yield self.collect_bunches(
+            (yield self.snapshot.get_recipient_bunches()))
+        self.assertEqual([r.key for r in bunch], [u'contact-0', u'contact-1'])
+        # The addresses seen are only kept while the snapshot is taken.
+        self.assertFalse(
+            (yield self.redis.exists(self.snapshot.seen_addrs_key())))
+
+    @inlineCallbacks
+    def test_take_dedupes_addresses_in_redis(self):
+        seen_sizes = []
+
+        def address_bunches():
+            yield self.mk_addresses(2)
+            seen_sizes.append(self.redis.scard(self.snapshot.seen_addrs_key()))
+            yield self.mk_addresses(3)
+
+        count = yield self.snapshot.take(address_bunches(), 'sms')
+        self.assertEqual(count, 3)
+        self.assertEqual((yield seen_sizes[0]), 2)
+
+    @inlineCallbacks
+    def test_take_replaces_snapshot(self):
+        yield self.snapshot.take([self.mk_addresses(3)], 'sms')
+        yield self.snapshot.take([self.mk_addresses(1)], 'sms')
+        [bunch] = yield self.collect_bunches(
+            (yield self.snapshot.get_recipient_bunches()))
+        self.assertEqual([r.key for r in bunch], [u'contact-0'])
+
+    @inlineCallbacks
+    def test_take_nothing(self):
+        count = yield self.snapshot.take([], 'sms')
+        self.assertEqual(count, 0)
+        info = yield self.snapshot.get_info()
+        self.assertEqual((info['count'], info['bunches']), (0, 0))
+        self.assertEqual((yield self.snapshot.get_recipients()), ([], None))
+
+    @inlineCallbacks
+    def test_get_recipients(self):
+        yield self.snapshot.take([self.mk_addresses(3)], 'sms', bunch_size=2)
+        recipients, cursor = yield self.snapshot.get_recipients()
+        self.assertEqual([r.key for r in recipients],
+                         [u'contact-0', u'contact-1'])
+        self.assertEqual(cursor, 1)
+        recipients, cursor = yield self.snapshot.get_recipients(cursor)
+        self.assertEqual([r.key for r in recipients], [u'contact-2'])
+        self.assertEqual(cursor, None)
+
+    @inlineCallbacks
+    def test_delete(self):
+        yield self.snapshot.take([self.mk_addresses(3)], 'sms')
+        yield self.snapshot.delete()
+        self.assertEqual((yield self.snapshot.get_info()), None)
+        self.assertEqual((yield self.snapshot.get_recipients()), ([], None))
+        bunches = yield self.snapshot.get_recipient_bunches()
+        self.assertEqual(list(bunches), [])
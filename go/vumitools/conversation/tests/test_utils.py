@@ -128,6 +128,38 @@ class ConversationWrapperTestCase(AppWorkerTestCase):
         self.assertEqual(batch_key, batch2)
         self.assertEqual(len(conv.batches.keys()), 2)
 
+    @inlineCallbacks
+    def test_get_latest_batch_key_without_activity_index(self):
+        tag = yield self.conv.acquire_tag()
+        batch1 = yield self.get_batch_id(self.conv, tag)
+        batch2 = yield self.get_batch_id(self.conv, tag)
+        # This batch predates the index.
+        yield self.mdb.cache.remove_conversation_batch(batch1)
+
+        now = datetime.now()
+        yield self.store_outbound(batch1, start_timestamp=now)
+        yield self.store_outbound(batch2,
+                                    start_timestamp=now - timedelta(days=1))
+
+        conv = yield self.user_api.get_wrapped_conversation(self.conv.key)
+        batch_key = yield conv.get_latest_batch_key()
+        self.assertEqual(batch_key, batch1)
+
+    @inlineCallbacks
+    def test_get_latest_batch_key_uses_activity_index(self):
+        tag = yield self.conv.acquire_tag()
+        batch1 = yield self.get_batch_id(self.conv, tag)
+        yield self.get_batch_id(self.conv, tag)
+        yield self.store_outbound(batch1)
+
+        conv = yield self.user_api.get_wrapped_conversation(self.conv.key)
+
+        def get_outbound_message_keys(*args, **kw):
+            self.fail("Unexpected outbound key lookup.")
+        self.patch(self.mdb, 'get_outbound_message_keys',
+                   get_outbound_message_keys)
+        self.assertEqual((yield conv.get_latest_batch_key()), batch1)
+
     @inlineCallbacks
     def test_count_replies(self):
         yield self.conv.start()
@@ -221,6 +253,49 @@ class ConversationWrapperTestCase(AppWorkerTestCase):
         self.assertEqual(len((yield self.conv.sent_messages(5, 10))), 5)
         self.assertEqual(len((yield self.conv.sent_messages(20, 25))), 0)
 
+    @inlineCallbacks
+    def test_message_pages(self):
+        yield self.conv.start()
+        batch_key = yield self.conv.get_latest_batch_key()
+        # Each message is older than the one before it.
+        sent = yield self.store_outbound(batch_key, count=5)
+        key_pages = yield self.conv.get_message_key_pages(
+            'outbound', page_size=2)
+        pages = []
+        for page in key_pages:
+            pages.append((yield page))
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        messages = yield self.collect_bunches(
+            self.conv.load_message_pages('outbound', iter(pages)))
+        self.assertEqual([msg['message_id'] for msg in messages],
+                         [msg['message_id'] for msg in reversed(sent)])
+        inbound_pages = yield self.conv.get_message_key_pages('inbound')
+        self.assertEqual(list(inbound_pages), [])
+
+    @inlineCallbacks
+    def test_search_message_keys(self):
+        yield self.conv.start(index_messages=True)
+        batch_key = yield self.conv.get_latest_batch_key()
+        sent = yield self.store_outbound(batch_key, count=5)
+        keys = yield self.conv.search_message_keys(
+            'outbound', u'to:to-3 OR to:to-1')
+        self.assertEqual(keys, [sent[1]['message_id'], sent[3]['message_id']])
+        messages = yield self.conv.load_messages('outbound', keys)
+        self.assertEqual([msg['content'] for msg in messages],
+                         [u'hello world 1', u'hello world 3'])
+        self.assertEqual(
+            (yield self.conv.search_message_keys('outbound', u'-hello')),
+            None)
+
+    @inlineCallbacks
+    def test_search_message_keys_not_indexed(self):
+        yield self.conv.start()
+        batch_key = yield self.conv.get_latest_batch_key()
+        yield self.store_outbound(batch_key, count=1)
+        self.assertEqual(
+            (yield self.conv.search_message_keys('outbound', u'hello')),
+            None)
+
     @inlineCallbacks
     def test_sent_messages_include_sensitive(self):
         yield self.conv.start()
@@ -266,6 +341,93 @@ class ConversationWrapperTestCase(AppWorkerTestCase):
         [tag] = yield self.conv.get_tags()
         self.assertEqual(tag, ('longcode', 'longcode10001'))
 
+    @inlineCallbacks
+    def test_start_and_end_update_status_index(self):
+        conv_store = self.user_api.conversation_store
+        yield conv_store.rebuild_status_index()
+        self.assertEqual(
+            (yield conv_store.list_conversation_keys([u'draft'])),
+            [self.conv.key])
+
+        yield self.conv.start()
+        self.assertEqual(
+            (yield conv_store.list_conversation_keys([u'draft'])), [])
+        [summary] = yield self.user_api.running_conversation_summaries()
+        self.assertEqual(summary.key, self.conv.key)
+        self.assertEqual(summary.delivery_tag_pool, u'longcode')
+
+        yield self.conv.end_conversation()
+        self.assertEqual((yield conv_store.list_conversation_keys()), [])
+
+    @inlineCallbacks
+    def mk_recipients(self):
+        contact_store = self.user_api.contact_store
+        group = yield contact_store.new_group(u'group')
+        contacts = []
+        for msisdn in [u'+27831234567', u'+27831234568', u'unknown']:
+            contact = yield contact_store.new_contact(
+                name=u'Contact', surname=u'Person', msisdn=msisdn,
+                groups=[group])
+            contacts.append(contact)
+        self.conv.add_group(group)
+        yield self.conv.save()
+        returnValue(contacts)
+
+    @inlineCallbacks
+    def collect_bunches(self, bunches):
+        collected = []
+        for bunch in bunches:
+            collected.extend((yield bunch))
+        returnValue(collected)
+
+    @inlineCallbacks
+    def test_start_with_recipient_snapshot(self):
+        contact1, contact2, contact3 = yield self.mk_recipients()
+        yield self.conv.start(snapshot_recipients=True)
+        # The application worker takes the snapshot when it gets the start
+        # command.
+        self.assertEqual(
+            (yield self.conv.recipient_snapshot().get_info()), None)
+        cmd = self.get_dispatcher_commands()[-1].payload
+        self.assertEqual(cmd['command'], 'start')
+        self.assertEqual(cmd['kwargs']['snapshot_recipients'], True)
+        yield self.conv.snapshot_recipients()
+        info = yield self.conv.recipient_snapshot().get_info()
+        self.assertEqual(info['count'], 3)
+
+        # Contacts added after the start aren't in the snapshot.
+        [group] = yield self.conv.get_groups()
+        yield self.user_api.contact_store.new_contact(
+            name=u'Contact', surname=u'Person', msisdn=u'+27831234569',
+            groups=[group])
+
+        recipients = yield self.collect_bunches(
+            (yield self.conv.get_opted_in_address_bunches()))
+        self.assertEqual(
+            sorted((r.key, r.addr_for('sms')) for r in recipients),
+            sorted((c.key, c.msisdn) for c in [contact1, contact2, contact3]))
+        contacts = yield self.collect_bunches(
+            (yield self.conv.get_opted_in_contact_bunches()))
+        self.assertEqual(sorted(c.key for c in contacts),
+                         sorted([contact1.key, contact2.key, contact3.key]))
+
+        yield self.conv.end_conversation()
+        self.assertEqual(
+            (yield self.conv.recipient_snapshot().get_info()), None)
+
+    @inlineCallbacks
+    def test_start_without_recipient_snapshot(self):
+        yield self.mk_recipients()
+        yield self.conv.snapshot_recipients()
+        yield self.conv.start()
+        self.assertEqual(
+            (yield self.conv.recipient_snapshot().get_info()), None)
+        cmd = self.get_dispatcher_commands()[-1].payload
+        self.assertFalse('snapshot_recipients' in cmd['kwargs'])
+        recipients = yield self.collect_bunches(
+            (yield self.conv.get_opted_in_address_bunches()))
+        self.assertEqual(len(recipients), 3)
+
     @inlineCallbacks
     def test_get_progress_status(self):
         yield self.conv.start()
@@ -289,6 +451,36 @@ class ConversationWrapperTestCase(AppWorkerTestCase):
             'delivery_report_pending': 1,
             })
 
+    @inlineCallbacks
+    def test_get_progress_status_uses_conversation_counters(self):
+        yield self.conv.start()
+        batch_key = yield self.conv.get_latest_batch_key()
+        outbound = yield self.store_outbound(batch_key, count=3)
+        yield self.store_event(outbound, 'ack', count=2)
+
+        def fail_batch_status(batch_id):
+            self.fail("Unexpected batch_status call")
+        self.patch(self.mdb, 'batch_status', fail_batch_status)
+        status = yield self.conv.get_progress_status()
+        self.assertEqual(status['sent'], 3)
+        self.assertEqual(status['ack'], 2)
+
+    @inlineCallbacks
+    def test_get_progress_status_for_uncounted_batches(self):
+        # Batches that weren't started by the conversation aren't in its
+        # counters, so their batch statuses are summed instead.
+        batch1 = yield self.mdb.batch_start()
+        batch2 = yield self.mdb.batch_start()
+        self.conv.batches.add_key(batch1)
+        self.conv.batches.add_key(batch2)
+        yield self.conv.save()
+        yield self.store_event((yield self.store_outbound(batch1, count=2)),
+                               'ack')
+        yield self.store_outbound(batch2, count=3)
+        status = yield self.conv.get_progress_status()
+        self.assertEqual(status['sent'], 5)
+        self.assertEqual(status['ack'], 2)
+
     @inlineCallbacks
     def test_get_progress_percentage(self):
         yield self.conv.start()
@@ -474,6 +666,16 @@ class ConversationWrapperTestCase(AppWorkerTestCase):
         for bucket in buckets:
             self.assertEqual(bucket, 2)
 
+    @inlineCallbacks
+    def test_get_aggregate_count_without_rollups(self):
+        yield self.conv.start()
+        batch_key = yield self.conv.get_latest_batch_key()
+        yield self.store_outbound(batch_key, count=20, time_multiplier=12)
+        rollups = yield self.conv.get_aggregate_count('outbound')
+        yield self.mdb.cache.clear_rollups(batch_key)
+        self.assertEqual(
+            (yield self.conv.get_aggregate_count('outbound')), rollups)
+
     @inlineCallbacks
     def test_get_groups(self):
         groups = yield self.user_api.list_groups()
@@ -8,15 +8,22 @@ from twisted.internet.defer import returnValue
 
 from vumi.persist.model import Manager
 
+from go.vumitools.conversation.recipients import RecipientSnapshot
 from go.vumitools.exceptions import ConversationSendError
 from go.vumitools.opt_out import OptOutStore
-from go.vumitools.utils import GoMessageMetadata
+from go.vumitools.utils import (
+    GoMessageMetadata, message_metadata_cache, map_pages, load_bunches,
+    collect_bunches)
 
 
 class ConversationWrapper(object):
     """Wrapper around a conversation, providing extended functionality.
     """
 
+    # How many message keys are fetched from the message store's cache at a
+    # time when paging through them.
+    MESSAGE_KEY_PAGE_SIZE = 1000
+
     def __init__(self, conversation, user_api):
         self.c = conversation
         self.user_api = user_api
@@ -37,12 +44,15 @@ class ConversationWrapper(object):
     def end_conversation(self):
         self.c.end_timestamp = datetime.utcnow()
         yield self.c.save()
+        yield self.update_status_index()
+        yield self.recipient_snapshot().delete()
         yield self._release_batches()
 
     @Manager.calls_manager
     def _release_batches(self):
         for batch in (yield self.get_batches()):
             yield self.mdb.batch_done(batch.key)  # TODO: why key?
+            message_metadata_cache.invalidate_batch(batch.key)
             for tag in batch.tags:
                 yield self.user_api.release_tag(tag)
 
@@ -58,16 +68,21 @@ class ConversationWrapper(object):
     def set_metadata(self, metadata):
         self.c.metadata = metadata
 
+    @Manager.calls_manager
     def start_batch(self, *tags):
         user_account = unicode(self.c.user_account.key)
-        return self.mdb.batch_start(tags, user_account=user_account)
+        batch_id = yield self.mdb.batch_start(tags, user_account=user_account)
+        # The batch is new, so counting it towards the conversation's
+        # progress status from here on counts all of it, as long as its
+        # messages are cached by the Go message store cache.
+        yield self.mdb.cache.add_conversation_batch(self.c.key, batch_id)
+        returnValue(batch_id)
 
     @Manager.calls_manager
     def get_batches(self):
         # NOTE: This assumes that we don't have very large numbers of batches.
-        batches = []
-        for bunch in self.c.batches.load_all_bunches(self.base_manager):
-            batches.extend((yield bunch))
+        batches = yield collect_bunches(
+            load_bunches(self.mdb.batches, self.c.batches.keys()))
         returnValue(batches)
 
     def get_batch_keys(self):
@@ -111,11 +126,11 @@ class ConversationWrapper(object):
                          'delivery_report_delivered', 'delivery_report_failed',
                          'delivery_report_pending'))
 
-        for batch_id in self.get_batch_keys():
-            batch_status = yield self.mdb.batch_status(batch_id)
-            for k, v in batch_status.items():
-                k = k.replace('.', '_')
-                statuses[k] += v
+        conversation_status = yield self.mdb.conversation_status(
+            self.c.key, self.get_batch_keys())
+        for k, v in conversation_status.items():
+            k = k.replace('.', '_')
+            statuses[k] += v
 
         returnValue(statuses)
 
@@ -151,6 +166,7 @@ class ConversationWrapper(object):
 
     @Manager.calls_manager
     def start(self, no_batch_tag=False, batch_id=None, acquire_tag=True,
+                snapshot_recipients=False, index_messages=False,
                 **extra_params):
         """
         Send the start command to this conversations application worker.
@@ -171,6 +187,16 @@ class ConversationWrapper(object):
             the delivery_tag isn't explicity chosen but left for the tagpool
             manager to choose, the `delivery_tag` will be `None` and this
             will fail
+        :param bool snapshot_recipients:
+            If True, the application worker resolves the conversation's
+            opted-in recipients once, when it gets the start command, and
+            stores them in Redis to send to from then on. Otherwise the
+            worker resolves them every time it sends. Defaults to `False`.
+        :param bool index_messages:
+            If True, the messages in the new batch are added to the message
+            store's search index as they are stored, so that
+            :meth:`search_message_keys` can answer searches of them.
+            Defaults to `False`.
         :param kwargs extra_params:
             Extra parameters to pass along with the VumiApiCommand to the
             application worker receiving the command.
@@ -199,9 +225,23 @@ class ConversationWrapper(object):
                 tag = yield self.acquire_existing_tag()
             batch_tags = [] if no_batch_tag else [tag]
             batch_id = yield self.start_batch(*batch_tags)
+            if index_messages:
+                # Nothing has been stored in the new batch yet, so its index
+                # is complete from the start. It's only searched once the
+                # batch is maintained, which means its messages are being
+                # cached (and indexed) by the GoMessageStoreCache.
+                yield self.mdb.cache.search_index.enable_batch(
+                    batch_id, complete=True)
 
         msg_options = yield self.make_message_options(tag)
 
+        # Don't leave a snapshot from an earlier start lying around. A new
+        # one is taken by the application worker, since it can take a while
+        # for a large conversation.
+        yield self.recipient_snapshot().delete()
+        if snapshot_recipients:
+            extra_params['snapshot_recipients'] = True
+
         is_client_initiated = yield self.is_client_initiated()
         yield self.dispatch_command('start',
             batch_id=batch_id,
@@ -214,6 +254,36 @@ class ConversationWrapper(object):
         if batch_id not in self.get_batch_keys():
             self.c.batches.add_key(batch_id)
         yield self.c.save()
+        yield self.update_status_index()
+        yield self.index_batch(batch_id)
+
+    def recipient_snapshot(self):
+        return RecipientSnapshot(
+            self.user_api.conversation_store.redis, self.c.key)
+
+    @Manager.calls_manager
+    def snapshot_recipients(self):
+        """
+        Resolve the conversation's opted-in recipients and store them in a
+        :class:`RecipientSnapshot`, which the contact bunch methods use from
+        then on. Returns the number of recipients.
+        """
+        address_bunches = yield self._get_opted_in_address_bunches()
+        count = yield self.recipient_snapshot().take(
+            address_bunches, self.delivery_class)
+        returnValue(count)
+
+    def update_status_index(self):
+        return self.user_api.conversation_store.update_status_index(self.c)
+
+    def index_batch(self, batch_id):
+        """
+        Add a batch to the routing index so that events for its messages
+        can be routed to this conversation's application.
+        """
+        return self.api.routing_index.add_batch(
+            batch_id, self.c.key, self.c.conversation_type,
+            self.c.user_account.key)
 
     @Manager.calls_manager
     def send_token_url(self, token_url, msisdn, **extra_params):
@@ -243,6 +313,8 @@ class ConversationWrapper(object):
             })
         self.c.batches.add_key(batch_id)
         yield self.c.save()
+        yield self.update_status_index()
+        yield self.index_batch(batch_id)
 
     @Manager.calls_manager
     def get_latest_batch_key(self):
@@ -277,6 +349,15 @@ class ConversationWrapper(object):
         if hasattr(self, '_latest_batch_key'):
             returnValue(self._latest_batch_key)
 
+        # The message store cache keeps track of which of the conversation's
+        # batches were used last, unless some of them predate that.
+        active_batch_keys = (
+            yield self.mdb.cache.get_conversation_batches_by_activity(
+                self.c.key, batch_keys))
+        if active_batch_keys is not None:
+            self._latest_batch_key = (active_batch_keys or batch_keys)[0]
+            returnValue(self._latest_batch_key)
+
         # Loop over the batch_keys and find out which one was most recently
         # used to send out a message.
         batch_key_timestamps = []
@@ -367,10 +448,7 @@ class ConversationWrapper(object):
             The scrubber to use on hidden messages. Should return a message
             object or None.
         """
-        messages = []
-        bunches = yield proxy.load_all_bunches(keys)
-        for bunch in bunches:
-            messages.extend((yield bunch))
+        messages = yield collect_bunches(load_bunches(proxy, keys))
 
         collection = []
         for message in messages:
@@ -460,6 +538,98 @@ class ConversationWrapper(object):
 
         returnValue(sent_messages)
 
+    def _message_proxy(self, direction):
+        if direction == 'outbound':
+            return self.mdb.outbound_messages
+        return self.mdb.inbound_messages
+
+    @Manager.calls_manager
+    def get_message_key_pages(self, direction, batch_key=None,
+                              page_size=None):
+        """
+        Return an iterator over (possibly deferred) pages of the keys of the
+        inbound or outbound messages in the message store's cache, oldest
+        first. Each page is only fetched from the cache as the iterator is
+        advanced.
+
+        :param str direction:
+            Either 'inbound' or 'outbound'.
+        :param str batch_key:
+            The batch to get message keys for. Defaults to whatever
+            `get_latest_batch_key()` returns.
+        :param int page_size:
+            How many keys to put in each page.
+        """
+        batch_key = batch_key or (yield self.get_latest_batch_key())
+        if batch_key is None:
+            returnValue(iter([]))
+        page_size = page_size or self.MESSAGE_KEY_PAGE_SIZE
+        cache = self.mdb.cache
+        if direction == 'outbound':
+            get_keys = cache.get_outbound_message_keys
+            count = yield cache.outbound_message_keys_size(batch_key)
+        else:
+            get_keys = cache.get_inbound_message_keys
+            count = yield cache.inbound_message_keys_size(batch_key)
+        returnValue(
+            get_keys(batch_key, start, start + page_size - 1, asc=True)
+            for start in xrange(0, count, page_size))
+
+    def load_message_pages(self, direction, key_pages,
+                           include_sensitive=False, scrubber=None):
+        """
+        Return an iterator over (possibly deferred) lists of the messages
+        for each page of keys in `key_pages`, as returned by
+        :meth:`get_message_key_pages`. Only one page of messages needs to be
+        held at a time.
+
+        See :meth:`sent_messages` for `include_sensitive` and `scrubber`.
+        """
+        return map_pages(key_pages, self.collect_messages,
+                         self._message_proxy(direction),
+                         include_sensitive, scrubber or (lambda msg: msg))
+
+    @Manager.calls_manager
+    def search_message_keys(self, direction, query, batch_key=None):
+        """
+        Return the keys of the inbound or outbound messages matching `query`
+        from the message store's search index, newest first. See
+        :class:`go.vumitools.message_search.MessageSearchIndex` for the
+        query syntax.
+
+        Returns `None` if the batch hasn't been indexed or the index can't
+        answer the query, in which case callers should fall back to
+        :meth:`find_inbound_messages_matching` or
+        :meth:`find_outbound_messages_matching`.
+
+        :param str direction:
+            Either 'inbound' or 'outbound'.
+        :param str query:
+            The query to search for.
+        :param str batch_key:
+            The batch to search. Defaults to whatever
+            `get_latest_batch_key()` returns.
+        """
+        batch_key = batch_key or (yield self.get_latest_batch_key())
+        if batch_key is None:
+            returnValue(None)
+        direction = 'outbound' if direction == 'outbound' else 'inbound'
+        keys = yield self.mdb.cache.search_messages(
+            batch_key, direction, query)
+        returnValue(keys)
+
+    def load_messages(self, direction, keys, include_sensitive=False,
+                      scrubber=None):
+        """
+        Load the inbound or outbound messages for `keys`, such as a page of
+        the keys returned by :meth:`search_message_keys`.
+
+        See :meth:`sent_messages` for `include_sensitive` and `scrubber`.
+        """
+        return self.collect_messages(keys, self._message_proxy(direction),
+                                     include_sensitive,
+                                     scrubber or (lambda msg: msg))
+
     @Manager.calls_manager
     def find_inbound_messages_matching(self, pattern, flags="i",
                                         batch_key=None, key="msg.content",
@@ -508,9 +678,8 @@ class ConversationWrapper(object):
         """
         batch_key = batch_key or (yield self.get_latest_batch_key())
         keys = yield self.mdb.get_keys_for_token(batch_key, token, start, stop)
-        messages = []
-        for bunch in self.mdb.inbound_messages.load_all_bunches(keys):
-            messages.extend((yield bunch))
+        messages = yield collect_bunches(
+            load_bunches(self.mdb.inbound_messages, keys))
         returnValue(messages)
 
     @Manager.calls_manager
@@ -562,13 +731,27 @@ class ConversationWrapper(object):
         """
         batch_key = batch_key or (yield self.get_latest_batch_key())
         keys = yield self.mdb.get_keys_for_token(batch_key, token, start, stop)
-        messages = []
-        for bunch in self.mdb.outbound_messages.load_all_bunches(keys):
-            messages.extend((yield bunch))
+        messages = yield collect_bunches(
+            load_bunches(self.mdb.outbound_messages, keys))
         returnValue(messages)
 
     @Manager.calls_manager
     def get_aggregate_count(self, direction, batch_key=None, bucket_func=None):
+        """
+        Get the number of messages handled per bucket, bucketed per day
+        unless a `bucket_func` is given (see :meth:`get_aggregate_keys`).
+
+        Daily counts come from the message store cache's rollups if they are
+        complete for the batch.
+        """
+        batch_key = batch_key or (yield self.get_latest_batch_key())
+        if batch_key is not None and bucket_func is None:
+            direction = 'outbound' if direction == 'outbound' else 'inbound'
+            counts = yield self.mdb.cache.get_rollup_counts(
+                batch_key, direction, 'day')
+            if counts is not None:
+                returnValue([(bucket.date(), count)
+                             for bucket, count in counts])
         aggregate_keys = yield self.get_aggregate_keys(direction,
                                                         batch_key, bucket_func)
         returnValue([(bucket, len(keys)) for bucket, keys in aggregate_keys])
@@ -700,7 +883,7 @@ class ConversationWrapper(object):
         address_type = 'gtalk' if self.delivery_class == 'gtalk' else 'msisdn'
         contacts = yield contacts
         opt_out_store = OptOutStore(
-            self.api.manager, self.user_api.user_account_key)
+            self.api.manager, self.user_api.user_account_key, self.api.redis)
 
         addresses = self.get_contacts_addresses(contacts)
         opt_out_keys = yield opt_out_store.opt_outs_for_addresses(
@@ -720,11 +903,19 @@ class ConversationWrapper(object):
         Get a generator that produces batches the contacts with
         an address attribute that is appropriate for the conversation's
         delivery_class and that are opted in.
+
+        If the recipients were snapshotted when the conversation was
+        started, the contacts are those in the snapshot. They are checked
+        for opt-outs again because the snapshot may be old.
         """
         contact_store = self.user_api.contact_store
-        contact_keys = yield self.get_contact_keys()
-        contacts_iter = yield contact_store.contacts.load_all_bunches(
-                                                            contact_keys)
+        snapshot = self.recipient_snapshot()
+        if (yield snapshot.get_info()) is not None:
+            key_pages = yield snapshot.get_contact_key_pages()
+        else:
+            key_pages = yield (
+                contact_store.get_contact_key_pages_for_conversation(self.c))
+        contacts_iter = contact_store.load_contact_pages(key_pages)
 
         # We return a generator here. It's important that this is iterated over
         # slowly, otherwise we risk hammering our Riak servers to death.
@@ -734,3 +925,35 @@ class ConversationWrapper(object):
                 yield self._filter_opted_out_contacts(contacts_bunch)
 
         returnValue(opted_in_contacts_generator())
+
+    @Manager.calls_manager
+    def get_opted_in_address_bunches(self):
+        """
+        Like :meth:`get_opted_in_contact_bunches`, but the batches hold
+        :class:`go.vumitools.contact.ContactAddress` objects, which only
+        have the contact's key and addresses. This is much cheaper when
+        the rest of the contact isn't needed.
+
+        If the recipients were snapshotted when the conversation was
+        started, the batches come straight from the snapshot.
+        """
+        snapshot = self.recipient_snapshot()
+        if (yield snapshot.get_info()) is not None:
+            bunches = yield snapshot.get_recipient_bunches()
+        else:
+            bunches = yield self._get_opted_in_address_bunches()
+        returnValue(bunches)
+
+    @Manager.calls_manager
+    def _get_opted_in_address_bunches(self):
+        contact_store = self.user_api.contact_store
+        key_pages = yield contact_store.get_contact_key_pages_for_conversation(
+            self.c)
+        addresses_iter = contact_store.load_contact_address_pages(key_pages)
+
+        def opted_in_addresses_generator():
+            # NOTE: This is a generator, *not* an async flattener.
+            for addresses_bunch in addresses_iter:
+                yield self._filter_opted_out_contacts(addresses_bunch)
+
+        returnValue(opted_in_addresses_generator())
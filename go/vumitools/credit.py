@@ -2,12 +2,20 @@
 
 # TODO: create worker that updates Riak
 
-from twisted.internet.defer import returnValue
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, DeferredLock, gatherResults)
+from twisted.internet.task import LoopingCall
 
 from vumi.persist.redis_base import Manager
 
 
 class CreditManager(object):
+
+    # How many times to retry a debit that overdrew the balance because
+    # other debits were in flight at the same time.
+    max_debit_attempts = 3
+
     def __init__(self, redis):
         self.redis = redis
         self.manager = self.redis  # TODO: hack to make calls_manager work
@@ -35,13 +43,127 @@ class CreditManager(object):
 
     @Manager.calls_manager
     def debit(self, user_account_key, amount):
-        """Remove an amount of credits from a user account."""
+        """Remove an amount of credits from a user account.
+
+        :returns:
+           `True` if the account had enough credit, `False` otherwise (in
+           which case the account is left as it was).
+        """
+        debited = yield self.debit_many(user_account_key, amount, 1)
+        returnValue(debited == 1)
+
+    @Manager.calls_manager
+    def debit_many(self, user_account_key, amount, count):
+        """Remove `amount` credits from a user account for each of up to
+        `count` messages.
+
+        If there isn't enough credit for all of them, as many as can be
+        paid for are debited. An overdrawing debit is undone and retried
+        up to `max_debit_attempts` times, so it can fail under contention.
+
+        :returns:
+           The number of messages that were paid for.
+        """
+        if amount == 0 or count == 0:
+            returnValue(count)
         credit_key = self._credit_key(user_account_key)
-        new_amount = yield self.redis.incr(credit_key, -amount)
-        success = new_amount >= 0
-        if not success:
-            yield self.redis.incr(credit_key, amount)
-        returnValue(success)
+        for _attempt in range(self.max_debit_attempts):
+            total = amount * count
+            new_amount = yield self.redis.incr(credit_key, -total)
+            if new_amount >= 0:
+                returnValue(count)
+            restored_amount = yield self.redis.incr(credit_key, total)
+            count = min(count, max(restored_amount, 0) // amount)
+            if count == 0:
+                break
+        returnValue(0)
 
     def _credit_key(self, user_account_key):
         return ":".join(["credits", user_account_key])
+
+
+class CreditLeaseManager(object):
+    """Debits credits locally from blocks leased from a
+    :class:`CreditManager`.
+
+    When an account doesn't have enough leased credit left for a debit, a
+    new block is leased by debiting it from the account in Redis. Until
+    then debits don't touch Redis at all. Unused credit is returned to the
+    account every `reconcile_interval` seconds and when the lease manager
+    is stopped, so an account is never charged for more than it ends up
+    using. If the process dies, up to a block's worth of credit per account
+    is lost but it is never overspent.
+
+    This is only meant for use from async code such as transport
+    middleware.
+
+    :param CreditManager cm:
+        The credit manager to lease credit from.
+    :param float reconcile_interval:
+        How often (in seconds) to return unused credit.
+    :param clock:
+        Something that provides `IReactorTime`. Defaults to the reactor.
+    """
+
+    def __init__(self, cm, reconcile_interval=60, clock=None):
+        self.cm = cm
+        self.reconcile_interval = reconcile_interval
+        self.clock = clock or reactor
+        self.leases = {}
+        self._locks = {}
+        self._reconciler = None
+
+    def start(self):
+        self._reconciler = LoopingCall(self.return_unused)
+        self._reconciler.clock = self.clock
+        self._reconciler.start(self.reconcile_interval, now=False)
+
+    def stop(self):
+        if self._reconciler is not None and self._reconciler.running:
+            self._reconciler.stop()
+        return self.return_unused()
+
+    def _lock(self, user_account_key):
+        return self._locks.setdefault(user_account_key, DeferredLock())
+
+    def get_leased_credit(self, user_account_key):
+        return self.leases.get(user_account_key, 0)
+
+    def debit(self, user_account_key, amount, lease_size):
+        """Debit `amount` credits from the account's lease, leasing at least
+        `lease_size` credits from the account first if there isn't enough
+        left.
+
+        :returns:
+           A Deferred that fires with `True` if the debit succeeded.
+        """
+        return self._lock(user_account_key).run(
+            self._debit, user_account_key, amount, lease_size)
+
+    @inlineCallbacks
+    def _debit(self, user_account_key, amount, lease_size):
+        leased = self.leases.pop(user_account_key, 0)
+        if leased < amount:
+            wanted = max(lease_size, amount) - leased
+            leased += yield self.cm.debit_many(user_account_key, 1, wanted)
+        if leased < amount:
+            # Don't hold on to credit that other workers might be able to
+            # use.
+            if leased:
+                yield self.cm.credit(user_account_key, leased)
+            returnValue(False)
+        self.leases[user_account_key] = leased - amount
+        returnValue(True)
+
+    def return_unused(self):
+        """Return all unused leased credit to the accounts it came from."""
+        return gatherResults([
+            self._lock(user_account_key).run(self._return_unused,
+                                             user_account_key)
+            for user_account_key in self.leases.keys()])
+
+    @inlineCallbacks
+    def _return_unused(self, user_account_key):
+        leased = self.leases.pop(user_account_key, 0)
+        if leased:
+            yield self.cm.credit(user_account_key, leased)
@@ -0,0 +1,323 @@
+# -*- test-case-name: go.vumitools.tests.test_message_search -*-
+import re
+
+from twisted.internet.defer import returnValue
+from vumi.persist.redis_base import Manager
+
+from go.vumitools.utils import GoMessageMetadata, gather_results
+
+
+class MessageSearchIndex(object):
+    """
+    An opt-in inverted index of the messages in a batch, kept in Redis.
+
+    The words in a message's content and its `from:<addr>` and `to:<addr>`
+    addresses are its terms. The content of sensitive messages isn't
+    indexed. Each term has a sorted set of the keys of the messages it
+    appears in, scored by message timestamp. The first time a term is seen
+    in a batch it is also added to a set of terms for each of its prefixes
+    (from `MIN_PREFIX_LENGTH` up to `MAX_PREFIX_LENGTH` characters), which
+    is how queries find the terms that start with a word.
+
+    Only messages in batches added with :meth:`enable_batch` are indexed.
+    A batch's index is only used for queries once it is complete, either
+    because it was enabled before any messages were stored in the batch or
+    because the messages stored before that have been indexed since.
+
+    Queries are made up of words, which must all match the start of a term.
+    `-word` excludes messages with a term starting with `word` and `OR`
+    separates alternatives, e.g. `from:+2783 -stop OR help`. A trailing `*`
+    is allowed, as in the message store's regex search. Queries that would
+    have to look up more than `MAX_PREFIX_TERMS` terms for a word, or load
+    more than `MAX_POSTINGS` message keys for one, aren't answered.
+    """
+
+    MIN_PREFIX_LENGTH = 2
+    MAX_PREFIX_LENGTH = 12
+
+    # Bounds on the work done for a query.
+    MAX_PREFIX_TERMS = 100
+    MAX_POSTINGS = 10000
+    MAX_SCORE_CHECKS = 200
+
+    ADDR_FIELDS = {
+        'from': 'from_addr',
+        'to': 'to_addr',
+    }
+
+    WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+    def __init__(self, redis):
+        self.redis = self.manager = redis
+
+    def enabled_key(self):
+        return 'enabled_batches'
+
+    def complete_key(self):
+        return 'complete_batches'
+
+    def postings_key(self, batch_id, direction, kind, term):
+        return u':'.join([batch_id, direction, kind, term])
+
+    def terms_key(self, batch_id, direction):
+        return u'%s:%s:terms' % (batch_id, direction)
+
+    def batch_postings_key(self, batch_id):
+        return u'%s:postings' % (batch_id,)
+
+    @Manager.calls_manager
+    def enable_batch(self, batch_id, complete=False):
+        """
+        Index messages stored in `batch_id` from now on. If `complete` is
+        set (because nothing has been stored in the batch yet) the index is
+        used for queries straight away.
+        """
+        yield self.redis.sadd(self.enabled_key(), batch_id)
+        if complete:
+            yield self.mark_complete(batch_id)
+
+    def is_enabled(self, batch_id):
+        return self.redis.sismember(self.enabled_key(), batch_id)
+
+    def mark_complete(self, batch_id):
+        return self.redis.sadd(self.complete_key(), batch_id)
+
+    def mark_incomplete(self, batch_id):
+        return self.redis.srem(self.complete_key(), batch_id)
+
+    def is_complete(self, batch_id):
+        return self.redis.sismember(self.complete_key(), batch_id)
+
+    @Manager.calls_manager
+    def clear_batch(self, batch_id):
+        """
+        Remove everything indexed for `batch_id`, but leave it enabled.
+        """
+        batch_postings_key = self.batch_postings_key(batch_id)
+        postings_keys = yield self.redis.smembers(batch_postings_key)
+        for postings_key in postings_keys:
+            yield self.redis.delete(postings_key)
+        yield self.redis.delete(batch_postings_key)
+
+    def _split_term(self, term):
+        field, sep, value = term.partition(u':')
+        if sep and field in self.ADDR_FIELDS:
+            return field + sep, value
+        return u'', term
+
+    def message_terms(self, msg):
+        terms = set()
+        if not GoMessageMetadata(None, msg).is_sensitive():
+            terms.update(word.lower() for word in
+                         self.WORD_RE.findall(msg['content'] or u''))
+        for field, msg_field in self.ADDR_FIELDS.iteritems():
+            if msg[msg_field]:
+                terms.add(u'%s:%s' % (field, msg[msg_field].lower()))
+        return terms
+
+    def term_prefixes(self, term):
+        field, value = self._split_term(term)
+        stop = min(len(value), self.MAX_PREFIX_LENGTH)
+        return [field + value[:i]
+                for i in range(self.MIN_PREFIX_LENGTH, stop + 1)]
+
+    @Manager.calls_manager
+    def index_message(self, batch_id, direction, msg, timestamp):
+        """
+        Index `msg` as one of the `direction` ('inbound' or 'outbound')
+        messages in `batch_id`, if the batch is enabled.
+        """
+        enabled = yield self.is_enabled(batch_id)
+        if not enabled:
+            return
+        terms = sorted(self.message_terms(msg))
+        if not terms:
+            return
+        message_key = msg['message_id'].encode('utf-8')
+        terms_key = self.terms_key(batch_id, direction)
+        postings_keys = [self.postings_key(batch_id, direction, 'term', term)
+                         for term in terms]
+        results = yield gather_results(
+            [self.redis.sadd(terms_key, term) for term in terms] +
+            [self.redis.zadd(postings_key, **{message_key: timestamp})
+             for postings_key in postings_keys])
+
+        # Only terms that are new to the batch need adding to the prefix
+        # sets, which keeps the number of writes per message down.
+        new_keys = set()
+        additions = []
+        new_terms = results[:len(terms)]
+        for term, postings_key, added in zip(terms, postings_keys, new_terms):
+            if not added:
+                continue
+            new_keys.update([terms_key, postings_key])
+            for prefix in self.term_prefixes(term):
+                prefix_key = self.postings_key(
+                    batch_id, direction, 'prefix', prefix)
+                new_keys.add(prefix_key)
+                additions.append(self.redis.sadd(prefix_key, term))
+        if new_keys:
+            yield gather_results(additions + [
+                self.redis.sadd(self.batch_postings_key(batch_id),
+                                *new_keys)])
+
+    def _parse_word(self, word):
+        if word.endswith(u'*'):
+            word = word[:-1]
+        field, value = self._split_term(word.lower())
+        if field:
+            words = [value] if value else []
+        else:
+            words = self.WORD_RE.findall(value)
+        if not words or len(words[-1]) < self.MIN_PREFIX_LENGTH:
+            return None
+        # Only the last word of something like `don't` can be the start of
+        # a longer term.
+        lookups = [('term', field + w) for w in words[:-1]]
+        lookups.append(('prefix', field + words[-1]))
+        return lookups
+
+    def parse_query(self, query):
+        """
+        Return the clauses of `query` as a list of `(include, exclude)`
+        tuples of the `(kind, term)` lookups that a message must (or must
+        not) match, or `None` if the index can't answer the query.
+        """
+        clauses = []
+        include, exclude = [], []
+        for word in query.split():
+            if word == u'OR':
+                clauses.append((include, exclude))
+                include, exclude = [], []
+                continue
+            negated = word.startswith(u'-')
+            lookups = self._parse_word(word[1:] if negated else word)
+            if lookups is None:
+                return None
+            if negated:
+                if len(lookups) > 1:
+                    return None
+                exclude.extend(lookups)
+            else:
+                include.extend(lookups)
+        clauses.append((include, exclude))
+        # We can't list the messages that don't match something.
+        if not all(include for include, _ in clauses):
+            return None
+        return clauses
+
+    @Manager.calls_manager
+    def lookup_postings_keys(self, batch_id, direction, lookup):
+        """
+        Return the postings keys of the terms that `lookup` matches, or
+        `None` if a prefix matches more than `MAX_PREFIX_TERMS` terms.
+        """
+        kind, term = lookup
+        if kind == 'term':
+            returnValue([self.postings_key(batch_id, direction, kind, term)])
+        # Longer prefixes are found among the terms of the longest prefix
+        # that is indexed.
+        field, value = self._split_term(term)
+        prefix_key = self.postings_key(
+            batch_id, direction, 'prefix',
+            field + value[:self.MAX_PREFIX_LENGTH])
+        count = yield self.redis.scard(prefix_key)
+        if count > self.MAX_PREFIX_TERMS:
+            returnValue(None)
+        terms = yield self.redis.smembers(prefix_key)
+        terms = [t.decode('utf-8') for t in terms]
+        returnValue([self.postings_key(batch_id, direction, 'term', t)
+                     for t in sorted(terms) if t.startswith(term)])
+
+    @Manager.calls_manager
+    def load_postings(self, postings_keys):
+        """
+        Return a dict of the message keys in `postings_keys` and their
+        timestamps.
+        """
+        results = yield gather_results([
+            self.redis.zrange(postings_key, 0, -1, withscores=True)
+            for postings_key in postings_keys])
+        postings = {}
+        for result in results:
+            postings.update(result)
+        returnValue(postings)
+
+    @Manager.calls_manager
+    def find_message_keys(self, postings_keys, size, message_keys):
+        """
+        Return the set of `message_keys` that are in any of `postings_keys`,
+        which hold `size` message keys between them. A few message keys are
+        checked one by one, otherwise the postings are loaded if there
+        aren't more than `MAX_POSTINGS` of them. Returns `None` if there
+        are.
+        """
+        message_keys = list(message_keys)
+        checks = len(message_keys) * len(postings_keys)
+        if checks <= self.MAX_SCORE_CHECKS:
+            scores = yield gather_results([
+                self.redis.zscore(postings_key, message_key)
+                for message_key in message_keys
+                for postings_key in postings_keys])
+            returnValue(set(
+                message_key for i, message_key in enumerate(message_keys)
+                if any(score is not None for score in scores[
+                    i * len(postings_keys):(i + 1) * len(postings_keys)])))
+        if size > self.MAX_POSTINGS:
+            returnValue(None)
+        postings = yield self.load_postings(postings_keys)
+        returnValue(set(postings).intersection(message_keys))
+
+    @Manager.calls_manager
+    def search(self, batch_id, direction, query):
+        """
+        Return the keys of the `direction` messages in `batch_id` that match
+        `query`, newest first, or `None` if the batch's index isn't complete
+        or the index can't answer the query.
+        """
+        clauses = self.parse_query(query)
+        if clauses is None:
+            returnValue(None)
+        complete = yield self.is_complete(batch_id)
+        if not complete:
+            returnValue(None)
+
+        lookups = sorted(set(lookup for include, exclude in clauses
+                             for lookup in include + exclude))
+        results = yield gather_results([
+            self.lookup_postings_keys(batch_id, direction, lookup)
+            for lookup in lookups])
+        if None in results:
+            returnValue(None)
+        postings_keys = dict(zip(lookups, results))
+        all_postings_keys = sorted(set(
+            postings_key for keys in results for postings_key in keys))
+        counts = yield gather_results([
+            self.redis.zcard(postings_key)
+            for postings_key in all_postings_keys])
+        counts = dict(zip(all_postings_keys, counts))
+        sizes = dict((lookup, sum(counts[postings_key]
+                                  for postings_key in postings_keys[lookup]))
+                     for lookup in lookups)
+
+        matches = {}
+        for include, exclude in clauses:
+            # Start with the rarest lookup so that there's less to check.
+            include = sorted(include, key=lambda lookup: sizes[lookup])
+            if sizes[include[0]] > self.MAX_POSTINGS:
+                returnValue(None)
+            found = yield self.load_postings(postings_keys[include[0]])
+            for lookup in include[1:] + exclude:
+                if not found:
+                    break
+                keep = lookup in include
+                matched = yield self.find_message_keys(
+                    postings_keys[lookup], sizes[lookup], found.keys())
+                if matched is None:
+                    returnValue(None)
+                found = dict((key, score) for key, score in found.iteritems()
+                             if (key in matched) == keep)
+            matches.update(found)
+        returnValue([key for key, score in sorted(
+            matches.iteritems(), key=lambda (key, score): (score, key),
+            reverse=True)])
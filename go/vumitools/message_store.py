@@ -0,0 +1,560 @@
+# -*- test-case-name: go.vumitools.tests.test_message_store -*-
+
+"""Go's extensions to the vumi message store."""
+
+from collections import defaultdict
+from datetime import datetime
+
+from twisted.internet.defer import returnValue
+
+from vumi.components.message_store import MessageStore
+from vumi.components.message_store_cache import MessageStoreCache
+from vumi.persist.redis_base import Manager
+
+from go.vumitools.cache import LRUCache
+from go.vumitools.message_search import MessageSearchIndex
+from go.vumitools.utils import gather_results, load_bunches
+
+
+class GoMessageStoreCache(MessageStoreCache):
+    """
+    A :class:`MessageStoreCache` that also rolls the per-batch event status
+    counters up into per-conversation counters.
+
+    The extra indexes kept here are only up to date for batches whose
+    messages and events are all cached by this class rather than by a plain
+    :class:`MessageStoreCache`, for example because the transports store
+    them with :class:`go.vumitools.middleware.GoStoringMiddleware`. Such a
+    batch is marked as maintained when the first message or event for it is
+    cached here, and readers only trust the extra indexes for batches that
+    are marked. A batch that already had something cached when this class
+    first saw it is left unmarked until it is reconciled.
+
+    A batch is only counted towards its conversation once it has been
+    linked to it with :meth:`add_conversation_batch`, which needs to happen
+    before any messages are stored for the batch. The conversation keeps a
+    set of the batches that are counted so that readers can tell whether
+    the conversation counters are complete.
+
+    Each conversation also has a sorted set of its batches scored by the
+    timestamp of their latest outbound message, which answers which batch
+    was used last without looking at each batch's outbound keys.
+
+    Inbound and outbound message counts for each batch are also rolled up
+    into minute, hour and day buckets as the messages are cached. A batch's
+    rollups are only complete if it is maintained, or if they were rebuilt
+    with :meth:`rebuild_rollups`, which readers can check with
+    :meth:`get_rollup_counts`.
+
+    Messages in batches that have opted in are also added to a
+    :class:`MessageSearchIndex` as they are cached. Like the other extra
+    indexes, the search index is only used for batches that are maintained,
+    see :meth:`search_messages`.
+    """
+    CONVERSATION_KEY = 'conversations'
+    MAINTAINED_BATCHES_KEY = 'maintained_batches'
+    ROLLUP_BATCHES_KEY = 'rollup_batches'
+
+    # The formats of the rollup buckets for each granularity, which sort in
+    # time order. Buckets are in local time, like the timestamps the cache
+    # stores.
+    ROLLUP_FORMATS = {
+        'minute': '%Y-%m-%dT%H:%M',
+        'hour': '%Y-%m-%dT%H',
+        'day': '%Y-%m-%d',
+    }
+
+    def __init__(self, redis):
+        super(GoMessageStoreCache, self).__init__(redis)
+        # A batch never moves to another conversation.
+        self.batch_conversations = LRUCache(max_size=10000)
+        # A batch stays maintained until it is cleared.
+        self.maintained_batches = LRUCache(max_size=10000)
+        self.search_index = MessageSearchIndex(
+            redis.sub_manager('search_index'))
+
+    def batch_conversation_key(self, batch_id):
+        return self.batch_key('conversation', batch_id)
+
+    def conversation_key(self, *args):
+        return self.key(self.CONVERSATION_KEY, *args)
+
+    def conversation_status_key(self, conversation_key):
+        return self.conversation_key('status', conversation_key)
+
+    def conversation_batches_key(self, conversation_key):
+        return self.conversation_key('batches', conversation_key)
+
+    def conversation_last_outbound_key(self, conversation_key):
+        return self.conversation_key('last_outbound', conversation_key)
+
+    def rollup_key(self, batch_id, direction, granularity):
+        return self.batch_key('rollup', direction, granularity, batch_id)
+
+    def rollup_batches_key(self):
+        return self.key(self.ROLLUP_BATCHES_KEY)
+
+    def maintained_batches_key(self):
+        return self.key(self.MAINTAINED_BATCHES_KEY)
+
+    def is_maintained(self, batch_id):
+        """
+        Return `True` if every message and event in `batch_id` has been
+        cached by this class.
+        """
+        return self.redis.sismember(self.maintained_batches_key(), batch_id)
+
+    @Manager.calls_manager
+    def track_batch(self, batch_id):
+        """
+        Mark `batch_id` as maintained if nothing has been cached for it yet.
+        This is called before each message or event is cached and returns
+        whether the batch is maintained.
+        """
+        if self.maintained_batches.get(batch_id):
+            returnValue(True)
+        maintained = yield self.is_maintained(batch_id)
+        if not maintained:
+            sizes = yield gather_results([
+                self.inbound_message_keys_size(batch_id),
+                self.outbound_message_keys_size(batch_id),
+                self.redis.scard(self.event_key(batch_id)),
+                ])
+            if any(sizes):
+                returnValue(False)
+            yield gather_results([
+                self.redis.sadd(self.maintained_batches_key(), batch_id),
+                # Everything in the batch is rolled up from now on too.
+                self.redis.sadd(self.rollup_batches_key(), batch_id),
+                ])
+        self.maintained_batches.set(batch_id, True)
+        returnValue(True)
+
+    @Manager.calls_manager
+    def add_conversation_batch(self, conversation_key, batch_id):
+        """
+        Count events for `batch_id` towards `conversation_key`'s status
+        counters from now on.
+        """
+        yield self.redis.set(self.batch_conversation_key(batch_id),
+                             conversation_key)
+        yield self.redis.sadd(self.conversation_batches_key(conversation_key),
+                              batch_id)
+        self.batch_conversations.set(batch_id, conversation_key)
+
+    @Manager.calls_manager
+    def rebuild_conversation_status(self, conversation_key):
+        """
+        Recount `conversation_key`'s status counters from the event status
+        of each of the batches counted towards it.
+        """
+        batch_ids = yield self.redis.smembers(
+            self.conversation_batches_key(conversation_key))
+        batch_statuses = yield gather_results(
+            [self.get_event_status(batch_id) for batch_id in batch_ids])
+        stats = defaultdict(int)
+        for batch_status in batch_statuses:
+            for event_type, count in batch_status.iteritems():
+                stats[event_type] += count
+        status_key = self.conversation_status_key(conversation_key)
+        yield self.redis.delete(status_key)
+        # Only counters that have been incremented are kept, as they are
+        # when the counters are kept as events arrive.
+        stats = dict((k, v) for k, v in stats.iteritems() if v)
+        if stats:
+            yield self.redis.hmset(status_key, stats)
+
+    @Manager.calls_manager
+    def remove_conversation_batch(self, batch_id):
+        """
+        Stop counting `batch_id` towards its conversation. The
+        conversation's counters are incomplete from then on.
+        """
+        conversation_key = yield self.get_batch_conversation(batch_id)
+        if conversation_key is None:
+            return
+        self.batch_conversations.delete(batch_id)
+        yield self.redis.delete(self.batch_conversation_key(batch_id))
+        yield self.redis.srem(self.conversation_batches_key(conversation_key),
+                              batch_id)
+        yield self.redis.zrem(
+            self.conversation_last_outbound_key(conversation_key), batch_id)
+
+    @Manager.calls_manager
+    def get_batch_conversation(self, batch_id):
+        conversation_key = self.batch_conversations.get(batch_id)
+        if conversation_key is None:
+            conversation_key = yield self.redis.get(
+                self.batch_conversation_key(batch_id))
+            if conversation_key is not None:
+                self.batch_conversations.set(batch_id, conversation_key)
+        returnValue(conversation_key)
+
+    @Manager.calls_manager
+    def increment_event_status(self, batch_id, event_type):
+        _, conversation_key = yield gather_results([
+            super(GoMessageStoreCache, self).increment_event_status(
+                batch_id, event_type),
+            self.get_batch_conversation(batch_id),
+            ])
+        if conversation_key is not None:
+            yield self.redis.hincrby(
+                self.conversation_status_key(conversation_key), event_type, 1)
+
+    @Manager.calls_manager
+    def clear_batch(self, batch_id):
+        yield super(GoMessageStoreCache, self).clear_batch(batch_id)
+        self.maintained_batches.delete(batch_id)
+        yield self.redis.srem(self.maintained_batches_key(), batch_id)
+        yield self.clear_rollups(batch_id)
+        yield self.search_index.clear_batch(batch_id)
+
+    @Manager.calls_manager
+    def clear_rollups(self, batch_id):
+        yield self.redis.srem(self.rollup_batches_key(), batch_id)
+        for direction in ('inbound', 'outbound'):
+            for granularity in self.ROLLUP_FORMATS:
+                yield self.redis.delete(
+                    self.rollup_key(batch_id, direction, granularity))
+
+    @Manager.calls_manager
+    def increment_rollups(self, batch_id, direction, timestamp):
+        dt = datetime.fromtimestamp(timestamp)
+        yield gather_results([
+            self.redis.hincrby(
+                self.rollup_key(batch_id, direction, granularity),
+                dt.strftime(bucket_format), 1)
+            for granularity, bucket_format in self.ROLLUP_FORMATS.iteritems()])
+
+    def _rolls_up(self, batch_id, maintained):
+        # Rollups are kept for maintained batches and for batches whose
+        # rollups have been rebuilt. Nothing reads them for other batches.
+        if maintained:
+            return True
+        return self.redis.sismember(self.rollup_batches_key(), batch_id)
+
+    @Manager.calls_manager
+    def search_messages(self, batch_id, direction, query):
+        """
+        Return the keys of the `direction` messages in `batch_id` matching
+        `query` from the search index, newest first, or `None` if the index
+        can't answer the query. Messages that weren't cached by this class
+        aren't indexed, so the index isn't used for batches that aren't
+        maintained.
+        """
+        maintained = yield self.is_maintained(batch_id)
+        if not maintained:
+            returnValue(None)
+        keys = yield self.search_index.search(batch_id, direction, query)
+        returnValue(keys)
+
+    # The methods below are called for every message and event stored, so
+    # the Redis calls that don't depend on each other are made together.
+    # Calls to an async manager are made over a single connection and run
+    # in the order they're made, so a score read in the same batch of
+    # calls as the write that changes it sees the old value.
+
+    @Manager.calls_manager
+    def add_inbound_message(self, batch_id, msg):
+        timestamp = self.get_timestamp(msg['timestamp'])
+        maintained = yield self.track_batch(batch_id)
+        calls = [
+            self._add_inbound_message_key(
+                batch_id, msg['message_id'], timestamp, maintained),
+            self.add_from_addr(batch_id, msg['from_addr'], timestamp),
+            ]
+        # The search index is only used for maintained batches.
+        if maintained:
+            calls.append(self.search_index.index_message(
+                batch_id, 'inbound', msg, timestamp))
+        yield gather_results(calls)
+
+    @Manager.calls_manager
+    def add_outbound_message(self, batch_id, msg):
+        timestamp = self.get_timestamp(msg['timestamp'])
+        maintained = yield self.track_batch(batch_id)
+        calls = [
+            self._add_outbound_message_key(
+                batch_id, msg['message_id'], timestamp, maintained),
+            self.add_to_addr(batch_id, msg['to_addr'], timestamp),
+            ]
+        if maintained:
+            calls.append(self.search_index.index_message(
+                batch_id, 'outbound', msg, timestamp))
+        yield gather_results(calls)
+
+    @Manager.calls_manager
+    def add_event(self, batch_id, event):
+        new_entry = yield self.add_event_key(batch_id, event['event_id'])
+        if new_entry:
+            event_type = event['event_type']
+            event_types = [event_type]
+            if event_type == 'delivery_report':
+                event_types.append(
+                    '%s.%s' % (event_type, event['delivery_status']))
+            yield gather_results([
+                self.increment_event_status(batch_id, status_type)
+                for status_type in event_types])
+
+    @Manager.calls_manager
+    def add_event_key(self, batch_id, event_key):
+        yield self.track_batch(batch_id)
+        new_entry = yield super(GoMessageStoreCache, self).add_event_key(
+            batch_id, event_key)
+        returnValue(new_entry)
+
+    @Manager.calls_manager
+    def add_inbound_message_key(self, batch_id, message_key, timestamp):
+        maintained = yield self.track_batch(batch_id)
+        yield self._add_inbound_message_key(
+            batch_id, message_key, timestamp, maintained)
+
+    @Manager.calls_manager
+    def _add_inbound_message_key(self, batch_id, message_key, timestamp,
+                                 maintained):
+        # Messages that are cached again mustn't be counted twice.
+        old_timestamp, _, rolls_up = yield gather_results([
+            self.redis.zscore(self.inbound_key(batch_id), message_key),
+            super(GoMessageStoreCache, self).add_inbound_message_key(
+                batch_id, message_key, timestamp),
+            self._rolls_up(batch_id, maintained),
+            ])
+        if old_timestamp is None and rolls_up:
+            yield self.increment_rollups(batch_id, 'inbound', timestamp)
+
+    @Manager.calls_manager
+    def add_outbound_message_key(self, batch_id, message_key, timestamp):
+        maintained = yield self.track_batch(batch_id)
+        yield self._add_outbound_message_key(
+            batch_id, message_key, timestamp, maintained)
+
+    @Manager.calls_manager
+    def _add_outbound_message_key(self, batch_id, message_key, timestamp,
+                                  maintained):
+        old_timestamp, _, rolls_up, conversation_key = yield gather_results([
+            self.redis.zscore(self.outbound_key(batch_id), message_key),
+            super(GoMessageStoreCache, self).add_outbound_message_key(
+                batch_id, message_key, timestamp),
+            self._rolls_up(batch_id, maintained),
+            self.get_batch_conversation(batch_id),
+            ])
+        updates = []
+        if old_timestamp is None and rolls_up:
+            updates.append(
+                self.increment_rollups(batch_id, 'outbound', timestamp))
+        if conversation_key is not None:
+            updates.append(self.update_last_outbound(
+                conversation_key, batch_id, timestamp))
+        yield gather_results(updates)
+
+    @Manager.calls_manager
+    def update_last_outbound(self, conversation_key, batch_id, timestamp):
+        last_outbound_key = self.conversation_last_outbound_key(
+            conversation_key)
+        # Messages aren't necessarily stored in the order they were sent.
+        last_timestamp = yield self.redis.zscore(last_outbound_key, batch_id)
+        if last_timestamp is None or timestamp > float(last_timestamp):
+            yield self.redis.zadd(last_outbound_key, **{
+                batch_id.encode('utf-8'): timestamp,
+            })
+
+    @Manager.calls_manager
+    def rebuild_rollups(self, batch_id):
+        """
+        Recount the rollups for `batch_id` from the message keys in the
+        cache and mark them as complete. Returns the number of messages
+        counted.
+
+        Batches that use counters only keep their most recent message keys
+        in the cache, so older messages in them can't be counted. Messages
+        stored later without going through this class (by vumi's plain
+        `StoringMiddleware`, for example) aren't rolled up, so only rebuild
+        batches that are stored with `GoStoringMiddleware`.
+        """
+        total = 0
+        for direction, get_message_keys in [
+                ('inbound', self.get_inbound_message_keys),
+                ('outbound', self.get_outbound_message_keys)]:
+            keys = yield get_message_keys(batch_id, with_timestamp=True)
+            rollups = dict((granularity, defaultdict(int))
+                           for granularity in self.ROLLUP_FORMATS)
+            for _key, timestamp in keys:
+                dt = datetime.fromtimestamp(timestamp)
+                for granularity, buckets in rollups.iteritems():
+                    buckets[dt.strftime(self.ROLLUP_FORMATS[granularity])] += 1
+            for granularity, buckets in rollups.iteritems():
+                rollup_key = self.rollup_key(batch_id, direction, granularity)
+                yield self.redis.delete(rollup_key)
+                if buckets:
+                    yield self.redis.hmset(rollup_key, dict(buckets))
+            total += len(keys)
+        yield self.redis.sadd(self.rollup_batches_key(), batch_id)
+        returnValue(total)
+
+    @Manager.calls_manager
+    def get_rollup_counts(self, batch_id, direction, granularity='day',
+                          start=None, end=None):
+        """
+        Return a list of `(bucket, count)` tuples for the `direction`
+        ('inbound' or 'outbound') messages in `batch_id`, where `bucket` is
+        the datetime that the `granularity` ('minute', 'hour' or 'day')
+        bucket starts at. Only buckets with messages are included.
+
+        :param datetime start:
+            If given, leave out buckets before the one containing `start`.
+        :param datetime end:
+            If given, leave out buckets after the one containing `end`.
+
+        Returns `None` if the rollups for the batch aren't complete.
+        """
+        if granularity not in self.ROLLUP_FORMATS:
+            raise ValueError("Unknown rollup granularity: %r" % (granularity,))
+        bucket_format = self.ROLLUP_FORMATS[granularity]
+        rolled_up, counts = yield gather_results([
+            self.redis.sismember(self.rollup_batches_key(), batch_id),
+            self.redis.hgetall(
+                self.rollup_key(batch_id, direction, granularity)),
+            ])
+        if not rolled_up:
+            returnValue(None)
+        first = start.strftime(bucket_format) if start is not None else None
+        last = end.strftime(bucket_format) if end is not None else None
+        returnValue([
+            (datetime.strptime(bucket, bucket_format), int(count))
+            for bucket, count in sorted(counts.iteritems())
+            if (first is None or bucket >= first) and
+            (last is None or bucket <= last)])
+
+    @Manager.calls_manager
+    def get_conversation_batches_by_activity(self, conversation_key,
+                                             batch_ids):
+        """
+        Return those of `batch_ids` that have outbound messages, most
+        recently used first, or `None` if some of the batches aren't
+        counted in the conversation's index. Batches that aren't maintained
+        are only allowed if they have no outbound messages, because nothing
+        they have can be more recent.
+        """
+        results = yield gather_results([
+            self.redis.smembers(
+                self.conversation_batches_key(conversation_key)),
+            self.redis.zrange(
+                self.conversation_last_outbound_key(conversation_key),
+                0, -1, desc=True),
+            ] + [self.is_maintained(batch_id) for batch_id in batch_ids])
+        counted_batch_ids, last_outbound, maintained = (
+            results[0], results[1], results[2:])
+        if not set(batch_ids).issubset(counted_batch_ids):
+            returnValue(None)
+        unmaintained_sizes = yield gather_results([
+            self.outbound_message_keys_size(batch_id)
+            for batch_id, marked in zip(batch_ids, maintained)
+            if not marked])
+        if any(unmaintained_sizes):
+            returnValue(None)
+        batch_ids = set(batch_ids)
+        returnValue([batch_id for batch_id in last_outbound
+                     if batch_id in batch_ids])
+
+    @Manager.calls_manager
+    def get_conversation_event_status(self, conversation_key, batch_ids):
+        """
+        Return a dictionary containing the event stats for a conversation
+        with the given batches, or `None` if some of the batches aren't
+        counted in the conversation's counters or aren't maintained.
+
+        The counters and the set of counted batches are fetched at the same
+        time.
+        """
+        results = yield gather_results([
+            self.redis.smembers(
+                self.conversation_batches_key(conversation_key)),
+            self.redis.hgetall(
+                self.conversation_status_key(conversation_key)),
+            ] + [self.is_maintained(batch_id) for batch_id in batch_ids])
+        counted_batch_ids, stats, maintained = (
+            results[0], results[1], results[2:])
+        if not all(maintained):
+            returnValue(None)
+        if not set(batch_ids).issubset(counted_batch_ids):
+            returnValue(None)
+        returnValue(dict([(k, int(v)) for k, v in stats.iteritems()]))
+
+
+class GoMessageStore(MessageStore):
+    """A :class:`MessageStore` that uses a :class:`GoMessageStoreCache`."""
+
+    def __init__(self, manager, redis):
+        super(GoMessageStore, self).__init__(manager, redis)
+        self.cache = GoMessageStoreCache(redis)
+
+    @Manager.calls_manager
+    def reconcile_cache(self, batch_id):
+        # Reconciling recounts the batch from scratch, which would count it
+        # twice towards its conversation, so the batch is only linked to it
+        # again once the recount is done.
+        conversation_key = yield self.cache.get_batch_conversation(batch_id)
+        yield self.cache.remove_conversation_batch(batch_id)
+        # The search index is rebuilt along with the rest of the cache and
+        # shouldn't be used until it has been.
+        search_index = self.cache.search_index
+        indexed = yield search_index.is_complete(batch_id)
+        yield search_index.mark_incomplete(batch_id)
+        yield super(GoMessageStore, self).reconcile_cache(batch_id)
+        if conversation_key is not None:
+            yield self.relink_conversation_batch(conversation_key, batch_id)
+        if indexed:
+            yield search_index.mark_complete(batch_id)
+
+    @Manager.calls_manager
+    def relink_conversation_batch(self, conversation_key, batch_id):
+        yield self.cache.add_conversation_batch(conversation_key, batch_id)
+        yield self.cache.rebuild_conversation_status(conversation_key)
+        last_outbound = yield self.cache.get_outbound_message_keys(
+            batch_id, 0, 0, with_timestamp=True)
+        if last_outbound:
+            [(_, timestamp)] = last_outbound
+            yield self.cache.update_last_outbound(
+                conversation_key, batch_id, timestamp)
+
+    @Manager.calls_manager
+    def build_search_index(self, batch_id):
+        """
+        Start indexing the messages in `batch_id` for searching and index
+        the messages that have already been stored in it. Returns the number
+        of messages indexed. The index is only searched while the batch is
+        maintained, see :meth:`GoMessageStoreCache.search_messages`.
+        """
+        search_index = self.cache.search_index
+        yield search_index.enable_batch(batch_id)
+        count = 0
+        for direction, get_keys, proxy in [
+                ('inbound', self.batch_inbound_keys, self.inbound_messages),
+                ('outbound', self.batch_outbound_keys,
+                 self.outbound_messages)]:
+            keys = yield get_keys(batch_id)
+            for bunch in load_bunches(proxy, keys):
+                for message in (yield bunch):
+                    msg = message.msg
+                    yield search_index.index_message(
+                        batch_id, direction, msg,
+                        self.cache.get_timestamp(msg['timestamp']))
+                    count += 1
+        yield search_index.mark_complete(batch_id)
+        returnValue(count)
+
+    @Manager.calls_manager
+    def conversation_status(self, conversation_key, batch_ids):
+        """
+        Return the event stats for a conversation, summed over its batches.
+        """
+        status = yield self.cache.get_conversation_event_status(
+            conversation_key, batch_ids)
+        if status is None:
+            status = {}
+            batch_statuses = yield gather_results(
+                self.batch_status(batch_id) for batch_id in batch_ids)
+            for batch_status in batch_statuses:
+                for k, v in batch_status.items():
+                    status[k] = status.get(k, 0) + v
+        returnValue(status)
@@ -1,14 +1,33 @@
 # -*- test-case-name: go.vumitools.tests.test_metrics_worker -*-
 
-from twisted.internet.defer import inlineCallbacks
-from twisted.internet.task import LoopingCall
+import random
+from hashlib import md5
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred, gatherResults,
+    DeferredSemaphore)
+from twisted.internet.task import LoopingCall, deferLater
 
 from vumi import log
+from vumi.errors import ConfigError
 from vumi.service import Worker
+from vumi.blinkenlights.metrics import MetricManager, Metric, Count
 
 from go.vumitools.api import VumiApi, VumiApiCommand
 
 
+def shard_for_key(key, shard_count):
+    """
+    Return which of `shard_count` shards `key` belongs to.
+
+    This uses rendezvous hashing, so changing the number of shards only
+    moves the keys that have to move rather than reshuffling all of them.
+    """
+    return max(range(shard_count),
+               key=lambda shard: md5('%s:%s' % (shard, key)).hexdigest())
+
+
 class GoMetricsWorker(Worker):
     """A metrics collection worker for Go applications.
 
@@ -16,6 +35,28 @@ class GoMetricsWorker(Worker):
     collection and sending commands to the relevant application workers to
     trigger the actual metrics.
 
+    Accounts can be split across several metrics workers by giving each a
+    different `shard_index` and the same `shard_count`.
+
+    :param int metrics_interval:
+        How often (in seconds) to collect metrics. Defaults to 300.
+    :param int shard_count:
+        How many metrics workers the accounts are split across. Defaults
+        to 1.
+    :param int shard_index:
+        Which of the `shard_count` shards this worker collects metrics for.
+        Defaults to 0.
+    :param int max_concurrent_loads:
+        How many accounts' conversations to load at the same time.
+        Defaults to 5.
+    :param float metrics_jitter:
+        The fraction of `metrics_interval` over which to spread the
+        `collect_metrics` commands, so that the application workers aren't
+        all asked for metrics at once. Must be less than 1. Defaults to 0.
+    :param str worker_metrics_prefix:
+        The prefix for this worker's own metrics, `loop_duration` (how many
+        seconds finding the conversations took) and `skipped_cycles`.
+        Defaults to `go.metrics_worker.`.
     """
 
     worker_name = 'go_metrics'
@@ -23,6 +64,8 @@ class GoMetricsWorker(Worker):
     @inlineCallbacks
     def startWorker(self):
         self.validate_config()
+        self.clock = reactor
+        self._loop_running = False
 
         self.vumi_api = yield VumiApi.from_config_async(self.config)
         self.redis = self.vumi_api.redis
@@ -30,44 +73,109 @@ class GoMetricsWorker(Worker):
         self.command_publisher = yield self.publish_to(
             self.api_routing_config['routing_key'])
 
-        self._looper = LoopingCall(self.metrics_loop_func)
+        self.metric_manager = yield self.start_publisher(
+            MetricManager, self.worker_metrics_prefix)
+        self.loop_duration = self.metric_manager.register(
+            Metric('loop_duration'))
+        self.skipped_cycles = self.metric_manager.register(
+            Count('skipped_cycles'))
+
+        self._looper = LoopingCall(self.run_metrics_loop)
         self._looper.start(self.metrics_interval)
 
     def stopWorker(self):
         if self._looper.running:
             self._looper.stop()
+        self.metric_manager.stop()
         return self.redis.close_manager()
 
     def validate_config(self):
         self.metrics_interval = int(self.config.get('metrics_interval', 300))
         self.api_routing_config = VumiApiCommand.default_routing_config()
         self.api_routing_config.update(self.config.get('api_routing', {}))
+        self.shard_count = int(self.config.get('shard_count', 1))
+        self.shard_index = int(self.config.get('shard_index', 0))
+        self.max_concurrent_loads = int(
+            self.config.get('max_concurrent_loads', 5))
+        self.metrics_jitter = float(self.config.get('metrics_jitter', 0))
+        if not 0 <= self.metrics_jitter < 1:
+            raise ConfigError('metrics_jitter must be at least 0 and less '
+                              'than 1, not %s' % (self.metrics_jitter,))
+        self.worker_metrics_prefix = self.config.get(
+            'worker_metrics_prefix', 'go.metrics_worker.')
+
+    def run_metrics_loop(self):
+        """
+        Start a metrics collection run unless the previous one is still
+        going, in which case this cycle is skipped.
+        """
+        if self._loop_running:
+            log.warning("Previous metrics run hasn't finished, skipping.")
+            self.skipped_cycles.inc()
+            return
+        self._loop_running = True
+
+        def finish(result):
+            self._loop_running = False
+            return result
+
+        d = maybeDeferred(self.metrics_loop_func)
+        d.addBoth(finish)
+        d.addErrback(log.err)
 
     @inlineCallbacks
     def metrics_loop_func(self):
+        start = self.clock.seconds()
         account_keys = yield self.find_account_keys()
-        conversations = []
-        # We deliberarely serialise this. We don't want to hit the datastore
-        # too hard for metrics.
-        for account_key in account_keys:
-            convs = yield self.find_conversations_for_account(account_key)
-            conversations.extend(convs)
+        account_keys = [account_key for account_key in account_keys
+                        if self.is_our_account(account_key)]
+        conversations = yield self.find_conversations(account_keys)
+        # Sending the commands is spread out by the jitter, so it isn't
+        # counted.
+        self.loop_duration.set(self.clock.seconds() - start)
         log.info(
             "Processing metrics for %s conversations owned by %s users." % (
                 len(conversations), len(account_keys)))
-        for conversation in conversations:
-            yield self.send_metrics_command(conversation)
+        yield self.send_metrics_commands(conversations)
+
+    def is_our_account(self, account_key):
+        shard = shard_for_key(account_key, self.shard_count)
+        return shard == self.shard_index
 
     def find_account_keys(self):
         return self.redis.smembers('metrics_accounts')
 
+    @inlineCallbacks
+    def find_conversations(self, account_keys):
+        # We don't want to hit the datastore too hard for metrics, so only a
+        # few accounts are loaded at a time.
+        semaphore = DeferredSemaphore(self.max_concurrent_loads)
+        results = yield gatherResults([
+            semaphore.run(self.find_conversations_for_account, account_key)
+            for account_key in account_keys])
+        conversations = []
+        for convs in results:
+            conversations.extend(convs)
+        returnValue(conversations)
+
     def find_conversations_for_account(self, account_key):
         user_api = self.vumi_api.get_user_api(account_key)
-        return user_api.running_conversations()
+        return user_api.running_conversation_summaries()
+
+    def send_metrics_commands(self, conversations):
+        spread = self.metrics_interval * self.metrics_jitter
+        if not spread:
+            return gatherResults([
+                maybeDeferred(self.send_metrics_command, conversation)
+                for conversation in conversations])
+        return gatherResults([
+            deferLater(self.clock, random.uniform(0, spread),
+                       self.send_metrics_command, conversation)
+            for conversation in conversations])
 
     def send_metrics_command(self, conversation):
         cmd = VumiApiCommand.command(
             conversation.conversation_type, 'collect_metrics',
             conversation_key=conversation.key,
-            user_account_key=conversation.user_account.key)
+            user_account_key=conversation.user_account_key)
         return self.command_publisher.publish_message(cmd)
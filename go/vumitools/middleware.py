@@ -6,13 +6,14 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi.middleware.tagger import TaggingMiddleware
 from vumi.middleware.base import TransportMiddleware, BaseMiddleware
+from vumi.middleware.message_storing import StoringMiddleware
 from vumi.utils import normalize_msisdn
-from vumi.components.tagpool import TagpoolManager
 from vumi.blinkenlights.metrics import MetricManager, Count, Metric
 from vumi.persist.txredis_manager import TxRedisManager
 from vumi.errors import ConfigError
 
-from go.vumitools.credit import CreditManager
+from go.vumitools.credit import CreditLeaseManager
+from go.vumitools.message_store import GoMessageStore
 
 
 class NormalizeMsisdnMiddleware(TransportMiddleware):
@@ -96,21 +97,77 @@ class OptOutMiddleware(BaseMiddleware):
 
 
 class DebitAccountMiddleware(TransportMiddleware):
+    """
+    Transport middleware that debits the sending account for each outbound
+    message, according to the `credits_per_message` set in the metadata of
+    the message's tagpool.
+
+    Messages that have already been paid for (see
+    :meth:`add_prepaid_to_payload`) are let through without being debited
+    again.
+
+    :param str metrics_prefix:
+        If set, a `debit_latency` metric (in seconds) and an
+        `insufficient_credit` counter are published with this prefix.
+    :param int credit_lease_messages:
+        If set, credit is leased from each account in blocks big enough to
+        pay for this many messages (at the `credits_per_message` of the
+        tagpool being sent from) and debited locally, instead of going to
+        Redis for each message. See :class:`CreditLeaseManager`.
+    :param float credit_lease_reconcile_interval:
+        How often (in seconds) unused leased credit is returned to the
+        accounts it was leased from. Defaults to 60.
+    """
 
+    @inlineCallbacks
     def setup_middleware(self):
-        # TODO: There really needs to be a helper function to
-        #       turn this config into managers.
-        from go.vumitools.api import get_redis
-        r_server = get_redis(self.config)
-        tpm_config = self.config.get('tagpool_manager', {})
-        tpm_prefix = tpm_config.get('tagpool_prefix', 'tagpool_store')
-        self.tpm = TagpoolManager(r_server, tpm_prefix)
-        cm_config = self.config.get('credit_manager', {})
-        cm_prefix = cm_config.get('credit_prefix', 'credit_store')
-        self.cm = CreditManager(r_server, cm_prefix)
+        from go.vumitools.api import VumiApi
+        self.vumi_api = yield VumiApi.from_config_async(self.config)
+        self.tpm = self.vumi_api.tpm
+        self.cm = self.vumi_api.cm
+
+        self.credit_leases = None
+        self.credit_lease_messages = self.config.get('credit_lease_messages')
+        if self.credit_lease_messages is not None:
+            self.credit_leases = CreditLeaseManager(self.cm,
+                reconcile_interval=self.config.get(
+                    'credit_lease_reconcile_interval', 60))
+            self.credit_leases.start()
+
+        self.metric_manager = None
+        metrics_prefix = self.config.get('metrics_prefix')
+        if metrics_prefix is not None:
+            self.metric_manager = yield self.worker.start_publisher(
+                MetricManager, metrics_prefix)
+            self.debit_latency = self.metric_manager.register(
+                Metric('debit_latency'))
+            self.insufficient_credit = self.metric_manager.register(
+                Count('insufficient_credit'))
+
+    def teardown_middleware(self):
+        if self.metric_manager is not None:
+            self.metric_manager.stop()
+        if self.credit_leases is not None:
+            return self.credit_leases.stop()
 
+    def _debit(self, user_account_key, credits_per_message):
+        if self.credit_leases is None:
+            return self.cm.debit(user_account_key, credits_per_message)
+        return self.credit_leases.debit(user_account_key, credits_per_message,
+            credits_per_message * self.credit_lease_messages)
+
+    @inlineCallbacks
     def _credits_per_message(self, pool):
-        tagpool_metadata = self.tpm.get_metadata(pool)
+        tagpool_metadata = yield self.tpm.get_metadata(pool)
+        returnValue(self.parse_credits_per_message(pool, tagpool_metadata))
+
+    @staticmethod
+    def parse_credits_per_message(pool, tagpool_metadata):
+        """Return the `credits_per_message` set for a tagpool.
+
+        :raises BadTagPool:
+            if it is missing or isn't a non-negative integer.
+        """
         credits_per_message = tagpool_metadata.get('credits_per_message')
         try:
             credits_per_message = int(credits_per_message)
@@ -150,23 +207,42 @@ class DebitAccountMiddleware(TransportMiddleware):
         go_metadata = helper_metadata.setdefault('go', {})
         go_metadata['user_account'] = user_account_key
 
+    @staticmethod
+    def add_prepaid_to_payload(payload):
+        """Convenience method for marking a message payload as already paid
+        for (with :meth:`CreditManager.debit_many`, for example)."""
+        helper_metadata = payload.setdefault('helper_metadata', {})
+        go_metadata = helper_metadata.setdefault('go', {})
+        go_metadata['prepaid'] = True
+
+    @staticmethod
+    def is_prepaid_message(msg):
+        return msg['helper_metadata'].get('go', {}).get('prepaid', False)
+
+    @inlineCallbacks
     def handle_outbound(self, msg, endpoint):
         # TODO: what actually happens when we raise an exception from
         #       inside middleware?
+        if self.is_prepaid_message(msg):
+            returnValue(msg)
         user_account_key = self.map_msg_to_user(msg)
         if user_account_key is None:
             raise NoUserError(msg)
         tag = TaggingMiddleware.map_msg_to_tag(msg)
         if tag is None:
             raise NoTagError(msg)
-        credits_per_message = self._credits_per_message(tag[0])
-        self._debit_account(user_account_key, credits_per_message)
-        success = self.cm.debit(user_account_key, credits_per_message)
+        credits_per_message = yield self._credits_per_message(tag[0])
+        start = time.time()
+        success = yield self._debit(user_account_key, credits_per_message)
+        if self.metric_manager is not None:
+            self.debit_latency.set(time.time() - start)
         if not success:
+            if self.metric_manager is not None:
+                self.insufficient_credit.inc()
             raise InsufficientCredit("User %r has insufficient credit"
                                      " to debit %r." %
                                      (user_account_key, credits_per_message))
-        return msg
+        returnValue(msg)
 
 
 class MetricsMiddleware(BaseMiddleware):
@@ -303,3 +379,22 @@ class MetricsMiddleware(BaseMiddleware):
         self.increment_counter(endpoint, 'failure.%s' % (
             failure['failure_code'] or 'unspecified',))
         return failure
+
+
+class GoStoringMiddleware(StoringMiddleware):
+    """
+    A :class:`StoringMiddleware` that stores messages in a
+    :class:`GoMessageStore`, so that the extra indexes Go keeps in the
+    message store cache are maintained as messages and events are stored.
+    Batches stored with a plain :class:`StoringMiddleware` still work, but
+    readers fall back to the slower per-batch lookups for them.
+
+    Configured in the same way as :class:`StoringMiddleware`.
+    """
+
+    @inlineCallbacks
+    def setup_middleware(self):
+        yield super(GoStoringMiddleware, self).setup_middleware()
+        store_prefix = self.config.get('store_prefix', 'message_store')
+        self.store = GoMessageStore(self.store.manager,
+                                    self.redis.sub_manager(store_prefix))
@@ -8,6 +8,7 @@ from vumi.persist.model import Model, Manager
 from vumi.persist.fields import ForeignKey, Timestamp, Unicode
 
 from go.vumitools.account import UserAccount, PerAccountStore
+from go.vumitools.utils import gather_results
 
 
 class OptOut(Model):
@@ -18,12 +19,29 @@ class OptOut(Model):
 
 
 class OptOutStore(PerAccountStore):
+    """
+    Opt-outs for an account.
+
+    If the store has a Redis manager it also keeps a set of opted out
+    addresses per address type in Redis so that a whole bunch of addresses
+    can be checked without a Riak MapReduce. The index is only used once it
+    has been built with :meth:`rebuild_opt_out_index` (see the
+    `go_rebuild_opt_out_index` management command), or marked as built when
+    the account was created, until then lookups go to Riak.
+    """
+
+    INDEXED_KEY = 'opt_outs_indexed'
+    ADDR_TYPES_KEY = 'opt_out_addr_types'
+
     def setup_proxies(self):
         self.opt_outs = self.manager.proxy(OptOut)
 
     def opt_out_id(self, addr_type, addr_value):
         return "%s:%s" % (addr_type, addr_value)
 
+    def opt_out_index_key(self, addr_type):
+        return "opt_outs:%s" % (addr_type,)
+
     @Manager.calls_manager
     def new_opt_out(self, addr_type, addr_value, message):
         opt_out_id = self.opt_out_id(addr_type, addr_value)
@@ -31,8 +49,18 @@ class OptOutStore(PerAccountStore):
                 user_account=self.user_account_key,
                 message=message.get('message_id'))
         yield opt_out.save()
+        if self.redis is not None:
+            yield self._index_opt_out(addr_type, addr_value)
         returnValue(opt_out)
 
+    @Manager.calls_manager('redis')
+    def _index_opt_out(self, addr_type, addr_value):
+        yield self.redis.sadd(self.ADDR_TYPES_KEY, addr_type)
+        yield self.redis.sadd(self.opt_out_index_key(addr_type), addr_value)
+
+    def _unindex_opt_out(self, addr_type, addr_value):
+        return self.redis.srem(self.opt_out_index_key(addr_type), addr_value)
+
     def get_opt_out(self, addr_type, addr_value):
         return self.opt_outs.load(self.opt_out_id(addr_type, addr_value))
 
@@ -41,6 +69,8 @@ class OptOutStore(PerAccountStore):
         opt_out = yield self.get_opt_out(addr_type, addr_value)
         if opt_out:
             yield opt_out.delete()
+        if self.redis is not None:
+            yield self._unindex_opt_out(addr_type, addr_value)
 
     @Manager.calls_manager
     def list_opt_outs(self):
@@ -49,8 +79,59 @@ class OptOutStore(PerAccountStore):
         opt_outs = yield user_account.backlinks.optouts(self.manager)
         returnValue(opt_outs)
 
+    @Manager.calls_manager
     def opt_outs_for_addresses(self, addr_type, addresses):
-        keys = ["%s:%s" % (addr_type, address) for address in addresses]
-        mr = self.manager.mr_from_keys(self.opt_outs, keys)
-        mr.filter_not_found()
-        return mr.get_keys()
+        """
+        Return the opt-out keys for those of `addresses` that have opted
+        out.
+        """
+        addresses = list(addresses)
+        indexed = yield self.opt_out_index_built()
+        if not indexed:
+            keys = [self.opt_out_id(addr_type, address)
+                    for address in addresses]
+            mr = self.manager.mr_from_keys(self.opt_outs, keys)
+            mr.filter_not_found()
+            opt_out_keys = yield mr.get_keys()
+            returnValue(opt_out_keys)
+
+        index_key = self.opt_out_index_key(addr_type)
+        opted_out = yield gather_results(
+            self.redis.sismember(index_key, address)
+            for address in addresses)
+        returnValue([self.opt_out_id(addr_type, address)
+                     for address, is_opted_out in zip(addresses, opted_out)
+                     if is_opted_out])
+
+    @Manager.calls_manager
+    def opt_out_index_built(self):
+        if self.redis is None:
+            returnValue(False)
+        indexed = yield self.redis.exists(self.INDEXED_KEY)
+        returnValue(bool(indexed))
+
+    def mark_opt_out_index_built(self):
+        return self.redis.set(self.INDEXED_KEY, '1')
+
+    @Manager.calls_manager
+    def rebuild_opt_out_index(self):
+        """
+        Rebuild the Redis opt-out index from the opt-outs in Riak and mark
+        it as usable. Returns the number of opt-outs indexed.
+        """
+        if self.redis is None:
+            raise ValueError("Can't build an opt-out index without Redis.")
+        # Stop using the index while we rebuild it.
+        yield self.redis.delete(self.INDEXED_KEY)
+        addr_types = yield self.redis.smembers(self.ADDR_TYPES_KEY)
+        for addr_type in addr_types:
+            yield self.redis.delete(self.opt_out_index_key(addr_type))
+        yield self.redis.delete(self.ADDR_TYPES_KEY)
+
+        opt_out_keys = yield self.list_opt_outs()
+        for opt_out_key in opt_out_keys:
+            addr_type, _colon, addr_value = opt_out_key.partition(":")
+            yield self._index_opt_out(addr_type, addr_value)
+
+        yield self.mark_opt_out_index_built()
+        returnValue(len(opt_out_keys))
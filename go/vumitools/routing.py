@@ -0,0 +1,57 @@
+# -*- test-case-name: go.vumitools.tests.test_routing -*-
+
+from twisted.internet.defer import returnValue
+
+from vumi.persist.redis_base import Manager
+
+from go.vumitools.cache import LRUCache
+
+
+class ConversationRoutingIndex(object):
+    """
+    An index from batches to the conversations they belong to.
+
+    Routing an event used to mean loading the outbound message, its batch,
+    doing a 2i lookup for the batch's conversation and then loading that
+    conversation, all to find a conversation type. With this index only
+    the outbound message needs loading, for its batch key.
+
+    Batches are indexed when a conversation attaches them and never change
+    owner, so lookups are also kept in a process-local LRU cache without
+    an expiry time. There's one entry per batch, however many messages are
+    sent in it.
+    """
+
+    def __init__(self, redis, cache_size=10000):
+        self.manager = self.redis = redis
+        self.batch_cache = LRUCache(cache_size)
+
+    def batch_key(self, batch_id):
+        return 'batch:%s' % (batch_id,)
+
+    @Manager.calls_manager
+    def add_batch(self, batch_id, conversation_key, conversation_type,
+                  user_account_key):
+        """Record which conversation a batch belongs to."""
+        info = {
+            'conversation_key': conversation_key,
+            'conversation_type': conversation_type,
+            'user_account': user_account_key,
+        }
+        yield self.redis.hmset(self.batch_key(batch_id), info)
+        self.batch_cache.set(batch_id, info)
+
+    @Manager.calls_manager
+    def get_batch(self, batch_id):
+        """
+        Return a dictionary containing `conversation_key`,
+        `conversation_type` and `user_account` for the batch or `None` if
+        the batch isn't indexed.
+        """
+        info = self.batch_cache.get(batch_id)
+        if info is None:
+            info = yield self.redis.hgetall(self.batch_key(batch_id))
+            if not info:
+                return
+            self.batch_cache.set(batch_id, info)
+        returnValue(info)
@@ -0,0 +1,74 @@
+# -*- test-case-name: go.vumitools.tests.test_tagpool -*-
+
+from copy import deepcopy
+
+from twisted.internet.defer import returnValue
+
+from vumi.components.tagpool import TagpoolManager
+from vumi.persist.redis_base import Manager
+
+from go.vumitools.cache import LRUCache
+
+
+class GoTagpoolManager(TagpoolManager):
+    """A :class:`TagpoolManager` that caches tagpool metadata.
+
+    Tagpool metadata is read for every message that passes through the
+    credit and opt-out middleware but almost never changes, so it's kept
+    in a cache shared by every tagpool manager in the process. Each cached
+    entry is stamped with a generation counter kept in Redis, which is
+    bumped whenever a pool is declared, has its metadata set or is purged
+    through a :class:`GoTagpoolManager`. A lookup only uses the cached
+    entry if the generation hasn't changed, so every process sees the
+    change on its next lookup.
+
+    Pools edited with a plain :class:`TagpoolManager` (the `vumi_tagpools`
+    script, for example) don't bump the generation. Run the
+    `go_refresh_tagpool_metadata` management command afterwards, otherwise
+    the change is only picked up once the cached entries expire after
+    `metadata_cache.ttl` seconds.
+    """
+
+    metadata_cache = LRUCache(max_size=1000, ttl=60)
+
+    def _metadata_cache_key(self, pool):
+        return (self.redis.get_key_prefix(), pool)
+
+    def _metadata_generation_key(self):
+        return "tagpools:metadata_generation"
+
+    def invalidate_metadata(self, pool):
+        """Drop any cached metadata for `pool` in this process."""
+        self.metadata_cache.delete(self._metadata_cache_key(pool))
+
+    def refresh_metadata(self):
+        """Invalidate cached metadata for all pools in every process."""
+        return self.redis.incr(self._metadata_generation_key())
+
+    @Manager.calls_manager
+    def get_metadata(self, pool):
+        cache_key = self._metadata_cache_key(pool)
+        generation = yield self.redis.get(self._metadata_generation_key())
+        cached = self.metadata_cache.get(cache_key)
+        if cached is not None and cached[0] == generation:
+            metadata = cached[1]
+        else:
+            metadata = yield super(GoTagpoolManager, self).get_metadata(pool)
+            self.metadata_cache.set(cache_key, (generation, metadata))
+        # Callers are free to modify what they get back.
+        returnValue(deepcopy(metadata))
+
+    @Manager.calls_manager
+    def declare_tags(self, tags):
+        yield super(GoTagpoolManager, self).declare_tags(tags)
+        yield self.refresh_metadata()
+
+    @Manager.calls_manager
+    def set_metadata(self, pool, metadata):
+        yield super(GoTagpoolManager, self).set_metadata(pool, metadata)
+        yield self.refresh_metadata()
+
+    @Manager.calls_manager
+    def purge_pool(self, pool):
+        yield super(GoTagpoolManager, self).purge_pool(pool)
+        yield self.refresh_metadata()
@@ -10,7 +10,7 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 from vumi.tests.utils import get_fake_amq_client
 
 from go.vumitools.opt_out import OptOutStore
-from go.vumitools.contact import ContactStore
+from go.vumitools.contact import ContactAddress, ContactStore
 from go.vumitools.api import (
     VumiApi, VumiUserApi, VumiApiCommand, VumiApiEvent)
 from go.vumitools.tests.utils import (
@@ -184,6 +184,13 @@ class TestTxVumiUserApi(AppWorkerTestCase):
                 optedin_addrs.append(contact.addr_for(conv.delivery_class))
         self.assertEqual(optedin_addrs, ['+27760000000'])
 
+        optedin_addrs = []
+        for addresses in (yield conv.get_opted_in_address_bunches()):
+            for address in (yield addresses):
+                self.assertTrue(isinstance(address, ContactAddress))
+                optedin_addrs.append(address.addr_for(conv.delivery_class))
+        self.assertEqual(optedin_addrs, ['+27760000000'])
+
     @inlineCallbacks
     def test_exists(self):
         self.assertTrue((yield self.api.user_exists(self.user_account.key)))
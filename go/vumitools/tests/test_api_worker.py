@@ -327,6 +327,50 @@ class GoApplicationRouterTestCase(GoPersistenceMixin, DispatcherTestCase):
         [event] = self.get_dispatched_messages('app_1', direction='event')
         self.assertEqual(event['user_message_id'], msg['message_id'])
 
+    @inlineCallbacks
+    def test_event_dispatching_indexes_batch(self):
+        msg = self.mkmsg_out(transport_type='xmpp',
+                                transport_name=self.transport_name)
+        tag = (u'xmpp', u'test1@xmpp.org')
+        batch_id = yield self.vumi_api.mdb.batch_start([tag],
+            user_account=unicode(self.account.key))
+        self.conversation.batches.add_key(batch_id)
+        yield self.conversation.save()
+        TaggingMiddleware.add_tag_to_msg(msg, tag)
+        yield self.vumi_api.mdb.add_outbound_message(msg, tag=tag,
+            batch_id=batch_id)
+
+        ack = self.mkmsg_ack(
+            user_message_id=msg['message_id'],
+            transport_name=self.transport_name)
+        yield self.dispatch(ack, self.transport_name, 'event')
+
+        batch_info = yield self.vumi_api.routing_index.get_batch(batch_id)
+        self.assertEqual(batch_info['conversation_key'],
+                         self.conversation.key)
+        self.assertEqual(batch_info['conversation_type'],
+                         self.conversation.conversation_type)
+
+    @inlineCallbacks
+    def test_event_dispatching_from_batch_index(self):
+        # The batch's conversation comes from the routing index, so the
+        # conversation store isn't needed.
+        msg = self.mkmsg_out(transport_type='xmpp',
+                                transport_name=self.transport_name)
+        batch_id = yield self.vumi_api.mdb.batch_start([],
+            user_account=unicode(self.account.key))
+        yield self.vumi_api.mdb.add_outbound_message(msg, batch_id=batch_id)
+        yield self.vumi_api.routing_index.add_batch(
+            batch_id, u'conv-1', u'survey', self.account.key)
+
+        ack = self.mkmsg_ack(
+            user_message_id=msg['message_id'],
+            transport_name=self.transport_name)
+        yield self.dispatch(ack, self.transport_name, 'event')
+
+        [event] = self.get_dispatched_messages('app_2', direction='event')
+        self.assertEqual(event['user_message_id'], msg['message_id'])
+
     @inlineCallbacks
     def test_no_tag(self):
         msg = self.mkmsg_in(transport_type='xmpp',
@@ -0,0 +1,66 @@
+"""Tests for go.vumitools.cache."""
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.task import Clock
+
+from go.vumitools.cache import LRUCache
+
+
+class TestLRUCache(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def mk_cache(self, max_size=3, ttl=None):
+        return LRUCache(max_size, ttl, clock=self.clock)
+
+    def test_get_and_set(self):
+        cache = self.mk_cache()
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', 'default'), 'default')
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+
+    def test_evicts_least_recently_used(self):
+        cache = self.mk_cache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # Touch 'a' so that 'b' is the least recently used.
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_expiry(self):
+        cache = self.mk_cache(ttl=10)
+        cache.set('a', 1)
+        self.clock.advance(9)
+        self.assertEqual(cache.get('a'), 1)
+        self.clock.advance(1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_set_refreshes_expiry(self):
+        cache = self.mk_cache(ttl=10)
+        cache.set('a', 1)
+        self.clock.advance(5)
+        cache.set('a', 2)
+        self.clock.advance(9)
+        self.assertEqual(cache.get('a'), 2)
+
+    def test_delete(self):
+        cache = self.mk_cache()
+        cache.set('a', 1)
+        cache.delete('a')
+        cache.delete('missing')
+        self.assertEqual(cache.get('a'), None)
+
+    def test_clear(self):
+        cache = self.mk_cache()
+        cache.set('a', 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
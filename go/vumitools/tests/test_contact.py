@@ -2,12 +2,14 @@
 
 """Tests for go.vumitools.contact."""
 
-from twisted.internet.defer import inlineCallbacks
+from datetime import timedelta
+
+from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.trial.unittest import TestCase
 
 from go.vumitools.tests.utils import model_eq, GoPersistenceMixin
 from go.vumitools.account import AccountStore
-from go.vumitools.contact import ContactStore
+from go.vumitools.contact import Contact, ContactStore
 from go.vumitools.opt_out import OptOutStore
 
 
@@ -18,6 +20,7 @@ class TestContactStore(GoPersistenceMixin, TestCase):
     def setUp(self):
         self._persist_setUp()
         self.manager = self.get_riak_manager()
+        self.redis = yield self.get_redis_manager()
         self.account_store = AccountStore(self.manager)
         # We pass `self` in as the VumiApi object here, because mk_user() just
         # grabs .account_store off it.
@@ -25,6 +28,8 @@ class TestContactStore(GoPersistenceMixin, TestCase):
         self.account_alt = yield self.mk_user(self, u'other_user')
         self.store = ContactStore.from_user_account(self.account)
         self.store_alt = ContactStore.from_user_account(self.account_alt)
+        self.redis_store = ContactStore(
+            self.manager, self.account.key, self.redis)
 
     def tearDown(self):
         return self._persist_tearDown()
@@ -150,3 +155,460 @@ class TestContactStore(GoPersistenceMixin, TestCase):
                 name=u'Contact', surname=u'Foo %d' % i, msisdn=u'12345')
         count = yield self.store.count_contacts_for_group(group)
         self.assertEqual(count, 1)
+
+    @inlineCallbacks
+    def test_group_deletion_tracking(self):
+        store = self.redis_store
+        group1 = yield store.new_group(u'group1')
+        group2 = yield store.new_group(u'group2')
+
+        yield store.start_group_deletion(group1)
+        yield store.record_group_deletion_progress(group1.key, 3)
+        self.assertEqual([g.key for g in (yield store.list_groups())],
+                         [group2.key])
+        self.assertEqual((yield store.list_group_deletions()), [{
+            'group_key': group1.key,
+            'name': u'group1',
+            'contacts_only': False,
+            'deleted': 3,
+            }])
+
+        # Starting again after an interruption keeps the progress.
+        yield store.start_group_deletion(group1)
+        progress = yield store.get_group_deletion_progress(group1.key)
+        self.assertEqual(progress['deleted'], 3)
+
+        yield store.finish_group_deletion(group1.key)
+        self.assertEqual((yield store.list_group_deletions()), [])
+        self.assertEqual(
+            (yield store.get_group_deletion_progress(group1.key)), None)
+        self.assertEqual([g.key for g in (yield store.list_groups())],
+                         [group1.key, group2.key])
+
+    @inlineCallbacks
+    def test_group_contacts_deletion_tracking(self):
+        store = self.redis_store
+        group = yield store.new_group(u'group1')
+        yield store.start_group_deletion(group, contacts_only=True)
+        # The group itself isn't going anywhere.
+        self.assertEqual([g.key for g in (yield store.list_groups())],
+                         [group.key])
+        yield store.record_group_deletion_progress(group.key, 2)
+        self.assertEqual((yield store.list_group_deletions()), [{
+            'group_key': group.key,
+            'name': u'group1',
+            'contacts_only': True,
+            'deleted': 2,
+            }])
+
+        yield store.finish_group_deletion(group.key)
+        self.assertEqual((yield store.list_group_deletions()), [])
+
+    def fail_search(self, store):
+        def search(**kw):
+            self.fail("Unexpected search: %r" % (kw,))
+        self.patch(store.contacts, 'search', search)
+
+    @inlineCallbacks
+    def test_contact_for_addr_uses_addr_index(self):
+        store = self.redis_store
+        contact = yield store.new_contact(
+            name=u'Contact', surname=u'Person', msisdn=u'+27831234567')
+        self.fail_search(store)
+
+        found = yield store.contact_for_addr('sms', u'27831234567')
+        self.assertEqual(found.key, contact.key)
+        # Without the in-process cache the lookup goes to Redis.
+        ContactStore.addr_cache.clear()
+        found = yield store.contact_for_addr('ussd', u'+27831234567')
+        self.assertEqual(found.key, contact.key)
+        self.assertEqual(
+            (yield self.redis.sub_manager(self.account.key).hget(
+                store.addr_index_key('msisdn'), u'+27831234567')),
+            contact.key)
+
+    @inlineCallbacks
+    def test_contact_for_addr_with_stale_addr_index(self):
+        store = self.redis_store
+        yield store.contacts.enable_search()
+        contact = yield store.new_contact(
+            name=u'Contact', surname=u'Person', msisdn=u'+27831234567')
+        contact.msisdn = u'+27830000000'
+        yield contact.save()
+
+        found = yield store.contact_for_addr('sms', u'+27831234567')
+        self.assertNotEqual(found.key, contact.key)
+        self.assertEqual(found.msisdn, u'+27831234567')
+        self.assertEqual(
+            (yield self.redis.sub_manager(self.account.key).hget(
+                store.addr_index_key('msisdn'), u'+27831234567')),
+            None)
+
+    @inlineCallbacks
+    def test_contact_for_addr_indexes_search_results(self):
+        yield self.store.contacts.enable_search()
+        # This contact isn't indexed because the store has no Redis manager.
+        contact = yield self.store.new_contact(
+            name=u'Contact', surname=u'Person', gtalk_id=u'foo@example.com',
+            msisdn=u'unknown')
+        ContactStore.addr_cache.clear()
+
+        store = self.redis_store
+        found = yield store.contact_for_addr('gtalk', u'foo@example.com/x')
+        self.assertEqual(found.key, contact.key)
+        ContactStore.addr_cache.clear()
+        self.fail_search(store)
+        found = yield store.contact_for_addr('gtalk', u'foo@example.com')
+        self.assertEqual(found.key, contact.key)
+
+    def get_indexed_addr(self, store, field, addr):
+        return self.redis.sub_manager(self.account.key).hget(
+            store.addr_index_key(field), addr)
+
+    @inlineCallbacks
+    def test_save_contact_updates_addr_index(self):
+        store = self.redis_store
+        contact = yield store.new_contact(
+            name=u'Contact', surname=u'Person', msisdn=u'+27831234567')
+        contact.msisdn = u'+27830000000'
+        yield store.save_contact(contact)
+        self.assertEqual(
+            (yield self.get_indexed_addr(store, 'msisdn', u'+27831234567')),
+            None)
+        self.assertEqual(
+            (yield self.get_indexed_addr(store, 'msisdn', u'+27830000000')),
+            contact.key)
+        ContactStore.addr_cache.clear()
+        self.fail_search(store)
+        found = yield store.find_contact_for_addr('msisdn', u'+27830000000')
+        self.assertEqual(found.key, contact.key)
+
+    @inlineCallbacks
+    def test_delete_contact_updates_addr_index(self):
+        store = self.redis_store
+        contact = yield store.new_contact(
+            name=u'Contact', surname=u'Person', msisdn=u'+27831234567')
+        yield store.delete_contact(contact)
+        self.assertEqual(
+            (yield self.get_indexed_addr(store, 'msisdn', u'+27831234567')),
+            None)
+        self.assertEqual(
+            (yield store.get_contact_by_key(contact.key)), None)
+
+    @inlineCallbacks
+    def test_find_contact_for_addr_caches_misses(self):
+        store = self.redis_store
+        yield store.contacts.enable_search()
+        found = yield store.find_contact_for_addr('msisdn', u'+27831234567')
+        self.assertEqual(found, None)
+        self.assertTrue(0 < (yield self.redis.sub_manager(
+            self.account.key).ttl(store.addr_miss_key(
+                'msisdn', u'+27831234567'))) <= store.ADDR_MISS_TTL)
+
+        self.fail_search(store)
+        found = yield store.find_contact_for_addr('msisdn', u'+27831234567')
+        self.assertEqual(found, None)
+
+        # A new contact with the address clears the miss.
+        contact = yield store.new_contact(
+            name=u'Contact', surname=u'Person', msisdn=u'+27831234567')
+        ContactStore.addr_cache.clear()
+        found = yield store.find_contact_for_addr('msisdn', u'+27831234567')
+        self.assertEqual(found.key, contact.key)
+
+    @inlineCallbacks
+    def test_rebuild_addr_index(self):
+        contact = yield self.store.new_contact(
+            name=u'Contact', surname=u'Person', msisdn=u'+27831234567',
+            twitter_handle=u'@person')
+        ContactStore.addr_cache.clear()
+
+        store = self.redis_store
+        count = yield store.rebuild_addr_index()
+        self.assertEqual(count, 1)
+        self.fail_search(store)
+        found = yield store.contact_for_addr('twitter', u'@person')
+        self.assertEqual(found.key, contact.key)
+        found = yield store.contact_for_addr('sms', u'+27831234567')
+        self.assertEqual(found.key, contact.key)
+
+    @inlineCallbacks
+    def mk_surname_contacts(self, store, group=None):
+        groups = [group] if group is not None else []
+        contacts = []
+        for name, surname in [(u'A', u'Anderson'), (u'B', u'Adams'),
+                              (u'C', u'Brown'), (u'D', u'allen'),
+                              (u'E', None)]:
+            contact = yield store.new_contact(
+                name=name, surname=surname, msisdn=u'+27831234567',
+                groups=groups)
+            contacts.append(contact)
+        returnValue(contacts)
+
+    def test_contact_surname_letter(self):
+        contact = self.store.contacts(
+            u'key', user_account=self.account.key, msisdn=u'+27831234567')
+        self.assertEqual(contact.surname_letter(), None)
+        contact.surname = u'Smith'
+        self.assertEqual(contact.surname_letter(), 's')
+        contact.surname = u'Öberg'
+        self.assertEqual(contact.surname_letter(), None)
+
+    @inlineCallbacks
+    def test_filter_contacts_on_surname_without_index(self):
+        contacts = yield self.mk_surname_contacts(self.store)
+        self.assertFalse((yield self.store.surname_index_built()))
+
+        found = yield self.store.filter_contacts_on_surname('a')
+        self.assertEqual(
+            [c.key for c in found],
+            sorted(c.key for c in contacts if c.name in 'ABD'))
+
+    @inlineCallbacks
+    def test_filter_contacts_on_surname_with_index(self):
+        store = self.redis_store
+        group = yield store.new_group(u'group')
+        contacts = yield self.mk_surname_contacts(store)
+        group_contacts = yield self.mk_surname_contacts(store, group)
+        yield self.redis.sub_manager(self.account.key).set(
+            store.SURNAME_INDEXED_KEY, '1')
+
+        found = yield store.filter_contacts_on_surname('A')
+        self.assertEqual(
+            [c.key for c in found],
+            sorted(c.key for c in contacts + group_contacts
+                   if c.name in 'ABD'))
+        found = yield store.filter_contacts_on_surname('a', group=group)
+        a_keys = sorted(c.key for c in group_contacts if c.name in 'ABD')
+        self.assertEqual([c.key for c in found], a_keys)
+        found = yield store.filter_contacts_on_surname(
+            'a', group=group, start=1, limit=1)
+        self.assertEqual([c.key for c in found], a_keys[1:2])
+
+    @inlineCallbacks
+    def test_surname_index_follows_contact_changes(self):
+        store = self.redis_store
+        group = yield store.new_group(u'group')
+        contact = yield store.new_contact(
+            name=u'A', surname=u'Adams', msisdn=u'+27831234567')
+        self.assertEqual(
+            (yield store.list_contact_keys_for_surname('a')), [contact.key])
+        self.assertEqual(
+            (yield store.list_contact_keys_for_surname('a', group)), [])
+
+        contact.surname = u'Brown'
+        contact.add_to_group(group)
+        yield contact.save()
+        self.assertEqual((yield store.list_contact_keys_for_surname('a')), [])
+        self.assertEqual(
+            (yield store.list_contact_keys_for_surname('b', group)),
+            [contact.key])
+
+    @inlineCallbacks
+    def test_rebuild_surname_index(self):
+        contact = yield self.store.new_contact(
+            name=u'A', surname=u'Adams', msisdn=u'+27831234567')
+        # Remove the index entries to simulate a contact saved before they
+        # existed.
+        contact._riak_object.remove_index(contact.SURNAME_LETTER_INDEX)
+        yield super(Contact, contact).save()
+        self.assertEqual(
+            (yield self.store.list_contact_keys_for_surname('a')), [])
+
+        store = self.redis_store
+        self.assertFalse((yield store.surname_index_built()))
+        count = yield store.rebuild_surname_index()
+        self.assertEqual(count, 1)
+        self.assertTrue((yield store.surname_index_built()))
+        self.assertEqual(
+            (yield store.list_contact_keys_for_surname('a')), [contact.key])
+
+    @inlineCallbacks
+    def test_materialized_smart_group(self):
+        store = self.redis_store
+        yield store.contacts.enable_search()
+        contact = yield store.new_contact(
+            name=u'Contact', surname=u'Person', msisdn=u'+27831234567')
+        group = yield store.new_smart_group(u'group', u'msisdn:\\+2783*')
+        self.assertEqual((yield store.get_smart_group_info(group.key)), None)
+
+        yield store.materialize_smart_group(group)
+        info = yield store.get_smart_group_info(group.key)
+        self.assertEqual(info['refreshed_at'], None)
+        self.assertTrue(info['stale'])
+
+        count = yield store.refresh_smart_group(group)
+        self.assertEqual(count, 1)
+        info = yield store.get_smart_group_info(group.key)
+        self.assertNotEqual(info['refreshed_at'], None)
+        self.assertFalse(info['stale'])
+
+        # Members now come from Redis rather than Riak search.
+        def search(query):
+            self.fail("Unexpected search: %r" % (query,))
+        self.patch(store.contacts, 'raw_search', search)
+        self.assertEqual((yield store.count_contacts_for_group(group)), 1)
+        self.assertEqual(
+            (yield store.get_dynamic_contacts_for_group(group)),
+            [contact.key])
+
+    @inlineCallbacks
+    def test_refresh_smart_group_with_changes(self):
+        store = self.redis_store
+        yield store.contacts.enable_search()
+        contact1 = yield store.new_contact(
+            name=u'Contact', surname=u'Person', msisdn=u'+27831234567')
+        group = yield store.new_smart_group(u'group', u'msisdn:\\+2783*')
+        yield store.materialize_smart_group(group)
+        yield store.refresh_smart_group(group)
+
+        contact2 = yield store.new_contact(
+            name=u'Contact', surname=u'Person', msisdn=u'+27831234568')
+        yield contact1.delete()
+        info = yield store.get_smart_group_info(group.key)
+        self.assertTrue(info['stale'])
+
+        count = yield store.refresh_smart_group(group)
+        self.assertEqual(count, 1)
+        self.assertEqual(
+            (yield store.get_dynamic_contacts_for_group(group)),
+            [contact2.key])
+
+    @inlineCallbacks
+    def test_list_smart_groups_to_refresh(self):
+        store = self.redis_store
+        group1 = yield store.new_smart_group(u'group1', u'name:foo')
+        group2 = yield store.new_smart_group(u'group2', u'name:bar')
+        yield store.new_smart_group(u'group3', u'name:baz')
+        yield store.materialize_smart_group(group1)
+        yield store.materialize_smart_group(group2)
+        yield store.refresh_smart_group(group2)
+        self.assertEqual(
+            (yield store.list_smart_groups_to_refresh(timedelta(hours=1))),
+            [group1.key])
+        self.assertEqual(
+            sorted((yield store.list_smart_groups_to_refresh(
+                timedelta(seconds=-1)))),
+            sorted([group1.key, group2.key]))
+
+        yield store.unmaterialize_smart_group(group1.key)
+        yield store.note_contacts_changed()
+        self.assertEqual(
+            (yield store.list_smart_groups_to_refresh(timedelta(hours=1))),
+            [group2.key])
+
+    @inlineCallbacks
+    def collect_pages(self, pages):
+        collected = []
+        for page in pages:
+            collected.append((yield page))
+        returnValue(collected)
+
+    @inlineCallbacks
+    def test_get_contact_key_pages_for_group(self):
+        store = self.redis_store
+        yield store.contacts.enable_search()
+        group = yield store.new_smart_group(u'group', u'msisdn:\\+2783*')
+        static_contact = yield store.new_contact(
+            name=u'Contact', surname=u'Person', msisdn=u'+27831234567',
+            groups=[group])
+        other_keys = []
+        for i in range(3):
+            contact = yield store.new_contact(
+                name=u'Contact', surname=u'Person',
+                msisdn=u'+2783123456%s' % (i,))
+            other_keys.append(contact.key)
+
+        pages = yield self.collect_pages(
+            (yield store.get_contact_key_pages_for_group(group, page_size=2)))
+        self.assertEqual(pages[0], [static_contact.key])
+        self.assertTrue(all(len(page) <= 2 for page in pages))
+        keys = sum(pages, [])
+        self.assertEqual(
+            sorted(keys), sorted(other_keys + [static_contact.key]))
+
+        # Materialized members come from Redis a page at a time.
+        yield store.materialize_smart_group(group)
+        yield store.refresh_smart_group(group)
+        pages = yield self.collect_pages(
+            (yield store.get_dynamic_contact_key_pages_for_group(
+                group, page_size=3)))
+        self.assertEqual(
+            pages, [sorted(other_keys + [static_contact.key])[:3],
+                    sorted(other_keys + [static_contact.key])[3:]])
+
+        # Members added after the count was taken are handed out too.
+        yield store.redis.zadd(
+            store.smart_group_members_key(group.key), **{'zzz': 0})
+        pages = yield self.collect_pages(
+            (yield store.get_dynamic_contact_key_pages_for_group(
+                group, page_size=2)))
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual(sum(pages, []),
+                         sorted(other_keys + [static_contact.key]) + ['zzz'])
+
+    @inlineCallbacks
+    def test_get_smart_group_key_page(self):
+        store = self.redis_store
+        yield store.contacts.enable_search()
+        group = yield store.new_smart_group(u'group', u'msisdn:\\+2783*')
+        keys = []
+        for i in range(4):
+            contact = yield store.new_contact(
+                name=u'Contact', surname=u'Person',
+                msisdn=u'+2783123456%s' % (i,))
+            keys.append(contact.key)
+        keys.sort()
+        yield store.materialize_smart_group(group)
+        yield store.refresh_smart_group(group)
+
+        page, cursor = yield store.get_smart_group_key_page(
+            group.key, page_size=3)
+        self.assertEqual((page, cursor), (keys[:3], 3))
+        page, cursor = yield store.get_smart_group_key_page(
+            group.key, cursor, page_size=3)
+        self.assertEqual((page, cursor), (keys[3:], None))
+
+        # The pages can all be asked for before any of them arrive.
+        pages = list((yield store.get_dynamic_contact_key_pages_for_group(
+            group, page_size=3)))
+        self.assertEqual((yield self.collect_pages(pages)),
+                         [keys[:3], keys[3:]])
+
+    @inlineCallbacks
+    def test_load_contact_pages(self):
+        contact1 = yield self.store.new_contact(
+            name=u'Contact', surname=u'Person', msisdn=u'+27831234567')
+        contact2 = yield self.store.new_contact(
+            name=u'Contact', surname=u'Person', msisdn=u'+27831234568')
+        pages = yield self.collect_pages(self.store.load_contact_pages(
+            [[contact1.key, u'missing'], [contact2.key]]))
+        self.assertEqual([[c.key for c in page] for page in pages],
+                         [[contact1.key], [contact2.key]])
+
+    @inlineCallbacks
+    def test_load_contact_addresses(self):
+        contact1 = yield self.store.new_contact(
+            name=u'Contact', surname=u'Person', msisdn=u'+27831234567',
+            twitter_handle=u'@person')
+        contact2 = yield self.store.new_contact(
+            name=u'Contact', surname=u'Person', msisdn=u'unknown',
+            gtalk_id=u'person@example.com')
+        contact3 = yield self.store.new_contact(
+            name=u'Contact', surname=u'Person', msisdn=u'+27831234568')
+        yield contact3.delete()
+
+        addresses = yield self.store.load_contact_addresses(
+            [contact1.key, contact2.key, contact3.key, u'missing'])
+        addresses = dict((address.key, address) for address in addresses)
+        self.assertEqual(sorted(addresses), sorted([contact1.key,
+                                                    contact2.key]))
+        self.assertEqual(addresses[contact1.key].addr_for('sms'),
+                         u'+27831234567')
+        self.assertEqual(addresses[contact1.key].addr_for('twitter'),
+                         u'@person')
+        self.assertEqual(addresses[contact1.key].addr_for('gtalk'), None)
+        self.assertEqual(addresses[contact2.key].addr_for('gtalk'),
+                         u'person@example.com')
+        self.assertEqual(addresses[contact2.key].addr_for('foo'), None)
+        self.assertEqual((yield self.store.load_contact_addresses([])), [])
@@ -0,0 +1,107 @@
+"""Tests for go.vumitools.contact_imports."""
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks
+
+from go.vumitools.tests.utils import GoPersistenceMixin
+from go.vumitools.contact_imports import ContactImportManager
+
+
+class ContactImportManagerTestCase(GoPersistenceMixin, TestCase):
+
+    use_riak = False
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.redis = yield self.get_redis_manager()
+        self.imports = ContactImportManager(
+            self.redis.sub_manager('contact_imports'))
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    @inlineCallbacks
+    def test_new_import(self):
+        import_id = yield self.imports.new_import(
+            'account-1', 'group-1', 'contacts.csv')
+        self.assertEqual((yield self.imports.get_latest_import('group-1')),
+                         import_id)
+        self.assertEqual((yield self.imports.get_progress(import_id)), {
+            'account_key': 'account-1',
+            'group_key': 'group-1',
+            'file_name': 'contacts.csv',
+            'status': 'pending',
+            'written': 0,
+            })
+
+    @inlineCallbacks
+    def test_get_progress_for_unknown_import(self):
+        self.assertEqual((yield self.imports.get_progress('unknown')), None)
+
+    @inlineCallbacks
+    def test_record_written(self):
+        import_id = yield self.imports.new_import(
+            'account-1', 'group-1', 'contacts.csv')
+        yield self.imports.start_import(import_id)
+        yield self.imports.record_written(import_id, ['c1', 'c2'])
+        yield self.imports.record_written(import_id, ['c3'])
+
+        progress = yield self.imports.get_progress(import_id)
+        self.assertEqual(progress['status'], 'running')
+        self.assertEqual(progress['written'], 3)
+        self.assertEqual(
+            (yield self.imports.get_written_keys(import_id, 0, 2)),
+            ['c1', 'c2'])
+        self.assertEqual(
+            (yield self.imports.get_written_keys(import_id, 2, 2)), ['c3'])
+
+    @inlineCallbacks
+    def test_finish_import(self):
+        import_id = yield self.imports.new_import(
+            'account-1', 'group-1', 'contacts.csv')
+        yield self.imports.record_written(import_id, ['c1'])
+
+        progress = yield self.imports.finish_import(
+            import_id, self.imports.IMPORT_COMPLETED)
+        self.assertEqual(progress['status'], 'completed')
+        self.assertEqual(progress['written'], 1)
+        self.assertEqual(
+            (yield self.imports.get_written_keys(import_id, 0, 10)), [])
+        self.assertEqual(
+            (yield self.imports.get_progress(import_id))['status'],
+            'completed')
+
+    @inlineCallbacks
+    def test_discard_written(self):
+        import_id = yield self.imports.new_import(
+            'account-1', 'group-1', 'contacts.csv')
+        yield self.imports.start_import(import_id, chunks=2)
+        yield self.imports.record_written(import_id, ['c1', 'c2'], 0)
+        yield self.imports.record_written(import_id, ['c3'], 1)
+
+        yield self.imports.discard_written(import_id, 0)
+        self.assertEqual(
+            (yield self.imports.get_written_keys(import_id, 0, 10, 0)), [])
+        self.assertEqual(
+            (yield self.imports.get_written_keys(import_id, 0, 10, 1)),
+            ['c3'])
+        progress = yield self.imports.get_progress(import_id)
+        self.assertEqual(progress['written'], 1)
+
+    @inlineCallbacks
+    def test_finish_chunk(self):
+        import_id = yield self.imports.new_import(
+            'account-1', 'group-1', 'contacts.csv')
+        yield self.imports.start_import(import_id, chunks=3)
+
+        self.assertFalse((yield self.imports.finish_chunk(import_id, 0)))
+        self.assertFalse(
+            (yield self.imports.finish_chunk(import_id, 2, 'Oops 2')))
+        self.assertTrue(
+            (yield self.imports.finish_chunk(import_id, 1, 'Oops 1')))
+
+        progress = yield self.imports.get_progress(import_id)
+        self.assertEqual(progress['chunks_done'], 3)
+        self.assertEqual(progress['chunks_failed'], 2)
+        self.assertEqual(progress['error'], 'Oops 2')
@@ -2,7 +2,9 @@
 
 """Tests for go.vumitools.conversation."""
 
-from twisted.internet.defer import inlineCallbacks
+from datetime import datetime
+
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
 from twisted.trial.unittest import TestCase
 
 from go.vumitools.tests.utils import model_eq, GoPersistenceMixin
@@ -20,11 +22,14 @@ class TestConversationStore(GoPersistenceMixin, TestCase):
     def setUp(self):
         yield self._persist_setUp()
         self.manager = self.get_riak_manager()
+        self.redis = yield self.get_redis_manager()
         self.account_store = AccountStore(self.manager)
         self.account = yield self.mk_user(self, u'user')
         self.optout_store = OptOutStore.from_user_account(self.account)
         self.conv_store = ConversationStore.from_user_account(self.account)
         self.contact_store = ContactStore.from_user_account(self.account)
+        self.indexed_conv_store = ConversationStore(
+            self.manager, self.account.key, self.redis)
 
     def tearDown(self):
         return self._persist_tearDown()
@@ -52,6 +57,92 @@ class TestConversationStore(GoPersistenceMixin, TestCase):
         dbconv = yield self.conv_store.get_conversation_by_key(conv.key)
         self.assert_models_equal(conv, dbconv)
 
+    @inlineCallbacks
+    def mk_conversations(self, store):
+        draft = yield store.new_conversation(
+            u'bulk_message', u'draft', u'message',
+            delivery_tag_pool=u'longcode')
+        running = yield store.new_conversation(
+            u'bulk_message', u'running', u'message',
+            delivery_tag_pool=u'longcode', delivery_tag=u'tag1')
+        running.batches.add_key(u'batch1')
+        yield running.save()
+        finished = yield store.new_conversation(
+            u'bulk_message', u'finished', u'message')
+        finished.end_timestamp = datetime.utcnow()
+        yield finished.save()
+        yield store.update_status_index(running)
+        yield store.update_status_index(finished)
+        returnValue((draft, running, finished))
+
+    @inlineCallbacks
+    def test_list_conversation_summaries_without_index(self):
+        draft, running, _ = yield self.mk_conversations(self.conv_store)
+        self.assertFalse((yield self.conv_store.status_index_built()))
+        summaries = yield self.conv_store.list_conversation_summaries()
+        self.assertEqual(
+            sorted((s.key, s.status) for s in summaries),
+            sorted([(draft.key, u'draft'), (running.key, u'running')]))
+        self.assertEqual(
+            (yield self.conv_store.list_conversation_keys([u'running'])),
+            [running.key])
+
+    @inlineCallbacks
+    def test_rebuild_status_index(self):
+        # The plain store has no Redis manager so nothing is indexed here.
+        draft, running, _ = yield self.mk_conversations(self.conv_store)
+        store = self.indexed_conv_store
+        self.assertFalse((yield store.status_index_built()))
+
+        count = yield store.rebuild_status_index()
+        self.assertEqual(count, 2)
+        self.assertTrue((yield store.status_index_built()))
+        [summary] = yield store.list_conversation_summaries([u'running'])
+        self.assertEqual(summary.key, running.key)
+        self.assertEqual(summary.user_account_key, self.account.key)
+        self.assertEqual(summary.conversation_type, u'bulk_message')
+        self.assertEqual(summary.subject, u'running')
+        self.assertEqual(summary.delivery_tag_pool, u'longcode')
+        self.assertEqual(summary.delivery_tag, u'tag1')
+        self.assertEqual(
+            (yield store.list_conversation_keys([u'draft'])), [draft.key])
+
+    @inlineCallbacks
+    def test_rebuild_status_index_with_changes(self):
+        store = self.indexed_conv_store
+        draft, running, _ = yield self.mk_conversations(store)
+        stale_convs = yield store.load_active_conversations()
+        running.end_timestamp = datetime.utcnow()
+        yield running.save()
+
+        def load_stale_conversations():
+            # The conversation is ended after the rebuild loaded it.
+            result = store.update_status_index(running)
+            if isinstance(result, Deferred):
+                return result.addCallback(lambda _: stale_convs)
+            return stale_convs
+        self.patch(store, 'load_active_conversations',
+                   load_stale_conversations)
+
+        yield store.rebuild_status_index()
+        self.assertEqual((yield store.list_conversation_keys()), [draft.key])
+
+    @inlineCallbacks
+    def test_status_index_maintained(self):
+        store = self.indexed_conv_store
+        yield store.rebuild_status_index()
+        draft, running, _ = yield self.mk_conversations(store)
+        self.assertEqual(
+            (yield store.list_conversation_keys([u'draft'])), [draft.key])
+        self.assertEqual(
+            (yield store.list_conversation_keys([u'running'])),
+            [running.key])
+
+        running.end_timestamp = datetime.utcnow()
+        yield running.save()
+        yield store.update_status_index(running)
+        self.assertEqual((yield store.list_conversation_keys()), [draft.key])
+
 
 class TestConversationStoreSync(TestConversationStore):
     sync_persistence = True
@@ -4,8 +4,9 @@ import uuid
 
 from twisted.trial.unittest import TestCase
 from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
 
-from go.vumitools.credit import CreditManager
+from go.vumitools.credit import CreditManager, CreditLeaseManager
 from go.vumitools.tests.utils import GoPersistenceMixin
 
 
@@ -43,3 +44,109 @@ class TestCreditManager(TestCase, GoPersistenceMixin):
         self.assertEqual((yield self.cm.get_credit(self.user_id)), 5)
         self.assertEqual((yield self.cm.debit(self.user_id, 5)), True)
         self.assertEqual((yield self.cm.get_credit(self.user_id)), 0)
+
+    @inlineCallbacks
+    def test_debit_many(self):
+        self.assertEqual((yield self.cm.debit_many(self.user_id, 2, 3)), 0)
+        yield self.cm.credit(self.user_id, 10)
+        self.assertEqual((yield self.cm.debit_many(self.user_id, 2, 3)), 3)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 4)
+        # Only some of these can be paid for.
+        self.assertEqual((yield self.cm.debit_many(self.user_id, 2, 3)), 2)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 0)
+        self.assertEqual((yield self.cm.debit_many(self.user_id, 0, 3)), 3)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 0)
+
+    @inlineCallbacks
+    def test_concurrent_overdraft_does_not_fail_other_debits(self):
+        yield self.cm.credit(self.user_id, 5)
+        # Simulate a debit of 6 that is in flight (and about to fail and be
+        # undone) while we try to debit 1.
+        credit_key = self.cm._credit_key(self.user_id)
+        yield self.cm.redis.incr(credit_key, -6)
+        incr = self.cm.redis.incr
+        undone = []
+
+        def incr_and_undo_other(key, amount=1):
+            if amount > 0 and not undone:
+                undone.append(True)
+                return incr(key, amount + 6)
+            return incr(key, amount)
+
+        self.patch(self.cm.redis, 'incr', incr_and_undo_other)
+        self.assertEqual((yield self.cm.debit(self.user_id, 1)), True)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 4)
+
+    @inlineCallbacks
+    def test_sustained_overdraft_can_fail_debits(self):
+        yield self.cm.credit(self.user_id, 5)
+        # Another debit of 6 that is still in flight every time we look.
+        credit_key = self.cm._credit_key(self.user_id)
+        yield self.cm.redis.incr(credit_key, -6)
+        self.assertEqual((yield self.cm.debit(self.user_id, 1)), False)
+        yield self.cm.redis.incr(credit_key, 6)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 5)
+
+
+class TestCreditLeaseManager(TestCase, GoPersistenceMixin):
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        redis = yield self.get_redis_manager()
+        self.cm = CreditManager(redis)
+        self.clock = Clock()
+        self.leases = CreditLeaseManager(self.cm, reconcile_interval=10,
+                                         clock=self.clock)
+        self.leases.start()
+        self.user_id = uuid.uuid4().hex
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield self.leases.stop()
+        yield self._persist_tearDown()
+
+    @inlineCallbacks
+    def test_debit_from_lease(self):
+        yield self.cm.credit(self.user_id, 10)
+        self.assertEqual((yield self.leases.debit(self.user_id, 1, 4)), True)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 6)
+        self.assertEqual(self.leases.get_leased_credit(self.user_id), 3)
+
+        # These come out of the lease without touching Redis.
+        def fail_debit_many(*args):
+            self.fail("Unexpected debit_many call")
+        self.patch(self.cm, 'debit_many', fail_debit_many)
+        for i in range(3):
+            self.assertEqual(
+                (yield self.leases.debit(self.user_id, 1, 4)), True)
+        self.assertEqual(self.leases.get_leased_credit(self.user_id), 0)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 6)
+
+    @inlineCallbacks
+    def test_partial_lease(self):
+        yield self.cm.credit(self.user_id, 3)
+        self.assertEqual((yield self.leases.debit(self.user_id, 2, 10)), True)
+        self.assertEqual(self.leases.get_leased_credit(self.user_id), 1)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 0)
+
+    @inlineCallbacks
+    def test_insufficient_credit(self):
+        yield self.cm.credit(self.user_id, 1)
+        self.assertEqual((yield self.leases.debit(self.user_id, 2, 10)),
+                         False)
+        # The credit we couldn't use isn't held on to.
+        self.assertEqual(self.leases.get_leased_credit(self.user_id), 0)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 1)
+
+    @inlineCallbacks
+    def test_reconcile(self):
+        yield self.cm.credit(self.user_id, 10)
+        yield self.leases.debit(self.user_id, 1, 4)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 6)
+        self.clock.advance(9)
+        self.assertEqual(self.leases.get_leased_credit(self.user_id), 3)
+        # The reconciler returns the unused credit by itself.
+        self.clock.advance(1)
+        self.assertEqual(self.leases.get_leased_credit(self.user_id), 0)
+        self.assertEqual((yield self.cm.get_credit(self.user_id)), 9)
@@ -0,0 +1,176 @@
+"""Tests for go.vumitools.message_search."""
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.message import TransportUserMessage
+
+from go.vumitools.tests.utils import GoPersistenceMixin
+from go.vumitools.message_search import MessageSearchIndex
+
+
+class MessageSearchIndexTestCase(GoPersistenceMixin, TestCase):
+
+    use_riak = False
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.redis = yield self.get_redis_manager()
+        self.index = MessageSearchIndex(self.redis.sub_manager('search'))
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    def mk_msg(self, content, helper_metadata=None):
+        return TransportUserMessage(to_addr=u'12345',
+            from_addr=u'+27831234567', content=content,
+            transport_name='sphex', transport_type='sms',
+            helper_metadata=helper_metadata or {})
+
+    @inlineCallbacks
+    def index_messages(self, *contents):
+        self.keys = {}
+        for timestamp, content in enumerate(contents):
+            msg = self.mk_msg(content)
+            yield self.index.index_message(
+                'batch-1', 'inbound', msg, timestamp)
+            self.keys[content] = msg['message_id']
+        # Newest first, as search results are.
+        self.msgs = [self.keys[content] for content in reversed(contents)]
+
+    def search(self, query, direction='inbound'):
+        return self.index.search('batch-1', direction, query)
+
+    def test_message_terms(self):
+        msg = self.mk_msg(u"Don't STOP me now")
+        self.assertEqual(self.index.message_terms(msg), set([
+            u'don', u't', u'stop', u'me', u'now',
+            u'from:+27831234567', u'to:12345']))
+
+    def test_message_terms_sensitive(self):
+        msg = self.mk_msg(u'PIN 1234', {'go': {'sensitive': True}})
+        self.assertEqual(self.index.message_terms(msg), set([
+            u'from:+27831234567', u'to:12345']))
+
+    def test_term_prefixes(self):
+        self.assertEqual(self.index.term_prefixes(u'stop'),
+                         [u'st', u'sto', u'stop'])
+        self.assertEqual(self.index.term_prefixes(u'a'), [])
+        self.assertEqual(self.index.term_prefixes(u'from:+2783'),
+                         [u'from:+2', u'from:+27', u'from:+278',
+                          u'from:+2783'])
+        self.assertEqual(len(self.index.term_prefixes(u'x' * 20)),
+                         self.index.MAX_PREFIX_LENGTH -
+                         self.index.MIN_PREFIX_LENGTH + 1)
+
+    def test_parse_query(self):
+        self.assertEqual(self.index.parse_query(u'stop -now OR help*'), [
+            ([('prefix', u'stop')], [('prefix', u'now')]),
+            ([('prefix', u'help')], []),
+            ])
+        self.assertEqual(self.index.parse_query(u'from:+2783'),
+                         [([('prefix', u'from:+2783')], [])])
+        self.assertEqual(self.index.parse_query(u'sign-up'),
+                         [([('term', u'sign'), ('prefix', u'up')], [])])
+        # Only negated words, or prefixes we don't index.
+        self.assertEqual(self.index.parse_query(u'-stop'), None)
+        self.assertEqual(self.index.parse_query(u'stop OR -now'), None)
+        self.assertEqual(self.index.parse_query(u's*'), None)
+        self.assertEqual(self.index.parse_query(u"don't"), None)
+        self.assertEqual(self.index.parse_query(u'.*'), None)
+
+    @inlineCallbacks
+    def test_index_message_not_enabled(self):
+        yield self.index_messages(u'hello')
+        yield self.index.mark_complete('batch-1')
+        self.assertEqual((yield self.search(u'hello')), [])
+
+    @inlineCallbacks
+    def test_search(self):
+        yield self.index.enable_batch('batch-1', complete=True)
+        yield self.index_messages(
+            u'hello world', u'Hello again', u'help me', u'stop')
+        self.assertEqual((yield self.search(u'hello')),
+                         [self.keys[u'Hello again'],
+                          self.keys[u'hello world']])
+        self.assertEqual((yield self.search(u'HELLO world')),
+                         [self.keys[u'hello world']])
+        self.assertEqual((yield self.search(u'hel*')), self.msgs[1:])
+        self.assertEqual((yield self.search(u'hel')), self.msgs[1:])
+        self.assertEqual((yield self.search(u'hel* -again')),
+                         [self.keys[u'help me'], self.keys[u'hello world']])
+        self.assertEqual((yield self.search(u'stop OR world')),
+                         [self.keys[u'stop'], self.keys[u'hello world']])
+        self.assertEqual((yield self.search(u'from:+27831234567')),
+                         self.msgs)
+        self.assertEqual((yield self.search(u'from:+2782*')), [])
+        self.assertEqual((yield self.search(u'from:+2783123')), self.msgs)
+        self.assertEqual((yield self.search(u'hello', 'outbound')), [])
+        self.assertEqual((yield self.search(u'-hello')), None)
+
+    @inlineCallbacks
+    def test_search_long_prefix(self):
+        yield self.index.enable_batch('batch-1', complete=True)
+        yield self.index_messages(
+            u'internationalisation', u'internationalization', u'intern')
+        self.assertEqual((yield self.search(u'internationalis')),
+                         [self.keys[u'internationalisation']])
+        self.assertEqual((yield self.search(u'internat')), self.msgs[1:])
+
+    @inlineCallbacks
+    def test_index_new_terms(self):
+        yield self.index.enable_batch('batch-1', complete=True)
+        yield self.index_messages(u'hello', u'hello help')
+        prefix_key = self.index.postings_key(
+            'batch-1', 'inbound', 'prefix', u'hel')
+        self.assertEqual((yield self.index.redis.smembers(prefix_key)),
+                         set(['hello', 'help']))
+        self.assertEqual(
+            (yield self.index.redis.smembers(
+                self.index.terms_key('batch-1', 'inbound'))),
+            set(['hello', 'help', 'from:+27831234567', 'to:12345']))
+
+    @inlineCallbacks
+    def test_search_bounds(self):
+        yield self.index.enable_batch('batch-1', complete=True)
+        yield self.index_messages(u'hello world', u'hello again', u'help')
+        self.index.MAX_PREFIX_TERMS = 1
+        self.assertEqual((yield self.search(u'hel')), None)
+        self.assertEqual((yield self.search(u'hello')), self.msgs[1:])
+
+        self.index.MAX_POSTINGS = 1
+        self.assertEqual((yield self.search(u'hello')), None)
+        # A few messages are checked against big postings one by one.
+        self.assertEqual((yield self.search(u'hello world')),
+                         [self.keys[u'hello world']])
+        self.index.MAX_SCORE_CHECKS = 0
+        self.assertEqual((yield self.search(u'hello world')), None)
+
+    @inlineCallbacks
+    def test_search_incomplete_batch(self):
+        yield self.index.enable_batch('batch-1')
+        yield self.index_messages(u'hello')
+        self.assertEqual((yield self.search(u'hello')), None)
+        yield self.index.mark_complete('batch-1')
+        self.assertEqual((yield self.search(u'hello')), self.msgs)
+        yield self.index.mark_incomplete('batch-1')
+        self.assertEqual((yield self.search(u'hello')), None)
+
+    @inlineCallbacks
+    def test_clear_batch(self):
+        yield self.index.enable_batch('batch-1', complete=True)
+        yield self.index_messages(u'hello')
+        yield self.index.clear_batch('batch-1')
+        self.assertEqual((yield self.search(u'hello')), [])
+        self.assertTrue((yield self.index.is_enabled('batch-1')))
+        postings_key = self.index.postings_key(
+            'batch-1', 'inbound', 'term', u'hello')
+        self.assertFalse((yield self.index.redis.exists(postings_key)))
+        prefix_key = self.index.postings_key(
+            'batch-1', 'inbound', 'prefix', u'hel')
+        self.assertFalse((yield self.index.redis.exists(prefix_key)))
+        self.assertFalse((yield self.index.redis.exists(
+            self.index.terms_key('batch-1', 'inbound'))))
+        self.assertEqual((yield self.index.redis.smembers(
+            self.index.batch_postings_key('batch-1'))), set())
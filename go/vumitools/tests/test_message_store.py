@@ -0,0 +1,327 @@
+"""Tests for go.vumitools.message_store."""
+
+import time
+from datetime import datetime
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.message import TransportUserMessage, TransportEvent
+from vumi.components.message_store import MessageStore
+
+from go.vumitools.message_store import GoMessageStore
+from go.vumitools.tests.utils import GoPersistenceMixin
+
+
+class TestGoMessageStore(GoPersistenceMixin, TestCase):
+    use_riak = True
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.manager = self.get_riak_manager()
+        self.redis = yield self.get_redis_manager()
+        self.store = GoMessageStore(self.manager, self.redis)
+        self.cache = self.store.cache
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    def mk_msg(self):
+        return TransportUserMessage(to_addr='+27831234567',
+            from_addr='12345', transport_name='sphex',
+            transport_type='sms')
+
+    def mk_ack(self, msg):
+        return TransportEvent(event_type='ack',
+            user_message_id=msg['message_id'], sent_message_id='xyz')
+
+    @inlineCallbacks
+    def test_conversation_counters(self):
+        batch_id = yield self.store.batch_start([])
+        yield self.cache.add_conversation_batch(u'conv-1', batch_id)
+        self.assertEqual(
+            (yield self.cache.get_batch_conversation(batch_id)), u'conv-1')
+
+        msg = self.mk_msg()
+        yield self.store.add_outbound_message(msg, batch_id=batch_id)
+        ack = self.mk_ack(msg)
+        yield self.store.add_event(ack)
+        # Duplicate events aren't counted twice.
+        yield self.store.add_event(ack)
+
+        status = yield self.cache.get_conversation_event_status(
+            u'conv-1', [batch_id])
+        self.assertEqual(status, {'sent': 1, 'ack': 1})
+        self.assertEqual(
+            (yield self.store.conversation_status(u'conv-1', [batch_id])),
+            {'sent': 1, 'ack': 1})
+
+    @inlineCallbacks
+    def test_conversation_counters_incomplete(self):
+        batch1 = yield self.store.batch_start([])
+        batch2 = yield self.store.batch_start([])
+        yield self.cache.add_conversation_batch(u'conv-1', batch1)
+        yield self.store.add_outbound_message(self.mk_msg(), batch_id=batch1)
+        yield self.store.add_outbound_message(self.mk_msg(), batch_id=batch2)
+
+        self.assertEqual((yield self.cache.get_conversation_event_status(
+            u'conv-1', [batch1, batch2])), None)
+        status = yield self.store.conversation_status(
+            u'conv-1', [batch1, batch2])
+        self.assertEqual(status['sent'], 2)
+
+    @inlineCallbacks
+    def test_conversation_counters_not_maintained(self):
+        batch_id = yield self.store.batch_start([])
+        yield self.cache.add_conversation_batch(u'conv-1', batch_id)
+        self.assertFalse((yield self.cache.is_maintained(batch_id)))
+        # A plain message store doesn't keep the conversation counters.
+        plain_store = MessageStore(self.manager, self.redis)
+        msg = self.mk_msg()
+        yield plain_store.add_outbound_message(msg, batch_id=batch_id)
+        yield self.store.add_event(self.mk_ack(msg))
+
+        self.assertFalse((yield self.cache.is_maintained(batch_id)))
+        self.assertEqual((yield self.cache.get_conversation_event_status(
+            u'conv-1', [batch_id])), None)
+        status = yield self.store.conversation_status(u'conv-1', [batch_id])
+        self.assertEqual((status['sent'], status['ack']), (1, 1))
+
+    @inlineCallbacks
+    def test_reconcile_cache_relinks_batch(self):
+        batch_id = yield self.store.batch_start([])
+        yield self.cache.add_conversation_batch(u'conv-1', batch_id)
+        plain_store = MessageStore(self.manager, self.redis)
+        msg = self.mk_msg()
+        yield plain_store.add_outbound_message(msg, batch_id=batch_id)
+        yield plain_store.add_event(self.mk_ack(msg))
+        yield self.store.reconcile_cache(batch_id)
+
+        self.assertEqual(
+            (yield self.cache.get_batch_conversation(batch_id)), u'conv-1')
+        self.assertTrue((yield self.cache.is_maintained(batch_id)))
+        self.assertEqual((yield self.cache.get_conversation_event_status(
+            u'conv-1', [batch_id])), {'sent': 1, 'ack': 1})
+
+        # Reconciling again doesn't count the batch twice.
+        yield self.store.reconcile_cache(batch_id)
+        self.assertEqual((yield self.cache.get_conversation_event_status(
+            u'conv-1', [batch_id])), {'sent': 1, 'ack': 1})
+
+    @inlineCallbacks
+    def test_conversation_batches_by_activity(self):
+        batch1 = yield self.store.batch_start([])
+        batch2 = yield self.store.batch_start([])
+        batch3 = yield self.store.batch_start([])
+        for batch_id in [batch1, batch2, batch3]:
+            yield self.cache.add_conversation_batch(u'conv-1', batch_id)
+        self.assertEqual(
+            (yield self.cache.get_conversation_batches_by_activity(
+                u'conv-1', [batch1, batch2, batch3])), [])
+
+        yield self.cache.add_outbound_message_key(batch1, u'msg-1', 20.0)
+        yield self.cache.add_outbound_message_key(batch2, u'msg-2', 10.0)
+        self.assertEqual(
+            (yield self.cache.get_conversation_batches_by_activity(
+                u'conv-1', [batch1, batch2, batch3])), [batch1, batch2])
+
+        # Older messages don't make a batch look less recently used.
+        yield self.cache.add_outbound_message_key(batch2, u'msg-3', 30.0)
+        yield self.cache.add_outbound_message_key(batch1, u'msg-4', 5.0)
+        self.assertEqual(
+            (yield self.cache.get_conversation_batches_by_activity(
+                u'conv-1', [batch1, batch2])), [batch2, batch1])
+
+    @inlineCallbacks
+    def test_conversation_batches_by_activity_not_maintained(self):
+        batch1 = yield self.store.batch_start([])
+        batch2 = yield self.store.batch_start([])
+        for batch_id in [batch1, batch2]:
+            yield self.cache.add_conversation_batch(u'conv-1', batch_id)
+        yield self.cache.add_outbound_message_key(batch1, u'msg-1', 20.0)
+        # An empty batch that isn't maintained can't be the latest one.
+        self.assertEqual(
+            (yield self.cache.get_conversation_batches_by_activity(
+                u'conv-1', [batch1, batch2])), [batch1])
+
+        # A plain message store doesn't keep the last outbound index.
+        plain_store = MessageStore(self.manager, self.redis)
+        yield plain_store.add_outbound_message(self.mk_msg(), batch_id=batch2)
+        self.assertEqual(
+            (yield self.cache.get_conversation_batches_by_activity(
+                u'conv-1', [batch1, batch2])), None)
+
+    @inlineCallbacks
+    def test_conversation_batches_by_activity_incomplete(self):
+        batch1 = yield self.store.batch_start([])
+        batch2 = yield self.store.batch_start([])
+        yield self.cache.add_conversation_batch(u'conv-1', batch1)
+        yield self.store.add_outbound_message(self.mk_msg(), batch_id=batch1)
+        self.assertEqual(
+            (yield self.cache.get_conversation_batches_by_activity(
+                u'conv-1', [batch1, batch2])), None)
+
+        yield self.store.reconcile_cache(batch1)
+        self.assertEqual(
+            (yield self.cache.get_conversation_batches_by_activity(
+                u'conv-1', [batch1])), [batch1])
+
+    def mk_timestamp(self, *args):
+        return time.mktime(datetime(*args).timetuple())
+
+    @inlineCallbacks
+    def test_rollups(self):
+        batch_id = yield self.store.batch_start([])
+        for i, args in enumerate([(2013, 5, 1, 10, 15, 5),
+                                  (2013, 5, 1, 10, 15, 55),
+                                  (2013, 5, 1, 11, 0, 0),
+                                  (2013, 5, 2, 9, 30, 0)]):
+            yield self.cache.add_outbound_message_key(
+                batch_id, u'msg-%s' % (i,), self.mk_timestamp(*args))
+        # Messages that are cached again aren't counted twice.
+        yield self.cache.add_outbound_message_key(
+            batch_id, u'msg-0', self.mk_timestamp(2013, 5, 1, 10, 15, 5))
+        yield self.cache.add_inbound_message_key(
+            batch_id, u'msg-in', self.mk_timestamp(2013, 5, 2, 9, 0, 0))
+
+        self.assertEqual(
+            (yield self.cache.get_rollup_counts(batch_id, 'outbound')),
+            [(datetime(2013, 5, 1), 3), (datetime(2013, 5, 2), 1)])
+        self.assertEqual(
+            (yield self.cache.get_rollup_counts(batch_id, 'inbound')),
+            [(datetime(2013, 5, 2), 1)])
+        self.assertEqual(
+            (yield self.cache.get_rollup_counts(batch_id, 'outbound', 'hour')),
+            [(datetime(2013, 5, 1, 10), 2), (datetime(2013, 5, 1, 11), 1),
+             (datetime(2013, 5, 2, 9), 1)])
+        self.assertEqual(
+            (yield self.cache.get_rollup_counts(
+                batch_id, 'outbound', 'minute',
+                start=datetime(2013, 5, 1, 10, 15, 30),
+                end=datetime(2013, 5, 1, 11, 0, 0))),
+            [(datetime(2013, 5, 1, 10, 15), 2), (datetime(2013, 5, 1, 11), 1)])
+        self.assertRaises(ValueError, self.cache.get_rollup_counts,
+                          batch_id, 'outbound', 'week')
+
+    @inlineCallbacks
+    def test_rebuild_rollups(self):
+        batch_id = yield self.store.batch_start([])
+        yield self.cache.add_outbound_message_key(
+            batch_id, u'msg-1', self.mk_timestamp(2013, 5, 1, 10, 0, 0))
+        yield self.cache.clear_rollups(batch_id)
+        yield self.cache.add_outbound_message_key(
+            batch_id, u'msg-2', self.mk_timestamp(2013, 5, 2, 10, 0, 0))
+        self.assertEqual(
+            (yield self.cache.get_rollup_counts(batch_id, 'outbound')), None)
+
+        count = yield self.cache.rebuild_rollups(batch_id)
+        self.assertEqual(count, 2)
+        self.assertEqual(
+            (yield self.cache.get_rollup_counts(batch_id, 'outbound')),
+            [(datetime(2013, 5, 1), 1), (datetime(2013, 5, 2), 1)])
+
+    @inlineCallbacks
+    def test_batch_start_with_cached_messages(self):
+        batch_id = yield self.store.batch_start([])
+        yield self.cache.add_outbound_message_key(
+            batch_id, u'msg-1', self.mk_timestamp(2013, 5, 1, 10, 0, 0))
+        yield self.cache.clear_rollups(batch_id)
+        yield self.cache.batch_start(batch_id)
+        self.assertEqual(
+            (yield self.cache.get_rollup_counts(batch_id, 'outbound')), None)
+
+    @inlineCallbacks
+    def test_rollups_not_maintained(self):
+        batch_id = yield self.store.batch_start([])
+        # A plain message store doesn't keep the rollups.
+        plain_store = MessageStore(self.manager, self.redis)
+        yield plain_store.add_outbound_message(
+            self.mk_msg(), batch_id=batch_id)
+        self.assertEqual(
+            (yield self.cache.get_rollup_counts(batch_id, 'outbound')), None)
+
+    @inlineCallbacks
+    def test_rollups_rebuilt_for_batch_not_maintained(self):
+        batch_id = yield self.store.batch_start([])
+        plain_store = MessageStore(self.manager, self.redis)
+        yield plain_store.cache.add_outbound_message_key(
+            batch_id, u'msg-1', self.mk_timestamp(2013, 5, 1, 10, 0, 0))
+        # Nothing is rolled up for a batch that isn't maintained.
+        yield self.cache.add_outbound_message_key(
+            batch_id, u'msg-2', self.mk_timestamp(2013, 5, 1, 11, 0, 0))
+        self.assertFalse((yield self.redis.exists(
+            self.cache.rollup_key(batch_id, 'outbound', 'day'))))
+
+        yield self.cache.rebuild_rollups(batch_id)
+        yield self.cache.add_outbound_message_key(
+            batch_id, u'msg-3', self.mk_timestamp(2013, 5, 1, 12, 0, 0))
+        self.assertEqual(
+            (yield self.cache.get_rollup_counts(batch_id, 'outbound')),
+            [(datetime(2013, 5, 1), 3)])
+
+    @inlineCallbacks
+    def test_reconcile_cache_recounts_rollups(self):
+        batch_id = yield self.store.batch_start([])
+        msg = self.mk_msg()
+        yield self.store.add_outbound_message(msg, batch_id=batch_id)
+        yield self.store.reconcile_cache(batch_id)
+        self.assertEqual(
+            (yield self.cache.get_rollup_counts(batch_id, 'outbound')),
+            [(datetime.combine(msg['timestamp'].date(), datetime.min.time()),
+              1)])
+
+    @inlineCallbacks
+    def test_build_search_index(self):
+        batch_id = yield self.store.batch_start([])
+        msg = self.mk_msg()
+        msg['content'] = u'hello world'
+        yield self.store.add_outbound_message(msg, batch_id=batch_id)
+        search_index = self.cache.search_index
+        self.assertEqual(
+            (yield search_index.search(batch_id, 'outbound', u'hello')), None)
+
+        count = yield self.store.build_search_index(batch_id)
+        self.assertEqual(count, 1)
+        self.assertEqual(
+            (yield search_index.search(batch_id, 'outbound', u'hello')),
+            [msg['message_id']])
+
+        # New messages are indexed as they're stored.
+        msg2 = self.mk_msg()
+        msg2['content'] = u'hello again'
+        yield self.store.add_outbound_message(msg2, batch_id=batch_id)
+        self.assertEqual(
+            set((yield search_index.search(batch_id, 'outbound', u'hel*'))),
+            set([msg['message_id'], msg2['message_id']]))
+
+    @inlineCallbacks
+    def test_search_messages_not_maintained(self):
+        batch_id = yield self.store.batch_start([])
+        yield self.cache.search_index.enable_batch(batch_id, complete=True)
+        msg = self.mk_msg()
+        msg['content'] = u'hello'
+        # A plain message store doesn't index the messages.
+        plain_store = MessageStore(self.manager, self.redis)
+        yield plain_store.add_outbound_message(msg, batch_id=batch_id)
+        self.assertEqual(
+            (yield self.cache.search_messages(batch_id, 'outbound', u'hello')),
+            None)
+
+        yield self.store.reconcile_cache(batch_id)
+        self.assertEqual(
+            (yield self.cache.search_messages(batch_id, 'outbound', u'hello')),
+            [msg['message_id']])
+
+    @inlineCallbacks
+    def test_reconcile_cache_rebuilds_search_index(self):
+        batch_id = yield self.store.batch_start([])
+        yield self.cache.search_index.enable_batch(batch_id, complete=True)
+        msg = self.mk_msg()
+        msg['content'] = u'hello'
+        yield self.store.add_outbound_message(msg, batch_id=batch_id)
+        yield self.store.reconcile_cache(batch_id)
+        self.assertEqual(
+            (yield self.cache.search_index.search(
+                batch_id, 'outbound', u'hello')),
+            [msg['message_id']])
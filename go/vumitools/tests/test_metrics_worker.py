@@ -2,12 +2,14 @@
 
 from datetime import datetime
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred
 from twisted.internet.task import Clock, LoopingCall
 
-from vumi.tests.utils import VumiWorkerTestCase
+from vumi.errors import ConfigError
+from vumi.tests.utils import VumiWorkerTestCase, get_stubbed_worker
 
 from go.vumitools.tests.utils import GoPersistenceMixin
+from go.vumitools.conversation import ConversationSummary
 from go.vumitools import metrics_worker
 
 
@@ -20,6 +22,7 @@ class GoMetricsWorkerTestCase(VumiWorkerTestCase, GoPersistenceMixin):
         super(GoMetricsWorkerTestCase, self).setUp()
         self.clock = Clock()
         self.patch(metrics_worker, 'LoopingCall', self.looping_call)
+        self.patch(metrics_worker, 'reactor', self.clock)
         self.worker = yield self.get_metrics_worker()
 
     @inlineCallbacks
@@ -100,6 +103,24 @@ class GoMetricsWorkerTestCase(VumiWorkerTestCase, GoPersistenceMixin):
         conversations = yield self.worker.find_conversations_for_account(akey)
         self.assertEqual([c.key for c in conversations], [conv2.key])
 
+    @inlineCallbacks
+    def test_find_conversations_for_account_with_status_index(self):
+        acc1 = yield self.make_account(u'acc1')
+        akey = acc1.key
+        user_api = self.worker.vumi_api.get_user_api(akey)
+
+        conv1 = yield self.make_conv(user_api, u'conv1')
+        yield self.end_conv(conv1)
+        conv2 = yield self.make_conv(user_api, u'conv2')
+        yield self.start_conv(conv2)
+        yield self.make_conv(user_api, u'conv3')
+        yield user_api.conversation_store.rebuild_status_index()
+
+        conversations = yield self.worker.find_conversations_for_account(akey)
+        self.assertEqual([c.key for c in conversations], [conv2.key])
+        self.assertEqual(conversations[0].user_account_key, akey)
+        self.assertEqual(conversations[0].conversation_type, u'my_conv')
+
     @inlineCallbacks
     def test_send_metrics_command(self):
         acc1 = yield self.make_account(u'acc1')
@@ -109,7 +130,8 @@ class GoMetricsWorkerTestCase(VumiWorkerTestCase, GoPersistenceMixin):
         conv1 = yield self.make_conv(user_api, u'conv1')
         yield self.start_conv(conv1)
 
-        yield self.worker.send_metrics_command(conv1)
+        yield self.worker.send_metrics_command(
+            ConversationSummary.from_conversation(conv1))
         [cmd] = self._get_dispatched('vumi.api')
         self.assertEqual(cmd.payload['kwargs']['conversation_key'], conv1.key)
         self.assertEqual(cmd.payload['kwargs']['user_account_key'], akey)
@@ -138,3 +160,92 @@ class GoMetricsWorkerTestCase(VumiWorkerTestCase, GoPersistenceMixin):
         conv_keys = [c.payload['kwargs']['conversation_key'] for c in cmds]
         self.assertEqual(sorted(conv_keys),
                          sorted(c.key for c in [conv1, conv2, conv3, conv4]))
+
+    @inlineCallbacks
+    def test_metrics_loop_func_sharded(self):
+        yield self.worker.stopWorker()
+        self.worker = yield self.get_metrics_worker({
+            'shard_count': 2,
+            'shard_index': 1,
+            })
+        accounts = []
+        for i in range(6):
+            account = yield self.make_account(u'acc%s' % (i,))
+            yield self.worker.redis.sadd('metrics_accounts', account.key)
+            user_api = self.worker.vumi_api.get_user_api(account.key)
+            conv = yield self.make_conv(user_api, u'conv%s' % (i,))
+            yield self.start_conv(conv)
+            accounts.append((account.key, conv.key))
+
+        yield self.worker.metrics_loop_func()
+
+        cmds = self._get_dispatched('vumi.api')
+        conv_keys = [c.payload['kwargs']['conversation_key'] for c in cmds]
+        self.assertEqual(sorted(conv_keys), sorted(
+            conv_key for account_key, conv_key in accounts
+            if metrics_worker.shard_for_key(account_key, 2) == 1))
+
+    def test_shard_for_key(self):
+        keys = [u'account-%s' % (i,) for i in range(100)]
+        shards = [metrics_worker.shard_for_key(key, 4) for key in keys]
+        self.assertEqual(set(shards), set(range(4)))
+        # Adding a shard only moves keys to the new shard.
+        for key, shard in zip(keys, shards):
+            new_shard = metrics_worker.shard_for_key(key, 5)
+            self.assertTrue(new_shard in (shard, 4))
+
+    @inlineCallbacks
+    def test_skipped_cycles(self):
+        yield self.worker.stopWorker()
+        self.worker = yield self.get_metrics_worker(start=False)
+        d = Deferred()
+        self.worker.find_conversations = lambda account_keys: d
+        yield self.worker.startWorker()
+        self.clock.advance(300)
+        self.clock.advance(300)
+        self.assertEqual(len(self.worker.skipped_cycles.poll()), 2)
+
+        self.clock.advance(10)
+        d.callback([])
+        [(_, duration)] = self.worker.loop_duration.poll()
+        self.assertEqual(duration, 610)
+
+    @inlineCallbacks
+    def test_loop_duration_excludes_jitter(self):
+        yield self.worker.stopWorker()
+        self.worker = yield self.get_metrics_worker({
+            'metrics_jitter': 0.5,
+            }, start=False)
+        d = Deferred()
+        self.worker.find_conversations = lambda account_keys: d
+        self.worker.send_metrics_commands = (
+            lambda conversations: Deferred())
+        yield self.worker.startWorker()
+        self.clock.advance(10)
+        d.callback([])
+        [(_, duration)] = self.worker.loop_duration.poll()
+        self.assertEqual(duration, 10)
+
+    def test_invalid_metrics_jitter(self):
+        worker = get_stubbed_worker(metrics_worker.GoMetricsWorker,
+                                    self.mk_config({'metrics_jitter': 1}))
+        self.assertRaises(ConfigError, worker.validate_config)
+
+    @inlineCallbacks
+    def test_send_metrics_commands_with_jitter(self):
+        yield self.worker.stopWorker()
+        self.worker = yield self.get_metrics_worker({
+            'metrics_jitter': 0.5,
+            })
+        acc1 = yield self.make_account(u'acc1')
+        user_api = self.worker.vumi_api.get_user_api(acc1.key)
+        conv1 = yield self.make_conv(user_api, u'conv1')
+        yield self.start_conv(conv1)
+
+        d = self.worker.send_metrics_commands([
+            ConversationSummary.from_conversation(conv1)])
+        self.assertEqual(self._get_dispatched('vumi.api'), [])
+        self.clock.advance(150)
+        yield d
+        [cmd] = self._get_dispatched('vumi.api')
+        self.assertEqual(cmd.payload['kwargs']['conversation_key'], conv1.key)
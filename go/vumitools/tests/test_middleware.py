@@ -10,7 +10,8 @@ from vumi.middleware.tagger import TaggingMiddleware
 
 from go.vumitools.tests.utils import AppWorkerTestCase
 from go.vumitools.middleware import (NormalizeMsisdnMiddleware,
-    OptOutMiddleware, MetricsMiddleware)
+    OptOutMiddleware, MetricsMiddleware, DebitAccountMiddleware,
+    InsufficientCredit, NoUserError, NoTagError, BadTagPool)
 
 
 class MiddlewareTestCase(AppWorkerTestCase):
@@ -167,6 +168,92 @@ class OptOutMiddlewareTestCase(MiddlewareTestCase):
         })
 
 
+class DebitAccountMiddlewareTestCase(MiddlewareTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(DebitAccountMiddlewareTestCase, self).setUp()
+        self.config = self.default_config.copy()
+        self.config.update({
+            'metrics_prefix': 'go.debit.',
+        })
+        self.mw = yield self.create_middleware(DebitAccountMiddleware,
+            config=self.config)
+        self._middlewares.append(self.mw)
+        self._persist_redis_managers.append(self.mw.vumi_api.redis)
+        yield self.mw.vumi_api.tpm.declare_tags([("pool", "tag1")])
+        yield self.mw.vumi_api.tpm.set_metadata("pool", {
+                "credits_per_message": 2,
+                })
+
+    def mk_debit_msg(self, user_account_key=u'user-1', tag=("pool", "tag1")):
+        msg = self.mk_msg()
+        if user_account_key is not None:
+            DebitAccountMiddleware.add_user_to_message(msg, user_account_key)
+        if tag is not None:
+            TaggingMiddleware.add_tag_to_msg(msg, tag)
+        return msg
+
+    @inlineCallbacks
+    def test_debit(self):
+        yield self.mw.cm.credit(u'user-1', 3)
+        msg = self.mk_debit_msg()
+        self.assertEqual((yield self.mw.handle_outbound(msg, 'dummy')), msg)
+        self.assertEqual((yield self.mw.cm.get_credit(u'user-1')), 1)
+        [latency] = self.mw.debit_latency.poll()
+        self.assertTrue(latency[1] >= 0)
+
+    @inlineCallbacks
+    def test_insufficient_credit(self):
+        yield self.mw.cm.credit(u'user-1', 1)
+        yield self.assertFailure(
+            self.mw.handle_outbound(self.mk_debit_msg(), 'dummy'),
+            InsufficientCredit)
+        self.assertEqual((yield self.mw.cm.get_credit(u'user-1')), 1)
+        self.assertEqual(len(self.mw.insufficient_credit.poll()), 1)
+
+    @inlineCallbacks
+    def test_prepaid_message(self):
+        msg = self.mk_debit_msg()
+        DebitAccountMiddleware.add_prepaid_to_payload(msg.payload)
+        self.assertEqual((yield self.mw.handle_outbound(msg, 'dummy')), msg)
+        self.assertEqual((yield self.mw.cm.get_credit(u'user-1')), None)
+
+    @inlineCallbacks
+    def test_bad_messages(self):
+        yield self.assertFailure(self.mw.handle_outbound(
+            self.mk_debit_msg(user_account_key=None), 'dummy'), NoUserError)
+        yield self.assertFailure(self.mw.handle_outbound(
+            self.mk_debit_msg(tag=None), 'dummy'), NoTagError)
+        yield self.mw.vumi_api.tpm.set_metadata("pool", {})
+        yield self.assertFailure(self.mw.handle_outbound(
+            self.mk_debit_msg(), 'dummy'), BadTagPool)
+
+    @inlineCallbacks
+    def test_credit_lease(self):
+        config = self.config.copy()
+        config.update({
+            'credit_lease_messages': 3,
+        })
+        mw = yield self.create_middleware(DebitAccountMiddleware,
+            config=config)
+        self._middlewares.append(mw)
+        self._persist_redis_managers.append(mw.vumi_api.redis)
+        yield mw.vumi_api.tpm.set_metadata("pool", {
+                "credits_per_message": 2,
+                })
+        yield mw.cm.credit(u'user-1', 10)
+
+        yield mw.handle_outbound(self.mk_debit_msg(), 'dummy')
+        self.assertEqual((yield mw.cm.get_credit(u'user-1')), 4)
+        self.assertEqual(mw.credit_leases.get_leased_credit(u'user-1'), 4)
+        yield mw.handle_outbound(self.mk_debit_msg(), 'dummy')
+        self.assertEqual((yield mw.cm.get_credit(u'user-1')), 4)
+
+        yield mw.credit_leases.return_unused()
+        self.assertEqual((yield mw.cm.get_credit(u'user-1')), 6)
+
+
 class MetricsMiddlewareTestCase(MiddlewareTestCase):
 
     @inlineCallbacks
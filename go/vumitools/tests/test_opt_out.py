@@ -0,0 +1,72 @@
+"""Tests for go.vumitools.opt_out."""
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial.unittest import TestCase
+
+from go.vumitools.tests.utils import GoPersistenceMixin
+from go.vumitools.account import AccountStore
+from go.vumitools.opt_out import OptOutStore
+
+
+class TestOptOutStore(GoPersistenceMixin, TestCase):
+    use_riak = True
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.manager = self.get_riak_manager()
+        self.redis = yield self.get_redis_manager()
+        self.account_store = AccountStore(self.manager)
+        self.account = yield self.mk_user(self, u'user')
+        self.store = OptOutStore(self.manager, self.account.key, self.redis)
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    def mk_opt_out(self, addr_value, addr_type=u'msisdn', store=None):
+        store = store or self.store
+        return store.new_opt_out(addr_type, addr_value, {
+            'message_id': u'the-message-id'})
+
+    @inlineCallbacks
+    def test_opt_outs_for_addresses_without_index(self):
+        yield self.mk_opt_out(u'+27831234567')
+        self.assertFalse((yield self.store.opt_out_index_built()))
+        opt_out_keys = yield self.store.opt_outs_for_addresses(
+            u'msisdn', [u'+27831234567', u'+27830000000'])
+        self.assertEqual(opt_out_keys, [u'msisdn:+27831234567'])
+
+    @inlineCallbacks
+    def test_rebuild_opt_out_index(self):
+        # This one isn't indexed because the store has no Redis manager.
+        riak_store = OptOutStore(self.manager, self.account.key)
+        yield self.mk_opt_out(u'+27831234567', store=riak_store)
+        yield self.mk_opt_out(u'user@example.com', addr_type=u'gtalk')
+
+        count = yield self.store.rebuild_opt_out_index()
+        self.assertEqual(count, 2)
+        self.assertTrue((yield self.store.opt_out_index_built()))
+        self.assertEqual(
+            (yield self.store.opt_outs_for_addresses(
+                u'msisdn', [u'+27831234567', u'user@example.com'])),
+            [u'msisdn:+27831234567'])
+        self.assertEqual(
+            (yield self.store.opt_outs_for_addresses(
+                u'gtalk', [u'+27831234567', u'user@example.com'])),
+            [u'gtalk:user@example.com'])
+
+    @inlineCallbacks
+    def test_index_maintained(self):
+        yield self.store.rebuild_opt_out_index()
+        yield self.mk_opt_out(u'+27831234567')
+        yield self.mk_opt_out(u'+27831234568')
+        self.assertEqual(
+            (yield self.store.opt_outs_for_addresses(
+                u'msisdn', [u'+27831234567', u'+27831234568'])),
+            [u'msisdn:+27831234567', u'msisdn:+27831234568'])
+
+        yield self.store.delete_opt_out(u'msisdn', u'+27831234567')
+        self.assertEqual(
+            (yield self.store.opt_outs_for_addresses(
+                u'msisdn', [u'+27831234567', u'+27831234568'])),
+            [u'msisdn:+27831234568'])
@@ -0,0 +1,40 @@
+"""Tests for go.vumitools.routing."""
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks
+
+from go.vumitools.routing import ConversationRoutingIndex
+from go.vumitools.tests.utils import GoPersistenceMixin
+
+
+class TestConversationRoutingIndex(TestCase, GoPersistenceMixin):
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.redis = yield self.get_redis_manager()
+        self.index = ConversationRoutingIndex(self.redis)
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    @inlineCallbacks
+    def test_add_and_get_batch(self):
+        self.assertEqual((yield self.index.get_batch('batch-1')), None)
+        yield self.index.add_batch('batch-1', 'conv-1', 'bulk_message',
+                                   'account-1')
+        self.assertEqual((yield self.index.get_batch('batch-1')), {
+            'conversation_key': 'conv-1',
+            'conversation_type': 'bulk_message',
+            'user_account': 'account-1',
+            })
+
+    @inlineCallbacks
+    def test_get_batch_from_redis(self):
+        yield self.index.add_batch('batch-1', 'conv-1', 'bulk_message',
+                                   'account-1')
+        # A new index (in another process, say) has an empty cache.
+        other_index = ConversationRoutingIndex(self.redis)
+        info = yield other_index.get_batch('batch-1')
+        self.assertEqual(info['conversation_type'], 'bulk_message')
+        self.assertEqual(other_index.batch_cache.get('batch-1'), info)
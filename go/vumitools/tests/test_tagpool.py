@@ -0,0 +1,81 @@
+"""Tests for go.vumitools.tagpool."""
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks
+
+from go.vumitools.cache import LRUCache
+from go.vumitools.tagpool import GoTagpoolManager
+from go.vumitools.tests.utils import GoPersistenceMixin
+
+
+class TestGoTagpoolManager(TestCase, GoPersistenceMixin):
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.redis = yield self.get_redis_manager()
+        self.tpm = GoTagpoolManager(self.redis)
+        yield self.tpm.declare_tags([(u'pool', u'tag1')])
+        yield self.tpm.set_metadata(u'pool', {'credits_per_message': 1})
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    @inlineCallbacks
+    def test_get_metadata_cached(self):
+        self.assertEqual((yield self.tpm.get_metadata(u'pool')),
+                         {'credits_per_message': 1})
+
+        def fail_hgetall(*args):
+            self.fail("Unexpected hgetall call")
+        self.patch(self.redis, 'hgetall', fail_hgetall)
+        # Other tagpool managers in this process share the cache.
+        other_tpm = GoTagpoolManager(self.redis)
+        self.assertEqual((yield other_tpm.get_metadata(u'pool')),
+                         {'credits_per_message': 1})
+
+    @inlineCallbacks
+    def test_get_metadata_returns_copy(self):
+        metadata = yield self.tpm.get_metadata(u'pool')
+        metadata['credits_per_message'] = 5
+        self.assertEqual((yield self.tpm.get_metadata(u'pool')),
+                         {'credits_per_message': 1})
+
+    @inlineCallbacks
+    def test_set_metadata_invalidates(self):
+        yield self.tpm.get_metadata(u'pool')
+        yield self.tpm.set_metadata(u'pool', {'credits_per_message': 2})
+        self.assertEqual((yield self.tpm.get_metadata(u'pool')),
+                         {'credits_per_message': 2})
+
+    @inlineCallbacks
+    def test_invalidate_metadata(self):
+        yield self.tpm.get_metadata(u'pool')
+        # Changed by another process.
+        yield self.redis.hset('tagpools:pool:metadata', 'credits_per_message',
+                              '3')
+        self.assertEqual((yield self.tpm.get_metadata(u'pool')),
+                         {'credits_per_message': 1})
+        self.tpm.invalidate_metadata(u'pool')
+        self.assertEqual((yield self.tpm.get_metadata(u'pool')),
+                         {'credits_per_message': 3})
+
+    @inlineCallbacks
+    def test_set_metadata_invalidates_other_processes(self):
+        yield self.tpm.get_metadata(u'pool')
+        other_tpm = GoTagpoolManager(self.redis)
+        # Give it a cache of its own, as it would have in another process.
+        other_tpm.metadata_cache = LRUCache()
+        yield other_tpm.set_metadata(u'pool', {'credits_per_message': 2})
+        self.assertEqual((yield self.tpm.get_metadata(u'pool')),
+                         {'credits_per_message': 2})
+
+    @inlineCallbacks
+    def test_refresh_metadata(self):
+        yield self.tpm.get_metadata(u'pool')
+        # Changed by a plain tagpool manager.
+        yield self.redis.hset('tagpools:pool:metadata', 'credits_per_message',
+                              '3')
+        yield self.tpm.refresh_metadata()
+        self.assertEqual((yield self.tpm.get_metadata(u'pool')),
+                         {'credits_per_message': 3})
@@ -6,6 +6,9 @@ from vumi.middleware.tagger import TaggingMiddleware
 
 from go.vumitools.api import VumiApi
 from go.vumitools.api_worker import GoMessageMetadata
+from go.vumitools import utils
+from go.vumitools.utils import (
+    message_metadata_cache, load_bunches, collect_bunches)
 from go.vumitools.tests.utils import GoPersistenceMixin
 
 
@@ -145,6 +148,65 @@ class GoMessageMetadataTestCase(GoPersistenceMixin, TestCase):
         self.assertEqual({}, other_md._store_objects)
         self.assertEqual(md._go_metadata, other_md._go_metadata)
 
+    @inlineCallbacks
+    def test_cached_conversation_lookup(self):
+        conversation = yield self.create_conversation()
+        batch_key = yield self.tag_conversation(conversation, self.tag)
+        msg = self.mk_msg('to@domain.org', 'from@domain.org')
+        TaggingMiddleware.add_tag_to_msg(msg, self.tag)
+        yield self.mk_md(msg).get_conversation_info()
+
+        # A second message on the same tag only needs the tag's current
+        # batch.
+        def fail(*args, **kw):
+            self.fail('Unexpected store lookup.')
+        self.patch(self.vumi_api.mdb, 'get_batch', fail)
+
+        other_msg = self.mk_msg('to@domain.org', 'from@domain.org')
+        TaggingMiddleware.add_tag_to_msg(other_msg, self.tag)
+        md = self.mk_md(other_msg)
+        conv_key, conv_type = yield md.get_conversation_info()
+        self.assertEqual(conv_key, conversation.key)
+        self.assertEqual(conv_type, conversation.conversation_type)
+        self.assertEqual(other_msg['helper_metadata']['go'], {
+                'batch_key': batch_key,
+                'user_account': self.account.key,
+                'conversation_key': conv_key,
+                'conversation_type': conv_type,
+                })
+
+    @inlineCallbacks
+    def test_cache_invalidation(self):
+        conversation = yield self.create_conversation()
+        batch_key = yield self.tag_conversation(conversation, self.tag)
+        msg = self.mk_msg('to@domain.org', 'from@domain.org')
+        TaggingMiddleware.add_tag_to_msg(msg, self.tag)
+        yield self.mk_md(msg).get_conversation_info()
+
+        message_metadata_cache.invalidate_batch(batch_key)
+        self.assertEqual(
+            message_metadata_cache.get_account_key(batch_key), None)
+        self.assertEqual(
+            message_metadata_cache.get_conversation_info(batch_key), None)
+
+    @inlineCallbacks
+    def test_reused_tag(self):
+        conversation = yield self.create_conversation()
+        yield self.tag_conversation(conversation, self.tag)
+        msg = self.mk_msg('to@domain.org', 'from@domain.org')
+        TaggingMiddleware.add_tag_to_msg(msg, self.tag)
+        yield self.mk_md(msg).get_conversation_info()
+
+        # The tag is picked up for another batch without the first one
+        # being invalidated in this process.
+        other_conversation = yield self.create_conversation()
+        other_batch_key = yield self.tag_conversation(
+            other_conversation, self.tag)
+        other_msg = self.mk_msg('to@domain.org', 'from@domain.org')
+        TaggingMiddleware.add_tag_to_msg(other_msg, self.tag)
+        self.assertEqual(
+            (yield self.mk_md(other_msg).get_batch_key()), other_batch_key)
+
     def test_is_sensitive(self):
         msg = self.mk_msg('to@domain.org', 'from@domain.org')
         self.assertFalse(self.mk_md(msg).is_sensitive())
@@ -155,3 +217,61 @@ class GoMessageMetadataTestCase(GoPersistenceMixin, TestCase):
             }
         }
         self.assertTrue(self.mk_md(msg).is_sensitive())
+
+
+class LoadBunchesTestCase(GoPersistenceMixin, TestCase):
+    use_riak = True
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.vumi_api = yield VumiApi.from_config_async(self._persist_config)
+        self._persist_riak_managers.append(self.vumi_api.manager)
+        self._persist_redis_managers.append(self.vumi_api.redis)
+        account = yield self.mk_user(self.vumi_api, u'user')
+        self.contact_store = self.vumi_api.get_user_api(
+            account.key).contact_store
+        self.patch(utils, 'LOAD_BUNCH_SIZE', 2)
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    @inlineCallbacks
+    def mk_contact_keys(self, count):
+        keys = []
+        for i in range(count):
+            contact = yield self.contact_store.new_contact(
+                name=u'name', surname=u'surname', msisdn=u'+2783%s' % (i,))
+            keys.append(contact.key)
+        returnValue(keys)
+
+    @inlineCallbacks
+    def test_load_bunches(self):
+        keys = yield self.mk_contact_keys(5)
+        # Missing objects are left out.
+        bunches = load_bunches(self.contact_store.contacts,
+                               keys[:1] + [u'missing'] + keys[1:],
+                               concurrency=2, read_ahead=1)
+        loaded = []
+        for bunch in bunches:
+            loaded.append([contact.key for contact in (yield bunch)])
+        self.assertEqual(loaded, [keys[:1], keys[1:3], keys[3:]])
+
+    @inlineCallbacks
+    def test_load_bunches_no_read_ahead(self):
+        keys = yield self.mk_contact_keys(3)
+        contacts = yield collect_bunches(load_bunches(
+            self.contact_store.contacts, keys, concurrency=1, read_ahead=0))
+        self.assertEqual([contact.key for contact in contacts], keys)
+
+    def test_load_bunches_no_keys(self):
+        self.assertEqual(
+            list(load_bunches(self.contact_store.contacts, [])), [])
+
+    @inlineCallbacks
+    def test_collect_bunches(self):
+        self.assertEqual(collect_bunches([[1], [], [2, 3]]), [1, 2, 3])
+        keys = yield self.mk_contact_keys(5)
+        contacts = yield collect_bunches(
+            load_bunches(self.contact_store.contacts, keys))
+        self.assertEqual([contact.key for contact in contacts], keys)
@@ -17,7 +17,9 @@ from vumi.tests.utils import PersistenceMixin
 
 from go.vumitools.api import VumiApiCommand
 from go.vumitools.account import UserAccount
-from go.vumitools.contact import Contact, ContactGroup
+from go.vumitools.contact import Contact, ContactGroup, ContactStore
+from go.vumitools.utils import message_metadata_cache
+from go.vumitools.tagpool import GoTagpoolManager
 
 
 def field_eq(f1, f2):
@@ -160,6 +162,10 @@ class CeleryTestMixIn(object):
 class GoPersistenceMixin(PersistenceMixin):
     def _persist_setUp(self):
         self._users_created = 0
+        # Cached lookups from other tests point at data that's been purged.
+        message_metadata_cache.clear()
+        GoTagpoolManager.metadata_cache.clear()
+        ContactStore.addr_cache.clear()
         return super(GoPersistenceMixin, self)._persist_setUp()
 
     @PersistenceMixin.sync_or_async
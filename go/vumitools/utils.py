@@ -1,10 +1,187 @@
 # -*- test-case-name: go.vumitools.tests.test_utils -*-
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from collections import deque
+
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, DeferredSemaphore, gatherResults,
+    succeed)
 
 from vumi import log
 from vumi.middleware.tagger import TaggingMiddleware
 
+from go.vumitools.cache import LRUCache
+
+
+def gather_results(results):
+    """
+    Collect the results of several calls made to a sync or async manager.
+
+    Calls made to an async manager are all in flight at once (and are
+    pipelined over a single connection) so this returns a Deferred that
+    fires with the list of their results. Calls made to a sync manager have
+    already returned so their results are returned as is. Either way, the
+    return value can be yielded from a `Manager.calls_manager` method.
+    """
+    results = list(results)
+    if not any(isinstance(result, Deferred) for result in results):
+        return results
+    return gatherResults([
+        result if isinstance(result, Deferred) else succeed(result)
+        for result in results])
+
+
+def map_pages(pages, func, *args):
+    """
+    Return an iterator over the results of calling `func` on each of the
+    (possibly deferred) pages in `pages`, such as those returned by
+    `load_all_bunches()`. Pages are only fetched as the iterator is
+    advanced.
+    """
+    for page in pages:
+        if isinstance(page, Deferred):
+            yield page.addCallback(func, *args)
+        else:
+            yield func(page, *args)
+
+
+# How many keys are loaded from Riak per bunch by `load_bunches()`.
+LOAD_BUNCH_SIZE = 100
+
+# How many bunches `load_bunches()` loads at once by default, and how many it
+# loads (or queues up to load) ahead of the one the caller is waiting for.
+DEFAULT_LOAD_CONCURRENCY = 4
+DEFAULT_READ_AHEAD = 8
+
+
+def _flatten_bunches(bunches):
+    return [obj for bunch in bunches for obj in bunch]
+
+
+def load_bunches(proxy, keys, concurrency=None, read_ahead=None):
+    """
+    Load the objects for `keys` through the model `proxy`, like its
+    `load_all_bunches()`, but with several bunches in flight at once. Returns
+    an iterator over (possibly deferred) lists of objects, in the same order
+    as `keys`. Objects that don't exist are left out.
+
+    With an async manager up to `concurrency` bunches are loaded at once and
+    up to `read_ahead` bunches are loaded (or queued to be loaded) ahead of
+    the one the caller is waiting on. Nothing is loaded until the iterator
+    is advanced. With a sync manager each bunch is loaded as the caller gets
+    to it.
+    """
+    keys = list(keys)
+    concurrency = concurrency or DEFAULT_LOAD_CONCURRENCY
+    if read_ahead is None:
+        read_ahead = DEFAULT_READ_AHEAD
+    chunks = (keys[i:i + LOAD_BUNCH_SIZE]
+              for i in xrange(0, len(keys), LOAD_BUNCH_SIZE))
+
+    def load(chunk):
+        bunches = gather_results(proxy.load_all_bunches(chunk))
+        if isinstance(bunches, Deferred):
+            return bunches.addCallback(_flatten_bunches)
+        return _flatten_bunches(bunches)
+
+    first_chunk = next(chunks, None)
+    if first_chunk is None:
+        return
+    bunch = load(first_chunk)
+    if not isinstance(bunch, Deferred):
+        # A sync manager has already loaded the bunch.
+        yield bunch
+        for chunk in chunks:
+            yield load(chunk)
+        return
+
+    # The first bunch is already in flight, so it holds one of the
+    # semaphore's tokens until it's done.
+    semaphore = DeferredSemaphore(concurrency)
+    semaphore.acquire()
+
+    def release(result):
+        semaphore.release()
+        return result
+
+    pending = deque([bunch.addBoth(release)])
+    for chunk in chunks:
+        if len(pending) > read_ahead:
+            yield pending.popleft()
+        pending.append(semaphore.run(load, chunk))
+    while pending:
+        yield pending.popleft()
+
+
+def collect_bunches(bunches):
+    """
+    Collect the objects in the (possibly deferred) lists in `bunches` into
+    a single list, or a Deferred that fires with it. Callers that can handle
+    the objects a bunch at a time should iterate over `bunches` instead.
+    """
+    bunches = iter(bunches)
+    collected = []
+    for bunch in bunches:
+        if isinstance(bunch, Deferred):
+            return _collect_deferred_bunches(bunch, bunches, collected)
+        collected.extend(bunch)
+    return collected
+
+
+@inlineCallbacks
+def _collect_deferred_bunches(bunch, bunches, collected):
+    collected.extend((yield bunch))
+    for bunch in bunches:
+        collected.extend((yield bunch))
+    returnValue(collected)
+
+
+class GoMessageMetadataCache(object):
+    """Process-wide cache for the store lookups done by
+    :class:`GoMessageMetadata`.
+
+    Every message in a batch needs the same batch -> account and
+    batch -> conversation lookups, so we keep the answers around for a
+    while instead of asking Riak each time. Entries expire after `ttl`
+    seconds and :meth:`invalidate_batch` is called when a conversation's
+    batches are released.
+
+    The tag -> batch lookup isn't cached, because a tag can be released and
+    acquired for another account's batch at any time and a stale entry in
+    another process would send messages to the wrong account.
+    """
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.configure(max_size, ttl)
+
+    def configure(self, max_size, ttl):
+        self.batch_accounts = LRUCache(max_size, ttl)
+        self.batch_conversations = LRUCache(max_size, ttl)
+
+    def clear(self):
+        self.batch_accounts.clear()
+        self.batch_conversations.clear()
+
+    def get_account_key(self, batch_key):
+        return self.batch_accounts.get(batch_key)
+
+    def set_account_key(self, batch_key, account_key):
+        self.batch_accounts.set(batch_key, account_key)
+
+    def get_conversation_info(self, batch_key):
+        return self.batch_conversations.get(batch_key)
+
+    def set_conversation_info(self, batch_key, conversation_key,
+                              conversation_type):
+        self.batch_conversations.set(
+            batch_key, (conversation_key, conversation_type))
+
+    def invalidate_batch(self, batch_key):
+        self.batch_accounts.delete(batch_key)
+        self.batch_conversations.delete(batch_key)
+
+
+message_metadata_cache = GoMessageMetadataCache()
+
 
 class GoMessageMetadata(object):
     """Look up various bits of metadata for a Vumi Go message.
@@ -18,11 +195,18 @@ class GoMessageMetadata(object):
     2. Objects retreived from those stores get stashed on the message object.
        This is helpful for preventing duplicate lookups within a worker.
        (Between different middlewares, for example.)
+
+    3. Keys found by looking things up get put in a process-wide
+       :class:`GoMessageMetadataCache`. This is helpful for preventing
+       duplicate lookups between messages in the same batch.
     """
 
-    def __init__(self, vumi_api, message):
+    def __init__(self, vumi_api, message, cache=None):
         self.vumi_api = vumi_api
         self.message = message
+        if cache is None:
+            cache = message_metadata_cache
+        self.cache = cache
 
         # Easier access to metadata.
         message_metadata = message.get('helper_metadata', {})
@@ -89,6 +273,12 @@ class GoMessageMetadata(object):
 
     @inlineCallbacks
     def get_batch_key(self):
+        if 'batch_key' not in self._go_metadata:
+            # The tag's current batch is looked up for every message, but
+            # the batch itself only needs loading if we don't know the key.
+            tag_info = yield self._get_tag_info()
+            if tag_info and tag_info.current_batch.key is not None:
+                self._go_metadata['batch_key'] = tag_info.current_batch.key
         if 'batch_key' not in self._go_metadata:
             # We're calling _find_batch() for the side effect, which is to put
             # the batch key in the metadata if there is one.
@@ -101,11 +291,19 @@ class GoMessageMetadata(object):
             # We already have this, no need to look it up.
             returnValue(self._go_metadata['user_account'])
 
+        batch_key = yield self.get_batch_key()
+        if batch_key is not None:
+            user_account_key = self.cache.get_account_key(batch_key)
+            if user_account_key is not None:
+                self._go_metadata['user_account'] = user_account_key
+                returnValue(user_account_key)
+
         # Look it up from the batch, assuming we can get one.
         batch = yield self._find_batch()
         if batch:
             user_account_key = batch.metadata['user_account']
             self._go_metadata['user_account'] = user_account_key
+            self.cache.set_account_key(batch.key, user_account_key)
             returnValue(user_account_key)
 
     @inlineCallbacks
@@ -154,11 +352,8 @@ class GoMessageMetadata(object):
             return
 
         conv_keys = yield batch.backlinks.conversations(conv_store.manager)
-        conv_model = conv_store.conversations
-        bunches = yield conv_model.load_all_bunches(conv_keys)
-        conversations = []
-        for bunch in bunches:
-            conversations.extend((yield bunch))
+        conversations = yield collect_bunches(
+            load_bunches(conv_store.conversations, conv_keys))
         if not conversations:
             # No open conversations for this batch.
             return
@@ -172,10 +367,23 @@ class GoMessageMetadata(object):
 
         self._go_metadata['conversation_key'] = conversation.key
         self._go_metadata['conversation_type'] = conversation.conversation_type
+        self.cache.set_conversation_info(
+            batch.key, conversation.key, conversation.conversation_type)
         returnValue(conversation)
 
     @inlineCallbacks
     def get_conversation_info(self):
+        if 'conversation_key' not in self._go_metadata:
+            batch_key = yield self.get_batch_key()
+            conv_info = (self.cache.get_conversation_info(batch_key)
+                         if batch_key is not None else None)
+            if conv_info is not None:
+                # We still need the account key, which is usually cached
+                # alongside the conversation.
+                yield self.get_account_key()
+                conv_key, conv_type = conv_info
+                self._go_metadata['conversation_key'] = conv_key
+                self._go_metadata['conversation_type'] = conv_type
         if 'conversation_key' not in self._go_metadata:
             conv = yield self.get_conversation()
             if conv is None: